@@ -0,0 +1,161 @@
+# api.py
+# HTTP API ของแชทบอท (Flask) สำหรับ LINE / web widget — ใช้ ChatEngine ตัวเดียวกับหน้า Streamlit
+#
+# รัน:  python api.py                      (FTE_API_PORT, ค่าเริ่มต้น 8000)
+#       flask --app api run --with-threads
+# ทดสอบโดยไม่เรียก Gemini:  FTE_LLM_BACKEND=stub python api.py
+#
+# POST /chat  {"message": "...", "conversation_id": "...", "stream": true}
+#   stream=true (ค่าเริ่มต้น) → text/event-stream: meta, delta (ทีละชิ้น), restart, done / error
+#   stream=false → JSON {"conversation_id", "reply", "stats"}
+# GET  /healthz → สถานะดัชนี
+# เวลาแต่ละขั้นของทุกคำขอ → logs/trace-api-<pid>.jsonl (FTE_TRACE_PATH) แยกจากไฟล์ของหน้า Streamlit
+import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from flask import Flask, Response, jsonify, request, stream_with_context
+
+from engine import ChatEngine, GeminiBackend, LLMBackend, ModelUnavailableError, StubBackend, load_api_key, open_index
+from prefixcache import PREFIX_CACHE_ENABLED, LocalPrefixStore, PrefixCache
+from tracing import Tracer
+
+GREETING = "คุณต้องการสอบถามข้อมูลเรื่องใดคะ"
+# บทสนทนาที่ไม่มีความเคลื่อนไหวเกิน TTL จะถูกลบ และเก็บได้ไม่เกิน MAX_CONVERSATIONS (LRU)
+CONVERSATION_TTL = float(os.environ.get("FTE_CONVERSATION_TTL", str(2 * 3600)))
+MAX_CONVERSATIONS = int(os.environ.get("FTE_MAX_CONVERSATIONS", "10000"))
+
+class ConversationStore:
+    """บทสนทนาในหน่วยความจำ: messages + dict session ของ engine + lock กันคำขอซ้อนในบทสนทนาเดียว"""
+
+    def __init__(self, ttl: float = CONVERSATION_TTL, max_items: int = MAX_CONVERSATIONS):
+        self.ttl, self.max_items = ttl, max_items
+        self._items: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, conversation_id: Optional[str]) -> Tuple[str, Dict]:
+        now = time.time()
+        with self._lock:
+            while self._items:
+                oldest_id, oldest = next(iter(self._items.items()))
+                if now - oldest["touched"] <= self.ttl and len(self._items) < self.max_items:
+                    break
+                del self._items[oldest_id]
+            conv = self._items.get(conversation_id) if conversation_id else None
+            if conv is None:
+                conversation_id = conversation_id or uuid.uuid4().hex
+                conv = {"messages": [{"role": "assistant", "content": GREETING}],
+                        "session": {}, "lock": threading.Lock(), "touched": now}
+                self._items[conversation_id] = conv
+            conv["touched"] = now
+            self._items.move_to_end(conversation_id)
+            return conversation_id, conv
+
+def make_backend() -> LLMBackend:
+    if os.environ.get("FTE_LLM_BACKEND", "gemini") == "stub":
+        # จำลอง outage: FTE_STUB_FAULTS='{"gemini-2.5-flash": {"error_rate": 1.0}}' (ดู StubBackend)
+        # prefix cache ฝั่งผู้ให้บริการแทนด้วย LocalPrefixStore (ทางเดียวกับ CachedContent ของ Gemini)
+        return StubBackend(faults=json.loads(os.environ.get("FTE_STUB_FAULTS") or "{}"),
+                           prefix_cache=PrefixCache(LocalPrefixStore()) if PREFIX_CACHE_ENABLED else None)
+    api_key = load_api_key()
+    if not api_key:
+        raise RuntimeError("ไม่พบ GEMINI_APIKEY ใน environment หรือ .streamlit/secrets.toml")
+    return GeminiBackend(api_key)
+
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _public_stats(stats: Dict) -> Dict:
+    out = {k: v for k, v in stats.items() if k != "hits"}
+    out["hits"] = [{"chunk": i, "score": round(s, 4)} for i, s in stats.get("hits", [])]
+    return out
+
+def create_app(engine: Optional[ChatEngine] = None,
+               store: Optional[ConversationStore] = None) -> Flask:
+    engine = engine or ChatEngine(open_index(), make_backend(), tracer=Tracer(channel="api"))
+    store = store or ConversationStore()
+    app = Flask(__name__)
+
+    @app.get("/healthz")
+    def healthz():
+        state = engine.holder.state
+        return jsonify(ready=state is not None,
+                       chunks=len(state.chunks) if state else 0,
+                       fingerprint=state.fingerprint if state else None)
+
+    @app.post("/chat")
+    def chat():
+        body = request.get_json(silent=True) or {}
+        message = str(body.get("message") or "").strip()
+        if not message:
+            return jsonify(error="message is required"), 400
+        conversation_id, conv = store.get_or_create(body.get("conversation_id"))
+        # หนึ่งคำขอต่อบทสนทนาในเวลาเดียวกัน (history ต้องเรียงลำดับ) — บทสนทนาอื่นทำงานขนานกันได้
+        if not conv["lock"].acquire(blocking=False):
+            return jsonify(error="conversation is busy", conversation_id=conversation_id), 409
+
+        def _run(on_restart):
+            stats: Dict = {}
+            parts = []
+
+            def _restart(model_name: str) -> None:
+                parts.clear()
+                on_restart(model_name)
+
+            history = list(conv["messages"])
+            trace = engine.tracer.start(channel="api", conversation_id=conversation_id)
+            try:
+                for piece in engine.stream_reply(history, message, session=conv["session"],
+                                                 stats=stats, on_restart=_restart, trace=trace):
+                    parts.append(piece)
+                    yield piece
+            finally:
+                engine.tracer.finish(trace)
+            reply = "".join(parts)
+            conv["messages"] += [{"role": "user", "content": message},
+                                 {"role": "assistant", "content": reply}]
+            stats["reply"] = reply
+
+            yield stats
+
+        if not body.get("stream", True):
+            try:
+                *_, stats = _run(lambda _m: None)
+                reply = stats.pop("reply")
+                return jsonify(conversation_id=conversation_id, reply=reply, stats=_public_stats(stats))
+            except ModelUnavailableError as e:
+                return jsonify(error="model unavailable", detail=str(e), conversation_id=conversation_id), 503
+            finally:
+                conv["lock"].release()
+
+        def events():
+            pending = []  # event ที่เกิดใน callback (generator yield จาก callback ไม่ได้)
+            try:
+                yield _sse("meta", {"conversation_id": conversation_id})
+                for item in _run(lambda model: pending.append(_sse("restart", {"model": model}))):
+                    while pending:
+                        yield pending.pop(0)
+                    if isinstance(item, dict):
+                        reply = item.pop("reply")
+                        yield _sse("done", {"reply": reply, "stats": _public_stats(item)})
+                    else:
+                        yield _sse("delta", {"text": item})
+            except ModelUnavailableError as e:
+                yield _sse("error", {"error": "model unavailable", "detail": str(e)})
+            finally:
+                conv["lock"].release()
+
+        return Response(stream_with_context(events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    return app
+
+if __name__ == "__main__":
+    # threaded: แต่ละสตรีมส่วนใหญ่รอ I/O จากโมเดล → thread ต่อคำขอรองรับหลายบทสนทนาพร้อมกัน
+    create_app().run(host=os.environ.get("FTE_API_HOST", "0.0.0.0"),
+                     port=int(os.environ.get("FTE_API_PORT", "8000")),
+                     threaded=True)
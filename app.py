@@ -1,31 +1,19 @@
 # app.py
+# ระดับโมดูล import เฉพาะ streamlit + stdlib: engine (numpy/scipy/sklearn/pythainlp/Gemini) และดัชนี
+# โหลดใน thread เบื้องหลัง (startup.EngineLoader) → replica ใหม่แสดงหน้าแชทได้ทันที
 import os
 import time
 import random
 from pathlib import Path
-from typing import Iterable, List, Dict, Tuple
-import pandas as pd
 import streamlit as st
-import docx
-from PyPDF2 import PdfReader
 
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-
-from prompt import PROMPT_FTE  # ต้องมีไฟล์ prompt.py ที่ประกาศ PROMPT_FTE
-
-from sklearn.feature_extraction.text import TfidfVectorizer
-import numpy as np
+from startup import FAILED, STARTUP_WAIT_SECONDS, EngineLoader
 
 # =========================
-# PATHS & DISCOVERY
+# PATHS
 # =========================
 BASE_DIR = Path(__file__).resolve().parent
 
-DOC_EXTS     = {".docx"}
-TABULAR_EXTS = {".csv", ".xlsx", ".xls"}
-PDF_EXTS     = {".pdf"}
-
 AVATAR_PATH = BASE_DIR / "assets" / "green-bot.png"
 PAGE_ICON = str(AVATAR_PATH) if AVATAR_PATH.exists() else None
 
@@ -36,38 +24,38 @@ st.set_page_config(page_title="FTE Chatbot • KMUTNB", page_icon=PAGE_ICON, lay
 st.title("🗨️ Computer Education & Civil Engineering and Education Chatbot • FTE of KMUTNB")
 
 # =========================
-# API KEY & MODEL CONFIG
+# API KEY & ENGINE
 # =========================
 api_key = st.secrets.get("GEMINI_APIKEY")
+# แผงเวลาแต่ละขั้นใน sidebar สำหรับผู้ดูแล (FTE_ADMIN_PANEL=1)
+ADMIN_PANEL = os.environ.get("FTE_ADMIN_PANEL") == "1"
 if not api_key:
     st.error("ไม่พบ GEMINI_APIKEY ในไฟล์ .streamlit/secrets.toml โปรดตรวจสอบการตั้งค่า.")
     st.stop()
 
-genai.configure(api_key=api_key)
+def _engine_builder(api_key: str):
+    def build(stage):
+        stage("importing")
+        from engine import ChatEngine, GeminiBackend, open_index, warm_tokenizer
+        from tracing import Tracer
+        backend = GeminiBackend(api_key)  # import google.generativeai
+        stage("indexing")
+        holder = open_index(warm=False)
+        stage("tokenizer")  # pythainlp โหลดพจนานุกรมหลายวินาที → แยกเวลาไว้ให้เห็น
+        warm_tokenizer()
+        return ChatEngine(holder, backend, tracer=Tracer(channel="streamlit"))
+    return build
 
-generation_config = {
-    "temperature": 0.5,
-    "top_p": 0.95,
-    "top_k": 64,
-    "max_output_tokens": 1024,
-    "response_mime_type": "text/plain",
-}
-SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-}
-PRIMARY_MODEL_NAME = "gemini-2.5-flash"
-FALLBACK_MODEL_NAME = "gemini-2.0-flash"
+@st.cache_resource(show_spinner=False)
+def get_loader(api_key: str) -> EngineLoader:
+    # หนึ่ง engine ต่อโปรเซส: ดัชนี, cache คำตอบ และ client ของโมเดลใช้ร่วมกันทุก session
+    # สร้างเบื้องหลัง — rerun ไม่รอ; ENGINE เป็น None จนกว่าจะพร้อม
+    return EngineLoader(_engine_builder(api_key))
 
-def make_model(name: str) -> genai.GenerativeModel:
-    return genai.GenerativeModel(
-        model_name=name,
-        safety_settings=SAFETY_SETTINGS,
-        generation_config=generation_config,
-        system_instruction=PROMPT_FTE,
-    )
+LOADER = get_loader(api_key)
+ENGINE = LOADER.engine
+STAGE_LABELS = {"starting": "กำลังเริ่มระบบ", "importing": "กำลังโหลดโมดูล", "indexing": "กำลังเตรียมดัชนีเอกสาร",
+                "tokenizer": "กำลังโหลดตัวตัดคำ"}
 
 # =========================
 # CHAT HISTORY UTILS
@@ -84,165 +72,6 @@ def restore_history():
         st.warning("ไม่พบประวัติที่สามารถเรียกคืนได้")
     st.rerun()
 
-# =========================
-# FILE READERS (CACHED) PDF & Docx
-# =========================
-@st.cache_data(show_spinner=False)
-def extract_text_from_docx(docx_path: str) -> str:
-    try:
-        d = docx.Document(docx_path)
-        return "\n".join([p.text for p in d.paragraphs if p.text.strip()])
-    except Exception as e:
-        st.error(f"Error reading Word file '{docx_path}': {e}")
-        return ""
-
-@st.cache_data(show_spinner=False)
-def extract_text_from_pdf(pdf_path: str) -> str:
-    try:
-        reader = PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        return text
-    except Exception as e:
-        st.error(f"Error reading PDF file '{pdf_path}': {e}")
-        return ""
-
-@st.cache_data(show_spinner=False)
-def load_excel_as_text(excel_path: str, max_rows: int = 160, max_cols: int = 12) -> str:
-    try:
-        if not os.path.exists(excel_path):
-            return ""
-        df = pd.read_excel(excel_path)
-        if df.shape[1] > max_cols:
-            df = df.iloc[:, :max_cols]
-        if len(df) > max_rows:
-            df = df.head(max_rows)
-        return df.to_csv(index=False)
-    except Exception as e:
-        st.error(f"Error reading Excel file '{excel_path}': {e}")
-        return ""
-
-@st.cache_data(show_spinner=False)
-def load_csv_as_text(csv_path: str, max_rows: int = 200, max_cols: int = 12) -> str:
-    try:
-        if not os.path.exists(csv_path):
-            return ""
-        df = pd.read_csv(csv_path, engine="python", encoding_errors="ignore")
-        if df.shape[1] > max_cols:
-            df = df.iloc[:, :max_cols]
-        if len(df) > max_rows:
-            df = df.head(max_rows)
-        return df.to_csv(index=False)
-    except Exception as e:
-        st.error(f"Error reading CSV file '{csv_path}': {e}")
-        return "" 
-
-# =========================
-# DISCOVER FILES (RECURSIVE)
-# =========================
-def rglob_many(root: Path, exts: Iterable[str]) -> list[Path]:
-    exts_low = {e.lower() for e in exts}
-    # เพิ่มเงื่อนไข .name.startswith("~$") เพื่อละเว้นไฟล์ชั่วคราว
-    return [p for p in root.rglob("*") if p.is_file() and p.suffix.lower() in exts_low and not p.name.startswith("~$")]
-
-@st.cache_data(show_spinner=False)
-def discover_all_files(base_dir: str) -> dict:
-    root = Path(base_dir)
-    found_docx  = rglob_many(root, DOC_EXTS)
-    found_tab   = rglob_many(root, TABULAR_EXTS)
-    found_pdf   = rglob_many(root, PDF_EXTS)
-
-    dataset_file = root / "workaw" / "Data คำตอบ  ครุล่าสุด.docx"
-    if dataset_file.exists():
-        found_docx.append(dataset_file)
-    return {"docx": sorted(found_docx), "tabular": sorted(found_tab), "pdf": sorted(found_pdf)}
-
-FOUND = discover_all_files(str(BASE_DIR))
-
-# =========================
-# NEW: COLLECT & CHUNK TEXTS FOR RETRIEVAL
-# =========================
-def chunk_text(text: str, size: int = 900, overlap: int = 150) -> List[str]:
-    text = (text or "").strip()
-    if not text:
-        return []
-    chunks, i, n = [], 0, len(text)
-    while i < n:
-        j = min(i + size, n)
-        chunks.append(text[i:j])
-        i = j - overlap if j - overlap > i else j
-    return [c for c in chunks if c.strip()]
-
-@st.cache_data(show_spinner=False)
-def collect_chunks(docx_files: List[Path], tabular_files: List[Path], pdf_files: List[Path]) -> List[Dict]:
-    rows = []
-
-    # DOCX
-    for p in docx_files:
-        try:
-            txt = extract_text_from_docx(str(p))
-            if txt:  # เพิ่มเงื่อนไขเพื่อตรวจสอบว่ามีข้อความหรือไม่
-                for c in chunk_text(txt):
-                    rows.append({"source": p.name, "kind": "DOCX", "text": c})
-        except Exception:
-            pass
-
-    # TABULAR
-    for p in tabular_files:
-        try:
-            if p.suffix.lower() == ".csv":
-                txt = load_csv_as_text(str(p))
-            else:
-                txt = load_excel_as_text(str(p))
-            if txt:
-                for c in chunk_text(txt):
-                    rows.append({"source": p.name, "kind": "TABLE", "text": c})
-        except Exception:
-            pass
-
-    # PDF
-    for p in pdf_files:
-        try:
-            txt = extract_text_from_pdf(str(p))
-            if txt:
-                for c in chunk_text(txt):
-                    rows.append({"source": p.name, "kind": "PDF", "text": c})
-        except Exception:
-            pass
-
-    return rows
-
-CHUNKS = collect_chunks(FOUND["docx"], FOUND["tabular"], FOUND["pdf"])
-
-# =========================
-# NEW: BUILD TF-IDF INDEX (CHAR N-GRAM → ดีสำหรับภาษาไทย)
-# =========================
-@st.cache_resource(show_spinner=False)
-def build_index(chunks: List[Dict]):
-    texts = [r["text"] for r in chunks] or ["dummy"]
-    vect = TfidfVectorizer(analyzer="char", ngram_range=(3, 5))
-    X = vect.fit_transform(texts)
-    return vect, X
-
-VECT, X = build_index(CHUNKS)
-
-def retrieve_context(query: str, top_k: int = 8, max_chars: int = 6000) -> Tuple[str, List[Tuple[int, float]]]:
-    if not query.strip() or X.shape[0] == 0:
-        return "", []
-    qv = VECT.transform([query])
-    sims = (X @ qv.T).toarray().ravel()  # cosine sim for tfidf-normalized
-    idx = np.argsort(-sims)[:top_k]
-    picked = [(int(i), float(sims[i])) for i in idx if sims[i] > 0]
-    parts, total = [], 0
-    for i, _ in picked:
-        seg = CHUNKS[i]
-        block = f"[{seg['kind']}] {seg['source']}\n{seg['text']}\n"
-        if total + len(block) > max_chars:
-            break
-        parts.append(block); total += len(block)
-    return "\n".join(parts), picked
-
 # =========================
 # BUILD REFERENCE STATUS (สำหรับ Sidebar เท่านั้น)
 # =========================
@@ -251,12 +80,35 @@ LOAD_STATUS = {
     "tabular": {},
     "pdf": {},
 }
-for p in FOUND["docx"]:
-    LOAD_STATUS["docx"][p.name] = "โหลดสำเร็จ" if any(r["source"] == p.name for r in CHUNKS) else "ไฟล์ว่างหรืออ่านไม่ได้"
-for p in FOUND["tabular"]:
-    LOAD_STATUS["tabular"][p.name] = "โหลดสำเร็จ" if any(r["source"] == p.name for r in CHUNKS) else "ไฟล์ว่างหรืออ่านไม่ได้"
-for p in FOUND["pdf"]:
-    LOAD_STATUS["pdf"][p.name] = "โหลดสำเร็จ" if any(r["source"] == p.name for r in CHUNKS) else "ไฟล์ว่างหรืออ่านไม่ได้"
+if ENGINE is not None:
+    # ดึง state ครั้งเดียวต่อ rerun → ทั้ง rerun ใช้ดัชนีชุดเดียวกันแม้ refresher จะสลับระหว่างทาง
+    INDEX_STATE = ENGINE.holder.state
+    FOUND = INDEX_STATE.found
+    CHUNKS = INDEX_STATE.chunks
+    CHUNK_COUNTS = INDEX_STATE.chunk_counts()  # relpath → จำนวน chunk (จากช่วงแถวของแต่ละไฟล์ในดัชนี)
+    for rel, meta in INDEX_STATE.manifest.items():
+        if rel in INDEX_STATE.failed:  # ใช้เนื้อหาเดิมไปก่อน refresher จะอ่านใหม่
+            LOAD_STATUS[meta["kind"]][Path(rel).name] = "อ่านไม่สำเร็จ กำลังลองใหม่"
+        else:
+            LOAD_STATUS[meta["kind"]][Path(rel).name] = "โหลดสำเร็จ" if CHUNK_COUNTS[rel] else "ไฟล์ว่างหรืออ่านไม่ได้"
+
+# =========================
+# STARTUP STATUS (ระหว่างเตรียม engine เบื้องหลัง)
+# =========================
+@st.fragment(run_every=1.0)
+def startup_status():
+    if LOADER.ready:
+        st.rerun()  # rerun ทั้งหน้าเพื่อใช้ ENGINE ที่พร้อมแล้ว (sidebar/แผงผู้ดูแล)
+    if LOADER.stage == FAILED:
+        st.error("ระบบเตรียมข้อมูลไม่สำเร็จ กรุณาแจ้งผู้ดูแลระบบค่ะ")
+        if st.button("ลองใหม่"):
+            get_loader.clear()
+            st.rerun()
+        return
+    st.caption(f"⏳ {STAGE_LABELS.get(LOADER.stage, LOADER.stage)}... พิมพ์คำถามไว้ได้เลย ระบบจะตอบเมื่อพร้อมค่ะ")
+
+if ENGINE is None:
+    startup_status()
 
 # =========================
 # SESSION STATE (MESSAGES)
@@ -279,6 +131,33 @@ with st.sidebar:
     if col2.button("🔁 Restore"):
         restore_history()
 
+    last = st.session_state.get("last_stream_stats")
+    if last and last.get("ttft") is not None:
+        st.caption(
+            f"คำตอบล่าสุด ({'cache' if last.get('cached') else last.get('model')}): token แรก {last['ttft']:.2f} วิ · "
+            f"รวม {last['total']:.2f} วิ · render {last['renders']} ครั้ง ({last['render_time'] * 1000:.0f} ms)"
+        )
+
+    # แผงผู้ดูแล: เวลาเริ่มระบบ + percentile ของเวลาแต่ละขั้นจากเทิร์นล่าสุดของทุก session ในโปรเซสนี้
+    if ADMIN_PANEL:
+        with st.expander("⏱️ เวลาแต่ละขั้น (ผู้ดูแล)"):
+            # first_paint_s / ready_s นับจากเริ่มโปรเซส, <ขั้น>_s คือเวลาของขั้นนั้น
+            st.caption("เริ่มระบบ (วินาที): " + (" · ".join(f"{k} {v}" for k, v in LOADER.timings.items())
+                                               or LOADER.stage))
+            pct = ENGINE.tracer.percentiles() if ENGINE is not None else {}
+            if pct:
+                st.dataframe(
+                    [{"ขั้น": name, **row} for name, row in sorted(pct.items(), key=lambda kv: -kv[1]["p95"])],
+                    hide_index=True,
+                )
+                st.caption(f"หน่วย ms · {len(ENGINE.tracer.recent())} เทิร์นล่าสุด")
+            else:
+                st.caption("ยังไม่มีข้อมูล")
+            health = ENGINE.breaker.snapshot() if ENGINE is not None else {}
+            if health:
+                st.dataframe([{"โมเดล": name, **row} for name, row in health.items()], hide_index=True)
+            if ENGINE is not None and ENGINE.backend.prefix_cache is not None:
+                st.caption("prefix cache: " + " · ".join(f"{k} {v}" for k, v in ENGINE.backend.prefix_cache.snapshot().items()))
 
     st.markdown("---")
     #st.header("ไฟล์ที่พบในโปรเจ็กต์")
@@ -307,89 +186,82 @@ for msg in st.session_state["messages"]:
         st.chat_message(msg["role"]).write(msg["content"])
 
 # =========================
-# BUILD HISTORY FOR GEMINI (ใช้บริบทที่ดึงมา เฉพาะที่เกี่ยว)
-# =========================
-def build_history_for_gemini(messages, context_text: str):
-    history = []
-    if context_text:
-        history.append({"role": "user", "parts": [{"text": "บริบทอ้างอิง (ซ่อนจากผู้ใช้):\n" + context_text}]})
-    for m in messages:
-        role = "user" if m["role"] == "user" else "model"
-        history.append({"role": role, "parts": [{"text": m["content"]}]})
-    return history
-
-# =========================
-# STREAMING + RETRY + FALLBACK
+# STREAMING (UI)
 # =========================
-def _should_retry(e: Exception) -> bool:
-    msg = str(e).lower()
-    return any(k in msg for k in ["429", "quota", "rate", "exceed", "resource exhausted", "deadline exceeded"])
+def wait_for_engine(placeholder):
+    """คำถามที่มาก่อน engine พร้อม: รอในคิว (แสดงขั้นที่กำลังทำ) ได้นานสุด STARTUP_WAIT_SECONDS"""
+    deadline = time.monotonic() + STARTUP_WAIT_SECONDS
+    while not LOADER.ready and LOADER.stage != FAILED and time.monotonic() < deadline:
+        placeholder.markdown(f"⏳ {STAGE_LABELS.get(LOADER.stage, LOADER.stage)} คำถามของคุณจะได้รับคำตอบเมื่อระบบพร้อมค่ะ...")
+        LOADER.wait(0.25)
+    placeholder.empty()
+    return LOADER.engine
+
+def stream_typing_with_retry(engine, history_messages, prompt_text: str, stats=None) -> str:
+    """สตรีมคำตอบจาก engine ลง UI แบบ batched; ถ้าส่ง dict มาใน stats จะได้เวลา TTFT/render กลับไป"""
+    from engine import ModelUnavailableError, StreamRenderer  # โหลดไว้แล้วโดย LOADER
 
-def stream_typing_with_retry(history_payload, prompt_text: str,
-                             typing_delay: float = 0.004,
-                             retries: int = 2,
-                             backoff: float = 2.0) -> str:
     status = st.empty()
     placeholder = st.empty()
     status.write("กำลังค้นหาคำตอบ...")
+    stats = stats if stats is not None else {}
+    renderer = StreamRenderer(placeholder.markdown)
+    trace = engine.tracer.start(channel="streamlit")
 
-    def _stream_from_model(model_name: str) -> str:
-        nonlocal status, placeholder
-        session = make_model(model_name).start_chat(history=history_payload)
-        full_text, first_char_written = "", False
-        for chunk in session.send_message(prompt_text, stream=True):
-            text = getattr(chunk, "text", "") or ""
-            for ch in text:
-                if not first_char_written:
-                    status.empty()
-                    first_char_written = True
-                full_text += ch
-                placeholder.markdown(full_text)
-                time.sleep(typing_delay)
-        return full_text
-
-    last_err = None
-    for attempt in range(retries):
-        try:
-            return _stream_from_model(PRIMARY_MODEL_NAME)
-        except Exception as e:
-            last_err = e
-            if _should_retry(e) and attempt < retries - 1:
-                time.sleep(backoff); backoff *= 2
-            else:
-                break
+    def _on_restart(model_name: str) -> None:
+        nonlocal renderer
+        renderer = StreamRenderer(placeholder.markdown, started=renderer.started)
+        if model_name != stats.get("model"):
+            placeholder.markdown("**สลับไปใช้โมเดลสำรองชั่วคราวเพื่อให้ได้คำตอบค่ะ...**")
 
     try:
-        placeholder.markdown("**สลับไปใช้โมเดลสำรองชั่วคราวเพื่อให้ได้คำตอบค่ะ...**")
-        return _stream_from_model(FALLBACK_MODEL_NAME)
-    except Exception:
+        for piece in engine.stream_reply(history_messages, prompt_text,
+                                         session=st.session_state.setdefault("engine_session", {}),
+                                         stats=stats, on_restart=_on_restart, trace=trace):
+            if renderer.first_token_at is None:
+                status.empty()
+            renderer.feed(piece)
+        reply = renderer.close()
+    except ModelUnavailableError:
         status.empty()
         placeholder.markdown("ขออภัยค่ะ ระบบไม่สามารถสร้างคำตอบได้ในขณะนี้ กรุณาลองใหม่ภายหลังค่ะ")
-        return ""
+        reply = ""
+    finally:
+        rs = renderer.stats()
+        trace.add_span("render", rs["render_time"] * 1000, renders=rs["renders"])
+        trace.set(ttft_ms=None if rs["ttft"] is None else round(rs["ttft"] * 1000, 3))
+        engine.tracer.finish(trace)
+    if reply:
+        stats.update(rs)
+    return reply
 
 # =========================
 # CHAT INPUT & RESPONSE
 # =========================
 prompt = st.chat_input("พิมพ์คำถามของคุณที่นี่...")
+LOADER.mark("first_paint_s")  # หน้าแชทแรกของโปรเซสวาดครบ (ไม่ว่า engine จะพร้อมหรือยัง)
 if prompt:
     # เก็บข้อความผู้ใช้
     st.session_state["messages"].append({"role": "user", "content": prompt})
     st.chat_message("user").write(prompt)
 
-    # 1) ดึงบริบทที่เกี่ยวข้องจากดัชนี
-    context_text, hits = retrieve_context(prompt, top_k=8, max_chars=6000)
-
-    # 2) สร้าง history ที่รวม 'บริบทอ้างอิง' (จะไม่ถูกแสดงใน UI)
-    history_payload = build_history_for_gemini(st.session_state["messages"][:-1], context_text)
-
-    # 3) ส่งถามโมเดล (มี retry + fallback)
+    # engine: cache คำตอบ → ดึงบริบท → สร้าง history ภายในงบ token → โมเดล (circuit breaker + hedged fallback)
+    stream_stats = {}
     with st.chat_message("assistant", avatar=assistant_avatar):
-        reply = stream_typing_with_retry(history_payload, prompt_text=prompt, typing_delay=0.004)
-
-    # ปิดท้ายทุกคำตอบด้วยประโยคสุภาพแบบสุ่ม (ไม่มีอีโมจิ)
-    followups = [
-        "\n\nต้องการข้อมูลส่วนไหนเพิ่มเติมอีกไหมคะ"
-    ]
-    reply_with_followup = (reply or "") + random.choice(followups)
-    
-    st.session_state["messages"].append({"role": "assistant", "content": (reply or "") + random.choice(followups)})
+        engine = ENGINE or wait_for_engine(st.empty())
+        if engine is None:
+            # degraded: ยังไม่พร้อม/เริ่มไม่สำเร็จ → ตอบสุภาพแทนการค้างหรือ error
+            reply_with_followup = ("ขออภัยค่ะ ระบบเตรียมข้อมูลไม่สำเร็จ กรุณาแจ้งผู้ดูแลระบบค่ะ"
+                                   if LOADER.stage == FAILED else
+                                   "ขออภัยค่ะ ระบบยังเตรียมข้อมูลเอกสารไม่เสร็จ กรุณาส่งคำถามอีกครั้งในอีกสักครู่ค่ะ")
+            st.write(reply_with_followup)
+        else:
+            from engine import FOLLOWUPS
+
+            reply = stream_typing_with_retry(engine, st.session_state["messages"][:-1], prompt_text=prompt,
+                                             stats=stream_stats)
+            # ปิดท้ายทุกคำตอบด้วยประโยคสุภาพแบบสุ่ม (ไม่มีอีโมจิ) — build_history_for_gemini ตัดออกก่อนส่งโมเดล
+            reply_with_followup = (reply or "") + random.choice(FOLLOWUPS)
+    st.session_state["last_stream_stats"] = stream_stats
+
+    st.session_state["messages"].append({"role": "assistant", "content": reply_with_followup})
@@ -0,0 +1,235 @@
+# benchmarks/bench.py
+# benchmark การนำเข้าเอกสาร, สร้างดัชนี, ค้นหา และหนึ่งเทิร์นแชทแบบ end-to-end บนคลังเอกสารสังเคราะห์
+# ทำงาน offline ทั้งหมด (โมเดลใช้ StubBackend) — ผลเป็น JSONL หนึ่งบรรทัดต่อขนาดคลัง เทียบข้าม commit ได้
+#
+# รัน:   python benchmarks/bench.py                                  (ขนาด 10,100,1000,10000 chunk)
+#        python benchmarks/bench.py --sizes 10,100 --out bench.jsonl
+#        python benchmarks/bench.py --sizes 1000 --compare bench.jsonl   (แสดง % เปลี่ยนเทียบผลเดิม)
+#        FTE_INDEX_BACKEND=hashed python benchmarks/bench.py --sizes 1000 --compare bench.jsonl
+#        python benchmarks/bench.py --sizes 100 --prefill-ms 300      (เทียบกับ FTE_PREFIX_CACHE=0)
+#        python benchmarks/bench.py --sizes 100 --primary-error-rate 0.5 --primary-first-token-ms 4000
+#                                     (จำลอง outage ของโมเดลหลัก: 429 บางส่วน + token แรกช้า → วัด breaker/hedge)
+#
+# แต่ละขนาดรันใน subprocess แยก เพื่อให้ peak RSS และ cache ภายในโปรเซสไม่ปนกันระหว่างขนาด
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from ingest import INGEST_WORKERS, chunk_text, collect_chunks, discover_all_files  # noqa: E402
+from engine import (INDEX_BACKEND, PRIMARY_MODEL_NAME, AnswerCache, ChatEngine, IndexHolder,  # noqa: E402
+                    StreamRenderer, StubBackend, build_index, index_params, retrieve_context, update_index)
+from tracing import Tracer  # noqa: E402
+from prefixcache import PREFIX_CACHE_ENABLED, LocalPrefixStore, PrefixCache  # noqa: E402
+from synth import build_corpus, synth_text  # noqa: E402
+
+DEFAULT_SIZES = "10,100,1000,10000"
+GREETING = [{"role": "assistant", "content": "คุณต้องการสอบถามข้อมูลเรื่องใดคะ"}]
+# ตัวชี้วัดที่ --compare แสดง (ค่ามาก = แย่ ยกเว้นที่อยู่ใน HIGHER_IS_BETTER)
+COMPARE_KEYS = ["ingest_s", "fit_s", "build_s", "index_mb", "vectorizer_mb", "chunks_mb", "snapshot_mb", "peak_rss_mb",
+                "retrieve_p50_ms", "retrieve_p95_ms", "retrieve_p99_ms", "retrieve_qps",
+                "chunk_text_mb_s", "e2e_ttft_p50_ms", "e2e_ttft_p95_ms", "e2e_ttft_p99_ms", "e2e_render_ms"]
+HIGHER_IS_BETTER = {"retrieve_qps", "chunk_text_mb_s"}
+
+def _ms(values: List[float], q: float) -> float:
+    return round(float(np.percentile(values, q)) * 1000, 3) if values else 0.0
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+def _sparse_bytes(X) -> int:
+    return int(X.data.nbytes + X.indices.nbytes + X.indptr.nbytes)
+
+def bench_size(n_chunks: int, args) -> Dict:
+    rec: Dict = {"size": n_chunks}
+    with tempfile.TemporaryDirectory(prefix="fte-bench-") as tmp:
+        root = Path(tmp)
+        corpus = build_corpus(root, n_chunks, seed=args.seed)
+        queries = corpus["queries"][:args.queries]
+        rec["files"] = corpus["files"]
+
+        # chunk_text อย่างเดียว (ไม่รวม I/O ของไฟล์)
+        text = "\n".join(synth_text(random.Random(args.seed), 2_000_000))
+        t0 = time.perf_counter()
+        chunk_text(text)
+        rec["chunk_text_mb_s"] = round(len(text.encode("utf-8")) / 1e6 / (time.perf_counter() - t0), 2)
+        del text
+
+        found = discover_all_files(str(root))
+        files = [(p, kind) for kind, paths in found.items() for p in paths]
+        t0 = time.perf_counter()
+        chunks = [r for rows in collect_chunks(files, workers=args.workers) for r in rows or ()]
+        rec["ingest_s"] = round(time.perf_counter() - t0, 4)
+        rec["chunks"] = len(chunks)
+
+        t0 = time.perf_counter()
+        vect, X = build_index(chunks)
+        rec["fit_s"] = round(time.perf_counter() - t0, 4)
+        rec["vocab"] = len(getattr(vect, "vocabulary_", ()))  # hashed: ไม่มี vocab
+        rec["vectorizer_mb"] = round(len(pickle.dumps(vect, protocol=pickle.HIGHEST_PROTOCOL)) / 1e6, 3)
+        del vect, X, chunks
+
+        # ดัชนีเต็มแบบที่แอปใช้: manifest + extract + TF-IDF + BM25 + ตาราง
+        t0 = time.perf_counter()
+        state = update_index(None, found, root)
+        rec["build_s"] = round(time.perf_counter() - t0, 4)
+        rec["index_mb"] = round((_sparse_bytes(state.X) + (state.Z.nbytes if state.Z is not None else 0)) / 1e6, 3)
+        rec["chunks_mb"] = round(state.chunks.nbytes / 1e6, 3)
+        rec["dedup_dropped"] = sum(len(drops) for drops in state.file_drops.values())
+        snap = {"params": index_params(), "state": dict(state.__dict__)}
+        rec["snapshot_mb"] = round(len(pickle.dumps(snap, protocol=pickle.HIGHEST_PROTOCOL)) / 1e6, 3)
+        del snap
+
+        # ค้นหา: อุ่นเครื่อง (โหลดตัวตัดคำ) แล้วจับเวลาทีละคำถาม
+        for q in queries[:5]:
+            retrieve_context(state, q)
+        lat = []
+        t_all = time.perf_counter()
+        for q in queries:
+            t0 = time.perf_counter()
+            retrieve_context(state, q)
+            lat.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - t_all
+        rec["retrieve_p50_ms"], rec["retrieve_p95_ms"], rec["retrieve_p99_ms"] = (
+            _ms(lat, 50), _ms(lat, 95), _ms(lat, 99))
+        rec["retrieve_qps"] = round(len(lat) / elapsed, 1) if elapsed else 0.0
+
+        # end-to-end: ChatEngine.stream_reply + StreamRenderer (ตรรกะเดียวกับ stream_typing_with_retry ใน app.py)
+        # ปิด cache คำตอบ (ขนาด 0) เพื่อให้ทุกเทิร์นผ่านการค้นหา + history + โมเดลจริง
+        primary = {"error_rate": args.primary_error_rate}
+        if args.primary_first_token_ms is not None:
+            primary["first_token_delay"] = args.primary_first_token_ms / 1000
+        backend = StubBackend(reply_chars=args.reply_chars, first_token_delay=args.first_token_ms / 1000,
+                              piece_delay=args.piece_ms / 1000, faults={PRIMARY_MODEL_NAME: primary},
+                              seed=args.seed, prefill_delay=args.prefill_ms / 1000,
+                              prefix_cache=PrefixCache(LocalPrefixStore()) if PREFIX_CACHE_ENABLED else None)
+        engine = ChatEngine(IndexHolder(state, root), backend, AnswerCache(0, 0, 1.1), Tracer(path=None))
+        ttft, total, render, renders, fallback = [], [], [], [], 0
+        for q in queries[:args.turns]:
+            started = time.perf_counter()
+            renderer = StreamRenderer(lambda _text: None, started=started)
+            stats: Dict = {}
+            for piece in engine.stream_reply(list(GREETING), q, session={}, stats=stats):
+                renderer.feed(piece)
+            renderer.close()
+            s = renderer.stats()
+            ttft.append(s["ttft"] or 0.0)
+            total.append(s["total"])
+            render.append(s["render_time"])
+            renders.append(s["renders"])
+            fallback += stats.get("model") != PRIMARY_MODEL_NAME
+        rec["e2e_ttft_p50_ms"], rec["e2e_ttft_p95_ms"], rec["e2e_ttft_p99_ms"] = (
+            _ms(ttft, 50), _ms(ttft, 95), _ms(ttft, 99))
+        rec["e2e_total_p50_ms"] = _ms(total, 50)
+        rec["e2e_render_ms"] = round(float(np.mean(render)) * 1000, 3) if render else 0.0
+        rec["e2e_renders"] = round(float(np.mean(renders)), 1) if renders else 0.0
+        rec["e2e_fallback_share"] = round(fallback / len(ttft), 3) if ttft else 0.0
+
+    rec["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return rec
+
+def load_records(path: str) -> Dict[int, Dict]:
+    out = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                rec = json.loads(line)
+                out[rec["size"]] = rec  # ขนาดซ้ำ → ใช้ผลล่าสุดในไฟล์
+    return out
+
+def print_compare(old: Dict[int, Dict], new: List[Dict]) -> None:
+    for rec in new:
+        base = old.get(rec["size"])
+        if base is None:
+            print(f"# size={rec['size']}: ไม่มีผลเดิมให้เทียบ", file=sys.stderr)
+            continue
+        print(f"# size={rec['size']}  {base.get('commit')} → {rec.get('commit')}", file=sys.stderr)
+        for key in COMPARE_KEYS:
+            a, b = base.get(key), rec.get(key)
+            if not a or b is None:
+                continue
+            change = (b - a) / a * 100
+            worse = change < 0 if key in HIGHER_IS_BETTER else change > 0
+            flag = " !" if worse and abs(change) >= 10 else ""
+            print(f"#   {key:<18} {a:>12} → {b:>12}  {change:+7.1f}%{flag}", file=sys.stderr)
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="FTE chatbot benchmark (offline, synthetic Thai corpus)")
+    ap.add_argument("--sizes", default=DEFAULT_SIZES, help="จำนวน chunk โดยประมาณ คั่นด้วย comma")
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--turns", type=int, default=30, help="จำนวนเทิร์น end-to-end")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    ap.add_argument("--reply-chars", type=int, default=600)
+    ap.add_argument("--first-token-ms", type=float, default=0.0, help="หน่วงก่อน token แรกของโมเดลจำลอง")
+    ap.add_argument("--piece-ms", type=float, default=0.0, help="หน่วงระหว่างชิ้นของโมเดลจำลอง")
+    ap.add_argument("--prefill-ms", type=float, default=0.0,
+                    help="เวลาประมวลผล system prompt ของโมเดลจำลองเมื่อไม่ได้ใช้ prefix cache (FTE_PREFIX_CACHE=0 ปิด)")
+    ap.add_argument("--primary-error-rate", type=float, default=0.0, help="สัดส่วนคำขอที่โมเดลหลักตอบ 429")
+    ap.add_argument("--primary-first-token-ms", type=float, help="หน่วงก่อน token แรกเฉพาะโมเดลหลัก")
+    ap.add_argument("--out", help="ต่อท้ายผล (JSONL) ลงไฟล์นี้")
+    ap.add_argument("--compare", help="ไฟล์ JSONL ผลเดิมที่จะเทียบ")
+    ap.add_argument("--inline", action="store_true", help="รันทุกขนาดในโปรเซสนี้ (ไม่แยก subprocess)")
+    args = ap.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    meta = {"commit": _git_commit(), "backend": INDEX_BACKEND, "python": platform.python_version(),
+            "machine": platform.machine(), "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+    records = []
+    for size in sizes:
+        if args.inline or len(sizes) == 1:
+            rec = bench_size(size, args)
+        else:
+            child = _without(sys.argv[1:] if argv is None else argv, "--sizes", "--out", "--compare")
+            cmd = [sys.executable, __file__, *child,
+                   "--sizes", str(size), "--inline"]
+            out = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            rec = json.loads(out.stdout.strip().splitlines()[-1])
+        rec = {**meta, **{k: v for k, v in rec.items() if k not in meta}}
+        records.append(rec)
+        print(json.dumps(rec, ensure_ascii=False), flush=True)
+        if args.out:
+            with open(args.out, "a", encoding="utf-8") as f:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    if args.compare:
+        print_compare(load_records(args.compare), records)
+    return 0
+
+def _without(argv: List[str], *flags: str) -> List[str]:
+    out, skip = [], False
+    for a in argv:
+        if skip:
+            skip = False
+            continue
+        if a in flags:
+            skip = True
+            continue
+        if any(a.startswith(f + "=") for f in flags):
+            continue
+        out.append(a)
+    return out
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+# benchmarks/synth.py
+# สร้างคลังเอกสารภาษาไทยสังเคราะห์ (DOCX / PDF / CSV) แบบ deterministic จาก seed สำหรับ benchmark
+# ไม่ต้องต่อเครือข่ายและไม่ต้องมีฟอนต์ไทยในเครื่อง: PDF เขียนเองแบบ minimal (Type0 + ToUnicode)
+# ซึ่งพอให้ PyPDF2 ดึงข้อความกลับมาได้เหมือนไฟล์จริง
+import csv
+import random
+from pathlib import Path
+from typing import Dict, List
+
+import docx
+
+from ingest import CHUNK_SIZE, CHUNK_OVERLAP
+
+DEPARTMENTS = [
+    "วิศวกรรมคอมพิวเตอร์", "เทคโนโลยีการศึกษา", "ครุศาสตร์อุตสาหการ", "วิศวกรรมไฟฟ้า",
+    "การออกแบบสื่อดิจิทัล", "เทคโนโลยีอุตสาหกรรม", "วิศวกรรมเครื่องกล", "คอมพิวเตอร์ศึกษา",
+]
+TOPICS = [
+    "ค่าเทอม", "ทุนการศึกษา", "การรับสมัคร", "การฝึกงาน", "สหกิจศึกษา", "หอพัก",
+    "การลงทะเบียน", "การสอบปลายภาค", "การเทียบโอนหน่วยกิต", "การขอจบการศึกษา",
+]
+MONTHS = ["มกราคม", "กุมภาพันธ์", "มีนาคม", "เมษายน", "พฤษภาคม", "มิถุนายน",
+          "กรกฎาคม", "สิงหาคม", "กันยายน", "ตุลาคม", "พฤศจิกายน", "ธันวาคม"]
+FILLERS = [
+    "ทั้งนี้ให้เป็นไปตามประกาศของคณะ", "นักศึกษาควรตรวจสอบรายละเอียดล่าสุดกับเจ้าหน้าที่",
+    "สามารถดาวน์โหลดแบบฟอร์มได้จากเว็บไซต์ของภาควิชา", "หากมีข้อสงสัยโปรดติดต่อสำนักงานคณบดี",
+    "กำหนดการอาจเปลี่ยนแปลงตามปฏิทินการศึกษา", "เอกสารประกอบต้องลงนามรับรองสำเนาถูกต้อง",
+]
+TABLE_HEADER = ["รหัสวิชา", "ชื่อวิชา", "หน่วยกิต", "สาขา", "อาจารย์ผู้สอน"]
+TEACHERS = ["อ.สมชาย", "อ.สุดารัตน์", "ผศ.วิชัย", "รศ.กาญจนา", "อ.ปิยะพงษ์", "ผศ.ดวงใจ"]
+
+# สัดส่วน chunk ต่อชนิดไฟล์ และขนาดไฟล์สูงสุด (จำนวน chunk โดยประมาณ) ต่อไฟล์
+KIND_SHARE = {"docx": 0.5, "pdf": 0.25, "csv": 0.25}
+CHUNKS_PER_FILE = 40
+ROWS_PER_CHUNK = 10  # แถวตารางสั้น ~80 ตัวอักษร → ~10 แถวต่อ chunk ขนาด CHUNK_SIZE
+PDF_LINE_CHARS = 70
+PDF_LINES_PER_PAGE = 40
+
+def _sentence(rng: random.Random) -> str:
+    dept, topic = rng.choice(DEPARTMENTS), rng.choice(TOPICS)
+    pick = rng.randrange(4)
+    if pick == 0:
+        return f"{topic}ของสาขา{dept} ภาคเรียนที่ {rng.randint(1, 3)} อัตรา {rng.randrange(8, 40) * 500:,} บาท"
+    if pick == 1:
+        return (f"นักศึกษาสาขา{dept} ต้องยื่นเอกสาร{topic}ภายในวันที่ {rng.randint(1, 28)} "
+                f"{rng.choice(MONTHS)} {rng.randint(2566, 2569)}")
+    if pick == 2:
+        return (f"ติดต่อสอบถามเรื่อง{topic}ได้ที่อาคาร {rng.randint(1, 9)} ชั้น {rng.randint(1, 6)} "
+                f"ห้อง {rng.randint(100, 699)} โทร 02-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}")
+    return rng.choice(FILLERS)
+
+def synth_text(rng: random.Random, n_chars: int) -> List[str]:
+    """ย่อหน้าภาษาไทยรวมยาวประมาณ n_chars ตัวอักษร"""
+    paragraphs, total = [], 0
+    while total < n_chars:
+        para = " ".join(_sentence(rng) for _ in range(rng.randint(3, 8)))
+        paragraphs.append(para)
+        total += len(para) + 1
+    return paragraphs
+
+def course_code(i: int) -> str:
+    return f"FTE{10000 + i}"
+
+def synth_rows(rng: random.Random, start: int, n_rows: int) -> List[List[str]]:
+    return [[course_code(i), f"{rng.choice(TOPICS)}เบื้องต้น {i % 7 + 1}", str(rng.randint(1, 4)),
+             rng.choice(DEPARTMENTS), rng.choice(TEACHERS)]
+            for i in range(start, start + n_rows)]
+
+# =========================
+# WRITERS
+# =========================
+def write_docx(path: Path, paragraphs: List[str]) -> None:
+    d = docx.Document()
+    for para in paragraphs:
+        d.add_paragraph(para)
+    d.save(str(path))
+
+def write_csv(path: Path, rows: List[List[str]]) -> None:
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(TABLE_HEADER)
+        w.writerows(rows)
+
+_TO_UNICODE = b"""/CIDInit /ProcSet findresource begin
+12 dict begin
+begincmap
+/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def
+/CMapName /Adobe-Identity-UCS def
+/CMapType 2 def
+1 begincodespacerange
+<0000> <FFFF>
+endcodespacerange
+2 beginbfrange
+<0020> <007E> <0020>
+<0E00> <0E7F> <0E00>
+endbfrange
+endcmap
+CMapName currentdict /CMap defineresource pop
+end
+end"""
+
+def _wrap(paragraphs: List[str], width: int) -> List[str]:
+    lines = []
+    for para in paragraphs:
+        line = ""
+        for word in para.split(" "):
+            if line and len(line) + 1 + len(word) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        if line:
+            lines.append(line)
+    return lines
+
+def _pdf_hex(text: str) -> str:
+    # Identity-H: code 2 ไบต์ = code point (ตัดอักขระนอกช่วง ASCII/ไทยออก)
+    return "".join(f"{ord(ch):04X}" for ch in text if ch == " " or 0x20 < ord(ch) < 0x7F or 0x0E00 <= ord(ch) <= 0x0E7F)
+
+def write_pdf(path: Path, paragraphs: List[str]) -> None:
+    """PDF แบบ minimal: ฟอนต์ Type0 ไม่ฝังไฟล์ฟอนต์ + CMap ToUnicode → ดึงข้อความได้ แต่ไม่ได้ตั้งใจให้เปิดดูสวย"""
+    lines = _wrap(paragraphs, PDF_LINE_CHARS)
+    pages = [lines[i:i + PDF_LINES_PER_PAGE] for i in range(0, len(lines), PDF_LINES_PER_PAGE)] or [[]]
+    objects: List[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",  # Pages — เติมเมื่อรู้เลข object ของแต่ละหน้า
+        b"<< /Type /Font /Subtype /Type0 /BaseFont /Sarabun /Encoding /Identity-H "
+        b"/DescendantFonts [4 0 R] /ToUnicode 5 0 R >>",
+        b"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /Sarabun "
+        b"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+        b"/FontDescriptor 6 0 R /CIDToGIDMap /Identity /DW 500 >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(_TO_UNICODE), _TO_UNICODE),
+        b"<< /Type /FontDescriptor /FontName /Sarabun /Flags 32 /FontBBox [0 -250 1000 900] "
+        b"/ItalicAngle 0 /Ascent 900 /Descent -250 /CapHeight 700 /StemV 80 >>",
+    ]
+    kids = []
+    for page_lines in pages:
+        body = "BT /F1 11 Tf 14 TL 40 800 Td\n" + "".join(f"<{_pdf_hex(ln)}> Tj T*\n" for ln in page_lines) + "ET"
+        content = body.encode("ascii")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects)))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for num, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (num, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % off for off in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    path.write_bytes(bytes(out))
+
+# =========================
+# CORPUS
+# =========================
+def build_corpus(root: Path, n_chunks: int, seed: int = 0) -> Dict:
+    """เขียนคลังเอกสารที่ให้ chunk ประมาณ n_chunks ลงใน root → {"files": {...}, "queries": [...]}"""
+    rng = random.Random(seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    step_chars = CHUNK_SIZE - CHUNK_OVERLAP
+    counts = {"docx": 0, "pdf": 0, "csv": 0}
+    course_rows = 0
+    for kind, share in KIND_SHARE.items():
+        remaining = max(1, round(n_chunks * share))
+        while remaining > 0:
+            size = min(CHUNKS_PER_FILE, remaining)
+            name = root / f"{kind}_{counts[kind]:04d}.{kind}"
+            if kind == "csv":
+                rows = synth_rows(rng, course_rows, size * ROWS_PER_CHUNK)
+                course_rows += len(rows)
+                write_csv(name, rows)
+            elif kind == "docx":
+                write_docx(name, synth_text(rng, size * step_chars))
+            else:
+                write_pdf(name, synth_text(rng, size * step_chars))
+            counts[kind] += 1
+            remaining -= size
+
+    # คำถามแบบที่นักศึกษาถามจริง: ข้อเท็จจริงในเอกสาร + ค้นรหัสวิชาในตาราง
+    queries = []
+    for i in range(200):
+        dept, topic = rng.choice(DEPARTMENTS), rng.choice(TOPICS)
+        pick = i % 4
+        if pick == 0:
+            queries.append(f"{topic}สาขา{dept} เท่าไหร่ครับ")
+        elif pick == 1:
+            queries.append(f"ยื่นเอกสาร{topic}ได้ถึงวันไหนคะ")
+        elif pick == 2:
+            queries.append(f"ติดต่อเรื่อง{topic}ที่ไหน")
+        else:
+            queries.append(f"วิชา {course_code(rng.randrange(max(course_rows, 1)))} กี่หน่วยกิต")
+    return {"files": counts, "queries": queries}
@@ -0,0 +1,88 @@
+# bm25.py
+# ดัชนีคำ (inverted index + BM25) สำหรับการค้นหาแบบ hybrid คู่กับ TF-IDF char n-gram ใน engine.py
+# ตัดคำภาษาไทยด้วย pythainlp (newmm) ถ้าไม่มี pythainlp จะตัดตามช่องว่าง/ตัวอักษรแทน
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+WORD_ENGINE = "newmm"
+BM25_K1 = 1.5
+BM25_B  = 0.75
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_tokenizer = None
+_stopwords: Optional[frozenset] = None
+
+def _load_tokenizer():
+    # import ช้า (~หลายวินาที) → โหลดเมื่อใช้ครั้งแรกเท่านั้น
+    global _tokenizer, _stopwords
+    try:
+        from pythainlp.tokenize import word_tokenize
+        from pythainlp.corpus import thai_stopwords
+        _tokenizer = lambda text: word_tokenize(text, engine=WORD_ENGINE, keep_whitespace=False)
+        _stopwords = frozenset(thai_stopwords())
+    except ImportError:
+        _tokenizer = _TOKEN_RE.findall
+        _stopwords = frozenset()
+    return _tokenizer
+
+def tokenize_words(text: str) -> List[str]:
+    """ตัดคำ → ตัวพิมพ์เล็ก, ตัดเครื่องหมาย/ช่องว่าง และคำหยุด (stopword) ออก"""
+    tokenize = _tokenizer or _load_tokenizer()
+    out = []
+    for tok in tokenize(text or ""):
+        tok = tok.strip().casefold()
+        if tok and _TOKEN_RE.search(tok) and tok not in _stopwords:
+            out.append(tok)
+    return out
+
+def count_terms(text: str) -> Dict[str, int]:
+    return dict(Counter(tokenize_words(text)))
+
+class BM25Index:
+    """inverted index: คำ → (เลข chunk, ความถี่) เป็น numpy array
+
+    search คำนวณคะแนนเฉพาะ chunk ที่มีคำร่วมกับคำถาม ต้นทุนจึงขึ้นกับความยาว postings
+    ของคำในคำถาม ไม่ใช่จำนวน chunk ทั้งหมด
+    """
+
+    def __init__(self, doc_terms: Iterable[Dict[str, int]], k1: float = BM25_K1, b: float = BM25_B):
+        ids: Dict[str, List[int]] = {}
+        tfs: Dict[str, List[int]] = {}
+        lengths = []
+        for doc_id, terms in enumerate(doc_terms):
+            lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                ids.setdefault(term, []).append(doc_id)
+                tfs.setdefault(term, []).append(tf)
+        self.k1, self.b = k1, b
+        self.n_docs = len(lengths)
+        self.doc_len = np.asarray(lengths, dtype=np.float32)
+        self.avgdl = float(self.doc_len.mean()) if self.n_docs else 0.0
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {
+            term: (np.asarray(ids[term], dtype=np.int32), np.asarray(tfs[term], dtype=np.float32))
+            for term in ids
+        }
+
+    def idf(self, term: str) -> float:
+        df = len(self.postings[term][0])
+        return float(np.log(1.0 + (self.n_docs - df + 0.5) / (df + 0.5)))
+
+    def search(self, query_terms: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """คืน (เลข chunk ที่เป็น candidate, คะแนน BM25) ไม่เรียงลำดับ"""
+        all_ids, all_scores = [], []
+        for term in set(query_terms):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids, tf = posting
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[ids] / (self.avgdl or 1.0))
+            all_ids.append(ids)
+            all_scores.append(self.idf(term) * tf * (self.k1 + 1.0) / (tf + norm))
+        if not all_ids:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        cand, inv = np.unique(np.concatenate(all_ids), return_inverse=True)
+        scores = np.bincount(inv, weights=np.concatenate(all_scores)).astype(np.float32)
+        return cand, scores
@@ -0,0 +1,117 @@
+# breaker.py
+# circuit breaker ต่อโมเดล ใช้ร่วมกันทุกคำขอในโปรเซส: จำผลการเรียกล่าสุด (สำเร็จ/ล้มเหลว + TTFT)
+# - closed: เรียกได้ตามปกติ; error rate ในหน้าต่างเวลาเกินเกณฑ์ → open
+# - open: ไม่เรียกโมเดลนี้เลยจนครบ cooldown (คำขอไปโมเดลสำรองทันที ไม่ต้องรอ retry)
+# - half-open: หลัง cooldown ปล่อยคำขอทดลองทีละหนึ่ง สำเร็จ → closed, ล้มเหลว → open อีกรอบ
+# TTFT ของคำขอที่สำเร็จใช้ตั้ง deadline ของ hedged request (ดู hedge_delay)
+import os
+import time
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+import numpy as np
+
+# หน้าต่างเวลา (วินาที), จำนวนคำขอขั้นต่ำก่อนตัดสิน, error rate ที่ทำให้ตัดวงจร และเวลาพักก่อนทดลองใหม่
+BREAKER_WINDOW = 60.0
+BREAKER_MIN_CALLS = 4
+BREAKER_ERROR_RATE = float(os.environ.get("FTE_BREAKER_ERROR_RATE", "0.5"))
+BREAKER_COOLDOWN = float(os.environ.get("FTE_BREAKER_COOLDOWN", "30"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+class _Health:
+    def __init__(self):
+        self.calls: Deque[Tuple[float, bool, Optional[float]]] = deque()  # (เวลา, สำเร็จ, ttft)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+
+class CircuitBreaker:
+    """สถานะสุขภาพของแต่ละโมเดล — thread-safe, ไม่เก็บข้อความใด ๆ"""
+
+    def __init__(self, window: float = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 error_rate: float = BREAKER_ERROR_RATE, cooldown: float = BREAKER_COOLDOWN,
+                 clock=time.monotonic):
+        self.window, self.min_calls, self.error_rate, self.cooldown = window, min_calls, error_rate, cooldown
+        self._clock = clock
+        self._models: Dict[str, _Health] = {}
+        self._lock = threading.Lock()
+
+    def _health(self, model: str, now: float) -> _Health:
+        h = self._models.setdefault(model, _Health())
+        while h.calls and h.calls[0][0] < now - self.window:
+            h.calls.popleft()
+        return h
+
+    def _cool(self, h: _Health, now: float) -> None:
+        # ครบ cooldown → half-open ทุกทางที่แตะสถานะ (ไม่ใช่แค่ allow) ไม่งั้นโมเดลที่ไม่มีใครถาม allow ค้าง open
+        if h.state == OPEN and now - h.opened_at >= self.cooldown:
+            h.state, h.probing = HALF_OPEN, False
+
+    def allow(self, model: str) -> bool:
+        """เรียกโมเดลนี้ได้ไหม (half-open: True เฉพาะคำขอทดลองแรก ผู้ที่ได้ True ต้อง record หรือ release เสมอ)"""
+        with self._lock:
+            now = self._clock()
+            h = self._health(model, now)
+            self._cool(h, now)
+            if h.state == CLOSED:
+                return True
+            if h.state == HALF_OPEN and not h.probing:
+                h.probing = True
+                return True
+            return False
+
+    def record(self, model: str, ok: bool, ttft: Optional[float] = None) -> None:
+        with self._lock:
+            now = self._clock()
+            h = self._health(model, now)
+            self._cool(h, now)
+            h.calls.append((now, ok, ttft))
+            if h.state == HALF_OPEN:
+                h.probing = False
+                if ok:
+                    h.state = CLOSED
+                    h.calls.clear()  # เริ่มนับใหม่ ไม่ให้ความล้มเหลวช่วง outage ตัดวงจรซ้ำทันที
+                    h.calls.append((now, ok, ttft))
+                else:
+                    h.state, h.opened_at = OPEN, now
+                return
+            if h.state == CLOSED and len(h.calls) >= self.min_calls:
+                errors = sum(1 for _, success, _ in h.calls if not success)
+                if errors / len(h.calls) >= self.error_rate:
+                    h.state, h.opened_at = OPEN, now
+
+    def release(self, model: str) -> None:
+        """คำขอที่ได้สิทธิ์จาก allow แต่ไม่ได้เรียกจริง/ถูกยกเลิกก่อนรู้ผล → คืนสิทธิ์ทดลอง"""
+        with self._lock:
+            h = self._models.get(model)
+            if h is not None and h.state == HALF_OPEN:
+                h.probing = False
+
+    def ttft_quantile(self, model: str, q: float) -> Optional[float]:
+        """quantile ของ TTFT (วินาที) จากคำขอที่สำเร็จในหน้าต่าง; ข้อมูลน้อยกว่า min_calls → None"""
+        with self._lock:
+            h = self._health(model, self._clock())
+            ttfts = [t for _, ok, t in h.calls if ok and t is not None]
+        if len(ttfts) < self.min_calls:
+            return None
+        return float(np.quantile(ttfts, q))
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """{โมเดล: {"state", "calls", "error_rate", "ttft_p50_ms"}} สำหรับแผงผู้ดูแล/trace"""
+        out = {}
+        with self._lock:
+            now = self._clock()
+            for model in list(self._models):
+                h = self._health(model, now)
+                self._cool(h, now)
+                n = len(h.calls)
+                ttfts = [t for _, ok, t in h.calls if ok and t is not None]
+                out[model] = {
+                    "state": h.state,
+                    "calls": n,
+                    "error_rate": round(sum(1 for _, ok, _ in h.calls if not ok) / n, 3) if n else 0.0,
+                    "ttft_p50_ms": round(float(np.median(ttfts)) * 1000, 1) if ttfts else None,
+                }
+        return out
@@ -0,0 +1,199 @@
+# chunkstore.py
+# ที่เก็บ chunk แบบคอลัมน์: ข้อความทุก chunk อยู่ใน blob UTF-8 ก้อนเดียว + offset เริ่ม/จบ
+# ชื่อไฟล์/ชนิด/ชีตเก็บเป็นเลข id (intern) และ chunk ที่ overlap กับ chunk ก่อนหน้าในไฟล์เดียวกัน
+# ใช้ไบต์ส่วนที่ซ้อนกันร่วมกัน (ไม่เก็บซ้ำ)
+#
+# blob เขียนลงดิสก์แยกจาก snapshot แล้วเปิดแบบ mmap (read-only) → ทุก worker ของ Streamlit
+# ที่เปิดดัชนีชุดเดียวกันใช้ page cache ชุดเดียว แทนที่ต่างคนต่างถือสำเนาข้อความทั้งหมด
+import os
+import mmap
+import threading
+from pathlib import Path
+from collections.abc import Sequence
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from ingest import CHUNK_OVERLAP
+
+NONE = -1  # ค่าว่างในคอลัมน์ตัวเลข (page/row/sheet)
+_INT_FIELDS = ("page", "page_end", "row", "row_end")
+
+class ChunkStore(Sequence):
+    """ลำดับของ chunk ที่ store[i] คืน dict แบบเดียวกับที่ ingest สร้าง (source, kind, text, ...)
+
+    dict ถูกสร้างใหม่ทุกครั้งที่เรียก (ไม่ได้เก็บไว้) — โค้ดที่ต้องการแค่ข้อความหรือชื่อไฟล์
+    ใช้ text(i) / source(i) ได้โดยไม่ต้องสร้าง dict
+    """
+
+    def __init__(self, sources: List[str], kinds: List[str], sheets: List[str],
+                 columns: Dict[str, np.ndarray], blob):
+        self.sources, self.kinds, self.sheets = sources, kinds, sheets
+        self.source_id = columns["source_id"]
+        self.kind_id = columns["kind_id"]
+        self.sheet_id = columns["sheet_id"]
+        self.start, self.end = columns["start"], columns["end"]
+        self.ints = {name: columns[name] for name in _INT_FIELDS}
+        self.blob = blob
+        self.blob_path: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def text(self, i: int) -> str:
+        return bytes(self.blob[self.start[i]:self.end[i]]).decode("utf-8")
+
+    def overlaps_previous(self, i: int) -> bool:
+        """chunk i ขึ้นต้นด้วยท้ายของ chunk i-1 (chunk ถัดกันในไฟล์เดียวกันที่ใช้ไบต์ร่วมกัน)"""
+        return 0 < i < len(self) and self.start[i] < self.end[i - 1]
+
+    def span_text(self, first: int, last: int) -> str:
+        """ข้อความต่อเนื่องของ chunk first..last ที่ overlap กันเป็นลูกโซ่ (ส่วนที่ซ้อนกันปรากฏครั้งเดียว)"""
+        return bytes(self.blob[self.start[first]:self.end[last]]).decode("utf-8")
+
+    def source(self, i: int) -> str:
+        return self.sources[self.source_id[i]]
+
+    def kind(self, i: int) -> str:
+        return self.kinds[self.kind_id[i]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        seg = {"source": self.source(i), "kind": self.kind(i), "text": self.text(i)}
+        if self.sheet_id[i] != NONE:
+            seg["sheet"] = self.sheets[self.sheet_id[i]]
+        for name, col in self.ints.items():
+            if col[i] != NONE:
+                seg[name] = int(col[i])
+        return seg
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def texts(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self.text(i)
+
+    @property
+    def nbytes(self) -> int:
+        cols = [self.source_id, self.kind_id, self.sheet_id, self.start, self.end, *self.ints.values()]
+        return len(self.blob) + sum(c.nbytes for c in cols)
+
+    # ---------- blob บนดิสก์ (mmap) ----------
+    def spill(self, path: Path) -> None:
+        """เขียน blob ลงไฟล์ (atomic) แล้วสลับไปอ่านผ่าน mmap; pickle หลังจากนี้เก็บแค่ path"""
+        path = Path(path)
+        if self.blob_path == str(path):
+            return
+        if not path.exists():
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp, "wb") as f:
+                f.write(self.blob)
+            os.replace(tmp, path)
+        self.blob = _map(path)
+        self.blob_path = str(path)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.blob_path:
+            state["blob"] = None
+        elif isinstance(self.blob, mmap.mmap):
+            state["blob"] = bytes(self.blob)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.blob is None:
+            self.blob = _map(Path(self.blob_path))  # ไฟล์หาย → FileNotFoundError (snapshot ใช้ไม่ได้)
+
+def _map(path: Path):
+    if path.stat().st_size == 0:
+        return b""  # mmap ไฟล์ว่างไม่ได้
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _shared_prefix(prev: str, text: str, overlap: int = CHUNK_OVERLAP) -> int:
+    """จำนวนตัวอักษรต้น text ที่ตรงกับท้าย prev (overlap ของ chunk_text / chunk_segments)"""
+    k = min(overlap, len(prev), len(text))
+    return k if k and prev.endswith(text[:k]) else 0
+
+class ChunkStoreBuilder:
+    """ประกอบ ChunkStore ทีละไฟล์: chunk ใหม่จาก ingest (add_rows) หรือช่วงจาก store เดิม (add_range)"""
+
+    def __init__(self):
+        self._ids: Dict[str, Dict[str, int]] = {"source": {}, "kind": {}, "sheet": {}}
+        self._cols: Dict[str, List[int]] = {name: [] for name in
+                                            ("source_id", "kind_id", "sheet_id", "start", "end", *_INT_FIELDS)}
+        self._blob = bytearray()
+
+    def _intern(self, table: str, value: Optional[str]) -> int:
+        if value is None or value == "":
+            return NONE
+        ids = self._ids[table]
+        return ids.setdefault(value, len(ids))
+
+    def _meta(self, source: str, kind: str, sheet: Optional[str], ints: Dict[str, Optional[int]]) -> None:
+        self._cols["source_id"].append(self._intern("source", source))
+        self._cols["kind_id"].append(self._intern("kind", kind))
+        self._cols["sheet_id"].append(self._intern("sheet", sheet))
+        for name in _INT_FIELDS:
+            v = ints.get(name)
+            self._cols[name].append(NONE if v is None else int(v))
+
+    def __len__(self) -> int:
+        return len(self._cols["start"])
+
+    def text(self, i: int) -> str:
+        return bytes(self._blob[self._cols["start"][i]:self._cols["end"][i]]).decode("utf-8")
+
+    def add_row(self, row: Dict, prev: Optional[str] = None) -> None:
+        """prev = ข้อความของ chunk ที่เพิ่งเพิ่มล่าสุด ถ้าเป็น chunk ก่อนหน้าในไฟล์เดียวกัน
+        — chunk ที่ขึ้นต้นด้วยท้ายของ prev ใช้ไบต์นั้นร่วมกัน"""
+        text = row["text"]
+        shared = _shared_prefix(prev, text) if prev is not None else 0
+        head = len(text[:shared].encode("utf-8"))
+        start = len(self._blob) - head
+        self._blob += text[shared:].encode("utf-8")
+        self._cols["start"].append(start)
+        self._cols["end"].append(len(self._blob))
+        self._meta(row["source"], row["kind"], row.get("sheet"), row)
+
+    def add_rows(self, rows: List[Dict]) -> None:
+        """chunk ของไฟล์เดียวกันตามลำดับ"""
+        prev = None
+        for r in rows:
+            self.add_row(r, prev)
+            prev = r["text"]
+
+    def add_range(self, store: ChunkStore, start: int, end: int) -> None:
+        """คัดลอก chunk [start, end) จาก store เดิม (ไบต์ของช่วงนี้ต่อเนื่องกันใน blob เดิม)"""
+        if start >= end:
+            return
+        lo, hi = int(store.start[start:end].min()), int(store.end[start:end].max())
+        shift = len(self._blob) - lo
+        self._blob += bytes(store.blob[lo:hi])
+        self._cols["start"].extend((store.start[start:end].astype(np.int64) + shift).tolist())
+        self._cols["end"].extend((store.end[start:end].astype(np.int64) + shift).tolist())
+        for i in range(start, end):
+            sheet = store.sheets[store.sheet_id[i]] if store.sheet_id[i] != NONE else None
+            ints = {name: (None if col[i] == NONE else int(col[i])) for name, col in store.ints.items()}
+            self._meta(store.source(i), store.kind(i), sheet, ints)
+
+    def build(self) -> ChunkStore:
+        offsets = np.int64 if len(self._blob) >= 2 ** 31 else np.int32
+        columns = {
+            "source_id": np.asarray(self._cols["source_id"], dtype=np.int32),
+            "kind_id": np.asarray(self._cols["kind_id"], dtype=np.int8),
+            "sheet_id": np.asarray(self._cols["sheet_id"], dtype=np.int32),
+            "start": np.asarray(self._cols["start"], dtype=offsets),
+            "end": np.asarray(self._cols["end"], dtype=offsets),
+            **{name: np.asarray(self._cols[name], dtype=np.int32) for name in _INT_FIELDS},
+        }
+        tables = [sorted(self._ids[t], key=self._ids[t].get) for t in ("source", "kind", "sheet")]
+        return ChunkStore(*tables, columns, bytes(self._blob))
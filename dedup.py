@@ -0,0 +1,120 @@
+# dedup.py
+# ตัด chunk ที่ซ้ำ/เกือบซ้ำข้ามไฟล์ตอนสร้างดัชนี (เช่น DOCX กับ PDF ฉบับเดียวกัน หรือไฟล์เดียวกันในสองโฟลเดอร์)
+# - ซ้ำตรงตัว: digest ของข้อความหลังตัดช่องว่างทั้งหมด
+# - เกือบซ้ำ: shingle ตัวอักษรยาว DEDUP_SHINGLE → MinHash → LSH หา candidate แล้วตรวจจริงทีละ candidate
+#   ว่า shingle ของ chunk ใหม่อยู่ใน candidate ตัวเดียว (หรือ candidate + chunk ติดกันในไฟล์เดียวกัน:
+#   PDF/DOCX ฉบับเดียวกันตัด chunk คนละตำแหน่ง) ≥ DEDUP_CONTAINMENT
+#   ห้ามรวม shingle ของ candidate ที่อยู่คนละที่: หัวข้อที่ใช้แม่แบบเดียวกัน (เช่น เกณฑ์รับสมัครของสองภาควิชา)
+#   ประกอบกันแล้วครอบคลุม chunk ที่มีข้อมูลต่างได้ → เนื้อหาจริงหายจากดัชนี
+# - ภายในไฟล์เดียวกันตัดเฉพาะที่ซ้ำตรงตัว: ส่วนที่คล้ายกันในเอกสารเดียวกันมักเป็นข้อมูลคนละเรื่องในแม่แบบเดียวกัน
+# ตัดช่องว่างออกก่อนเทียบ: PDF ขึ้นบรรทัดใหม่กลางวลีภาษาไทยที่ DOCX ไม่มีช่องว่าง
+import os
+import re
+import hashlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEDUP_ENABLED = os.environ.get("FTE_DEDUP", "1") != "0"
+DEDUP_SHINGLE = 16  # ตัวอักษร (~3-4 คำไทย) — สั้นกว่านี้ข้อความที่ใช้แม่แบบเดียวกันจะดูซ้ำกันทั้งที่ข้อมูลต่าง
+DEDUP_PERMUTATIONS = 64
+DEDUP_BANDS = 32  # 32 แถบ × 2 ค่า → คู่ที่ Jaccard ~0.2 ขึ้นไปมักได้เป็น candidate
+DEDUP_CONTAINMENT = float(os.environ.get("FTE_DEDUP_CONTAINMENT", "0.9"))
+DEDUP_CANDIDATES = 8
+
+_WS_RE = re.compile(r"\s+")
+_BASE = np.uint64(1000003)
+_rng = np.random.default_rng(20240611)
+_PERM_A = _rng.integers(1, 2 ** 63, DEDUP_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_PERM_B = _rng.integers(0, 2 ** 63, DEDUP_PERMUTATIONS, dtype=np.uint64)
+
+def shingles(text: str) -> np.ndarray:
+    """hash (uint64) ของทุกช่วงตัวอักษรยาว DEDUP_SHINGLE หลังตัดช่องว่าง — ไม่ซ้ำ, เรียงแล้ว"""
+    codes = np.frombuffer(_WS_RE.sub("", text).casefold().encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    n = len(codes) - DEDUP_SHINGLE + 1
+    if n <= 0:
+        n, width = (1, len(codes)) if len(codes) else (0, 0)
+    else:
+        width = DEDUP_SHINGLE
+    h = np.zeros(n, dtype=np.uint64)
+    for j in range(width):
+        h = h * _BASE + codes[j:j + n]  # overflow = mod 2^64 ตั้งใจ
+    return np.unique(h)
+
+def signature(text: str) -> Tuple[int, np.ndarray]:
+    """(digest ของข้อความ, MinHash uint32 ยาว DEDUP_PERMUTATIONS) — ค่าคงที่ข้ามโปรเซส เก็บใน snapshot ได้"""
+    digest = int.from_bytes(hashlib.blake2b(_WS_RE.sub("", text).casefold().encode("utf-8"),
+                                            digest_size=8).digest(), "little")
+    h = shingles(text)
+    if not h.size:
+        return digest, np.full(DEDUP_PERMUTATIONS, np.iinfo(np.uint32).max, dtype=np.uint32)
+    sig = ((h[None, :] * _PERM_A[:, None] + _PERM_B[:, None]) >> np.uint64(32)).min(axis=1)
+    return digest, sig.astype(np.uint32)
+
+class Deduper:
+    """chunk ที่เก็บไว้แล้วตามลำดับ (id = ลำดับที่ add) → find บอกว่า chunk ใหม่ซ้ำกับ id ไหน
+
+    text_of(id) คืนข้อความของ chunk ที่เก็บไว้ ใช้ตรวจ containment เฉพาะ candidate จาก LSH
+    group = ไฟล์ของ chunk: candidate แบบเกือบซ้ำต้องมาจากไฟล์อื่น
+    """
+
+    def __init__(self, text_of: Callable[[int], str], containment: float = DEDUP_CONTAINMENT):
+        self._text_of, self.containment = text_of, containment
+        self._digests: Dict[int, int] = {}
+        self._buckets: Dict[bytes, List[int]] = {}
+        self._sigs = np.empty((64, DEDUP_PERMUTATIONS), dtype=np.uint32)
+        self._groups: List[str] = []
+        self._n = 0
+        self._shingles: Dict[int, np.ndarray] = {}
+
+    def _bands(self, sig: np.ndarray):
+        rows = DEDUP_PERMUTATIONS // DEDUP_BANDS
+        for b in range(DEDUP_BANDS):
+            yield bytes([b]) + sig[b * rows:(b + 1) * rows].tobytes()
+
+    def add(self, digest: int, sig: np.ndarray, group: str = "") -> int:
+        i = self._n
+        if i == len(self._sigs):
+            self._sigs = np.concatenate([self._sigs, np.empty_like(self._sigs)])
+        self._sigs[i] = sig
+        self._groups.append(group)
+        self._n += 1
+        self._digests.setdefault(digest, i)
+        for key in self._bands(sig):
+            self._buckets.setdefault(key, []).append(i)
+        return i
+
+    def _shingles_of(self, i: int) -> np.ndarray:
+        if i not in self._shingles:
+            self._shingles[i] = shingles(self._text_of(i))
+        return self._shingles[i]
+
+    def find(self, text: str, digest: int, sig: np.ndarray, group: str = "",
+             exact_only: bool = False) -> Optional[int]:
+        if digest in self._digests:
+            return self._digests[digest]
+        if exact_only or self._n == 0:
+            return None
+        cand = {i for key in self._bands(sig) for i in self._buckets.get(key, ())
+                if self._groups[i] != group}
+        if not cand:
+            return None
+        cand = np.fromiter(cand, dtype=np.int64, count=len(cand))
+        agree = (self._sigs[cand] == sig).sum(axis=1)  # ≈ Jaccard × จำนวน permutation
+        if cand.size > DEDUP_CANDIDATES:
+            top = np.argpartition(-agree, DEDUP_CANDIDATES - 1)[:DEDUP_CANDIDATES]
+            cand, agree = cand[top], agree[top]
+        h = shingles(text)
+        if not h.size:
+            return None
+        best, best_score = None, self.containment
+        for i in cand[np.argsort(-agree, kind="stable")]:
+            i = int(i)
+            for lo, hi in ((i, i), (i - 1, i), (i, i + 1)):  # ข้อความต่อเนื่องจากที่เดียว
+                if lo < 0 or hi >= self._n or self._groups[lo] != self._groups[hi]:
+                    continue
+                span = self._shingles_of(i) if lo == hi else np.union1d(self._shingles_of(lo), self._shingles_of(hi))
+                score = np.isin(h, span, assume_unique=True).mean()
+                if score >= best_score:
+                    best, best_score = i, score
+        return best
@@ -0,0 +1,1168 @@
+# engine.py
+# แกนของแชทบอทที่ไม่ผูกกับ UI: ดัชนีค้นหา, การดึงบริบท, history, cache คำตอบ และการเรียกโมเดล
+# ใช้ร่วมกันระหว่างหน้า Streamlit (app.py) และ HTTP API (api.py); ทุกอย่างในนี้ thread-safe
+import os
+import re
+import time
+import json
+import queue
+import pickle
+import random
+import shutil
+import hashlib
+import threading
+import tomllib
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator, List, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from prompt import PROMPT_FTE  # ต้องมีไฟล์ prompt.py ที่ประกาศ PROMPT_FTE
+from bm25 import WORD_ENGINE, BM25Index, count_terms, tokenize_words
+from ingest import (CHUNK_SIZE, CHUNK_OVERLAP, KIND_LABELS, TableIndex, collect_chunks, discover_all_files,
+                    format_source)
+from chunkstore import ChunkStore, ChunkStoreBuilder
+from dedup import DEDUP_CONTAINMENT, DEDUP_ENABLED, DEDUP_PERMUTATIONS, Deduper, signature
+from hashindex import HASH_FEATURES, PROJECTION_DIM, HashedTfidfVectorizer, MappedMatrix
+from tracing import Trace, Tracer
+from breaker import CircuitBreaker
+from prefixcache import PREFIX_CACHE_ENABLED, GeminiPrefixStore, PrefixCache
+
+# =========================
+# PATHS & CONFIG
+# =========================
+BASE_DIR = Path(__file__).resolve().parent
+
+# พารามิเตอร์ vectorizer (เป็นส่วนหนึ่งของ fingerprint ของ snapshot ร่วมกับ CHUNK_SIZE/OVERLAP)
+VECTORIZER_PARAMS = {"analyzer": "char", "ngram_range": (3, 5)}
+# "tfidf" = TfidfVectorizer (vocab dict, float64) | "hashed" = hash n-gram, float32, เมทริกซ์ mmap ใช้ร่วมกันข้ามโปรเซส
+INDEX_BACKEND = os.environ.get("FTE_INDEX_BACKEND", "tfidf")
+# hashed: จำนวน candidate จากเวกเตอร์ dense ที่นำมาคำนวณ cosine จริง
+PROJECTION_CANDIDATES = 200
+
+# snapshot ของดัชนีบนดิสก์ — เพิ่มเลขเวอร์ชันเมื่อรูปแบบข้อมูลใน snapshot เปลี่ยน
+INDEX_CACHE_DIR = BASE_DIR / ".index_cache"
+INDEX_SNAPSHOT_VERSION = 9
+# สแกนหาไฟล์ใหม่/แก้ไข/ลบทุก ๆ N วินาที (0 = ปิด) และ fit vocab ใหม่ทั้งหมด
+# เมื่อแถวที่ transform ด้วย vocab เดิมเกินสัดส่วนนี้ของดัชนี
+INDEX_REFRESH_SECONDS = float(os.environ.get("FTE_INDEX_REFRESH_SECONDS", "60"))
+INDEX_REFIT_RATIO = 0.25
+# น้ำหนักคะแนน BM25 (คำ) เทียบกับ cosine ของ char n-gram ในการค้นหาแบบ hybrid
+HYBRID_WORD_WEIGHT = 0.5
+# เลือกบริบทแบบ MMR: candidate = top_k × POOL_FACTOR ตามคะแนน แล้วเลือกทีละตัวด้วย
+# λ·ความเกี่ยวข้อง − (1−λ)·cosine สูงสุดกับที่เลือกไปแล้ว (λ = 1 → เรียงตามคะแนนอย่างเดียว)
+# pool ใหญ่ขึ้นเสียเวลาแบบกำลังสอง (cosine ทุกคู่ของ candidate บนเวกเตอร์ sparse)
+MMR_POOL_FACTOR = 2
+MMR_LAMBDA = float(os.environ.get("FTE_MMR_LAMBDA", "0.7"))
+
+# cache คำตอบที่ใช้ร่วมกันทุก session: จำนวนสูงสุด, อายุ (วินาที) และ cosine ขั้นต่ำที่ถือว่าคำถามซ้ำ
+ANSWER_CACHE_SIZE = 512
+ANSWER_CACHE_TTL = float(os.environ.get("FTE_ANSWER_CACHE_TTL", str(6 * 3600)))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("FTE_ANSWER_CACHE_SIMILARITY", "0.9"))
+
+# history ที่ส่งให้โมเดล: งบ token ของข้อความคำต่อคำ, จำนวนเทิร์นล่าสุดสูงสุด,
+# งบของสรุปเทิร์นเก่า และความยาวต่อบรรทัดในสรุป
+CHARS_PER_TOKEN      = 3
+HISTORY_TOKEN_BUDGET = int(os.environ.get("FTE_HISTORY_TOKEN_BUDGET", "2000"))
+HISTORY_MAX_TURNS    = 4
+SUMMARY_TOKEN_BUDGET = 400
+SUMMARY_LINE_CHARS   = 160
+
+# การ render คำตอบแบบสตรีม: อัปเดตหน้าจออย่างมากทุก N วินาที หรือเมื่อมีข้อความใหม่ ≥ N ตัวอักษร
+RENDER_INTERVAL  = 0.08
+RENDER_MIN_CHARS = 400
+
+# =========================
+# MODEL CONFIG
+# =========================
+GENERATION_CONFIG = {
+    "temperature": 0.5,
+    "top_p": 0.95,
+    "top_k": 64,
+    "max_output_tokens": 1024,
+    "response_mime_type": "text/plain",
+}
+PRIMARY_MODEL_NAME = "gemini-2.5-flash"
+FALLBACK_MODEL_NAME = "gemini-2.0-flash"
+# hedged request: โมเดลหลักยังไม่ส่ง token แรกภายใน deadline → ส่งคำขอเดียวกันไปโมเดลสำรองคู่ขนาน
+# ใครได้ token แรกก่อนชนะ; deadline = HEDGE_TTFT_FACTOR × p90 TTFT ล่าสุดของโมเดลหลัก
+# จำกัดในช่วง [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY] วินาที (ยังไม่มีสถิติ → HEDGE_MAX_DELAY, ≤ 0 = ปิด hedge)
+HEDGE_MIN_DELAY = 0.5
+HEDGE_MAX_DELAY = float(os.environ.get("FTE_HEDGE_DELAY", "3.0"))
+HEDGE_TTFT_FACTOR = 2.0
+
+def load_api_key() -> Optional[str]:
+    """GEMINI_APIKEY จาก environment หรือ .streamlit/secrets.toml (ไฟล์เดียวกับที่หน้า Streamlit ใช้)"""
+    key = os.environ.get("GEMINI_APIKEY")
+    if key:
+        return key
+    secrets = BASE_DIR / ".streamlit" / "secrets.toml"
+    if secrets.exists():
+        with open(secrets, "rb") as f:
+            return tomllib.load(f).get("GEMINI_APIKEY")
+    return None
+
+# =========================
+# BUILD TF-IDF INDEX (CHAR N-GRAM → ดีสำหรับภาษาไทย)
+# =========================
+def build_index(chunks: Sequence[Dict]):
+    texts = (list(chunks.texts()) if isinstance(chunks, ChunkStore) else [r["text"] for r in chunks]) or ["dummy"]
+    if INDEX_BACKEND == "hashed":
+        vect = HashedTfidfVectorizer(**VECTORIZER_PARAMS)
+    else:
+        from sklearn.feature_extraction.text import TfidfVectorizer  # snapshot ที่โหลดได้ไม่ต้องใช้ตอนเปิดแอป
+        vect = TfidfVectorizer(**VECTORIZER_PARAMS)
+    X = vect.fit_transform(texts)
+    return vect, X[:len(chunks)]
+
+# =========================
+# FILE MANIFEST & INCREMENTAL INDEX
+# =========================
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def build_manifest(found: dict, previous: Optional[Dict[str, Dict]] = None,
+                   root: Path = BASE_DIR) -> Dict[str, Dict]:
+    """{relpath: {kind, size, mtime_ns, sha256}} — แฮชใหม่เฉพาะไฟล์ที่ size/mtime เปลี่ยน"""
+    previous = previous or {}
+    manifest = {}
+    for kind in ("docx", "tabular", "pdf"):
+        for p in found[kind]:
+            rel = p.relative_to(root).as_posix()
+            if rel in manifest:
+                continue
+            stat = p.stat()
+            old = previous.get(rel)
+            if old and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns:
+                digest = old["sha256"]
+            else:
+                digest = file_sha256(str(p))
+            manifest[rel] = {"kind": kind, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+    return manifest
+
+def index_params() -> Dict:
+    params = {"version": INDEX_SNAPSHOT_VERSION, "chunk": [CHUNK_SIZE, CHUNK_OVERLAP],
+              "vectorizer": json.loads(json.dumps(VECTORIZER_PARAMS)), "words": WORD_ENGINE,
+              "backend": INDEX_BACKEND, "dedup": [DEDUP_ENABLED, DEDUP_CONTAINMENT]}
+    if INDEX_BACKEND == "hashed":
+        params["hashed"] = [HASH_FEATURES, PROJECTION_DIM]
+    return params
+
+def index_fingerprint(manifest: Dict[str, Dict], failed: Sequence[str] = ()) -> str:
+    h = hashlib.sha256()
+    h.update(json.dumps(index_params(), sort_keys=True).encode("utf-8"))
+    for rel, meta in manifest.items():
+        h.update(f"{meta['kind']}\0{rel}\0{meta['sha256']}\n".encode("utf-8"))
+    for rel in sorted(failed):  # ดัชนีที่ขาดไฟล์ ≠ ดัชนีที่อ่านครบ (cache คำตอบ/prefix ผูกกับ fingerprint)
+        h.update(f"failed\0{rel}\n".encode("utf-8"))
+    return h.hexdigest()
+
+@dataclass(frozen=True)
+class IndexState:
+    fingerprint: str
+    manifest: Dict[str, Dict]
+    row_ranges: Dict[str, Tuple[int, int]]  # relpath → แถว [start, end) ใน chunks และ X
+    chunks: ChunkStore
+    vect: object
+    X: object
+    stale_rows: int = 0  # แถวที่ transform ด้วย vocab/idf เดิมโดยยังไม่ได้ fit ใหม่
+    tables: Optional[TableIndex] = None  # ค่าในเซลล์ → แถวของตาราง
+    file_terms: Dict[str, List[Dict[str, int]]] = field(default_factory=dict)  # relpath → คำ/ความถี่ต่อ chunk
+    bm25: Optional[BM25Index] = None
+    root: str = str(BASE_DIR)  # โฟลเดอร์ที่ relpath ใน manifest อ้างอิง
+    Z: Optional[np.ndarray] = None  # hashed: เวกเตอร์ dense มิติต่ำของแต่ละแถวใน X (candidate รอบแรก)
+    # ตัด chunk ซ้ำ: digest/MinHash ของแต่ละแถว, chunk ที่ถูกตัดต่อไฟล์ [(relpath ของ chunk ที่เก็บไว้,
+    # ลำดับในไฟล์นั้น, ป้ายที่มาของ chunk ที่ถูกตัด)] และ chunk ที่เก็บไว้ → ป้ายที่มาของ chunk ซ้ำ
+    digests: Optional[np.ndarray] = None
+    signatures: Optional[np.ndarray] = None
+    file_drops: Dict[str, List[Tuple[str, int, str]]] = field(default_factory=dict)
+    aliases: Dict[int, List[str]] = field(default_factory=dict)
+    # ไฟล์ที่อ่านไม่สำเร็จ (parser ล้ม/worker ตาย/หมดเวลา) — ใช้แถวเดิม (ถ้ามี) และอ่านใหม่ใน refresh ถัดไป
+    failed: Tuple[str, ...] = ()
+
+    @property
+    def found(self) -> dict:
+        out = {"docx": [], "tabular": [], "pdf": []}
+        for rel, meta in self.manifest.items():
+            out[meta["kind"]].append(Path(self.root) / rel)
+        return out
+
+    def chunk_counts(self) -> Dict[str, int]:
+        """relpath → จำนวน chunk ที่อ่านได้จากไฟล์นั้น รวมที่ถูกตัดเพราะซ้ำ (0 = ไฟล์ว่างหรืออ่านไม่ได้)"""
+        return {rel: end - start + len(self.file_drops.get(rel, ()))
+                for rel, (start, end) in self.row_ranges.items()}
+
+def update_index(state: Optional[IndexState], found: dict, root: Path = BASE_DIR) -> IndexState:
+    """สร้างดัชนีใหม่จาก state เดิม: อ่านเฉพาะไฟล์ที่เพิ่ม/เปลี่ยน, ตัดแถวของไฟล์ที่ถูกลบ"""
+    root = Path(root)
+    manifest = build_manifest(found, state.manifest if state else None, root)
+    fingerprint = index_fingerprint(manifest)
+    if state is not None and state.fingerprint == fingerprint:
+        return state
+
+    old_ranges = state.row_ranges if state else {}
+    old_manifest = state.manifest if state else {}
+    old_drops = state.file_drops if state else {}
+    old_failed = set(state.failed) if state else set()
+    changed = {rel for rel, meta in manifest.items()
+               if rel not in old_ranges or old_manifest[rel]["sha256"] != meta["sha256"] or rel in old_failed}
+    # ไฟล์ที่ chunk เคยถูกตัดเพราะซ้ำกับไฟล์ที่เปลี่ยน/ถูกลบ ต้องอ่านใหม่ด้วย (ต้นฉบับที่อ้างถึงอาจหายไป)
+    # ไฟล์อื่นที่ไม่เปลี่ยนคงผลการตัดเดิม — กรณีก้ำกึ่ง (containment ใกล้เกณฑ์) อาจต่างจากการสร้างใหม่ทั้งหมดเล็กน้อย
+    stale = changed | (set(old_manifest) - set(manifest))
+    while True:
+        more = {rel for rel in manifest if rel not in changed
+                and any(owner in stale for owner, _, _ in old_drops.get(rel, ()))}
+        if not more:
+            break
+        changed |= more
+        stale |= more
+    changed = [rel for rel in manifest if rel in changed]
+    extracted = dict(zip(changed, collect_chunks([(root / rel, manifest[rel]["kind"]) for rel in changed])))
+    # อ่านไม่สำเร็จ ≠ ไฟล์ว่าง: คงแถวและ manifest เดิมของไฟล์นั้นไว้ (ไฟล์ใหม่ → ยังไม่อยู่ในดัชนี)
+    # แล้วจดไว้ใน failed ให้ refresh ถัดไปอ่านใหม่ ไม่งั้น fingerprint ตรงกันและไฟล์หายจากดัชนีจนกว่าจะถูกแก้
+    failed = tuple(rel for rel in changed if extracted[rel] is None)
+    for rel in failed:
+        del extracted[rel]
+        if rel in old_ranges:
+            manifest[rel] = old_manifest[rel]
+        else:
+            del manifest[rel]
+    if failed:
+        fingerprint = index_fingerprint(manifest, failed)
+
+    # ประกอบ store ใหม่ตามลำดับ manifest: ไฟล์ที่ไม่เปลี่ยนคัดลอกช่วงไบต์จาก store เดิม
+    # chunk ใหม่ที่ซ้ำกับ chunk ที่เก็บไว้ก่อนหน้า (ไฟล์ก่อนหน้าหรือไฟล์เดียวกัน) ถูกตัด แล้วจดที่มาไว้แทน
+    # worker ตัดคำมาให้แล้ว (ทำขนานกัน) → แยกเก็บไว้นอก chunk สำหรับสร้าง BM25 รอบถัดไป
+    old_terms = state.file_terms if state else {}
+    builder = ChunkStoreBuilder()
+    deduper = Deduper(builder.text)
+    owners: List[Tuple[str, int]] = []  # แถวในดัชนี → (relpath, ลำดับในไฟล์)
+    digests, signatures = [], []
+    file_terms, file_drops, row_ranges = {}, {}, {}
+    for rel in manifest:
+        start_row = len(builder)
+        if rel in extracted:
+            kept, drops, terms, prev = [], [], [], None
+            for r in extracted[rel]:
+                digest, sig = r.pop("dedup", None) or signature(r["text"])
+                dup = (deduper.find(r["text"], digest, sig, rel, exact_only=r["kind"] == KIND_LABELS["tabular"])
+                       if DEDUP_ENABLED else None)
+                if dup is not None:
+                    drops.append((*owners[dup], format_source(r)))
+                    prev = None
+                    continue
+                deduper.add(digest, sig, rel)
+                owners.append((rel, len(kept)))
+                digests.append(digest)
+                signatures.append(sig)
+                builder.add_row(r, prev)
+                prev = r["text"]
+                kept.append(r)
+                terms.append(r.pop("terms", None) or count_terms(r["text"]))
+            extracted[rel] = kept
+            file_terms[rel], file_drops[rel] = terms, drops
+        else:
+            start, end = old_ranges[rel]
+            builder.add_range(state.chunks, start, end)
+            for i in range(start, end):
+                deduper.add(int(state.digests[i]), state.signatures[i], rel)
+                owners.append((rel, i - start))
+            digests.extend(state.digests[start:end].tolist())
+            signatures.extend(state.signatures[start:end])
+            file_terms[rel] = old_terms.get(rel) or [count_terms(state.chunks.text(i)) for i in range(start, end)]
+            # ไฟล์ที่อ่านใหม่ไม่สำเร็จอาจมีรายการที่อ้างถึงไฟล์ที่เปลี่ยน/ถูกลบ → ทิ้ง (รอบหน้าอ่านใหม่อยู่แล้ว)
+            file_drops[rel] = [d for d in old_drops.get(rel, []) if d[0] not in stale]
+        row_ranges[rel] = (start_row, len(builder))
+    chunks = builder.build()
+    digests = np.asarray(digests, dtype=np.uint64)
+    signatures = np.asarray(signatures, dtype=np.uint32).reshape(len(chunks), DEDUP_PERMUTATIONS)  # 0 chunk ก็ได้รูปถูก
+    aliases: Dict[int, List[str]] = {}
+    for drops in file_drops.values():
+        for owner, local, label in drops:
+            aliases.setdefault(row_ranges[owner][0] + local, []).append(label)
+
+    new_rows = sum(len(rows) for rows in extracted.values())
+    stale_rows = (state.stale_rows if state else 0) + new_rows
+    if state is None or state.X.shape[0] == 0 or stale_rows > INDEX_REFIT_RATIO * max(len(chunks), 1):
+        vect, X = build_index(chunks)
+        stale_rows = 0
+    else:
+        # คง vocab/idf เดิม: ใช้แถวเดิมของไฟล์ที่ไม่เปลี่ยน + transform เฉพาะ chunk ใหม่
+        vect = state.vect
+        blocks = []
+        for rel in manifest:
+            if rel in extracted:
+                if extracted[rel]:
+                    blocks.append(vect.transform([r["text"] for r in extracted[rel]]))
+            else:
+                start, end = old_ranges[rel]
+                if end > start:
+                    blocks.append(state.X[start:end])
+        X = sp.vstack(blocks, format="csr") if blocks else state.X[:0]
+        stale_rows = min(stale_rows, len(chunks))
+    bm25 = BM25Index(terms for rel in manifest for terms in file_terms[rel])
+    Z = vect.project(X) if isinstance(vect, HashedTfidfVectorizer) else None
+    return IndexState(fingerprint, manifest, row_ranges, chunks, vect, X, stale_rows,
+                      TableIndex(chunks), file_terms, bm25, str(root), Z,
+                      digests, signatures, file_drops, aliases, failed)
+
+# =========================
+# INDEX SNAPSHOT (ON-DISK) — cold start โหลดไฟล์เดียวแทนการ parse + fit ใหม่
+# =========================
+def _snapshot_path() -> Path:
+    return INDEX_CACHE_DIR / f"index-v{INDEX_SNAPSHOT_VERSION}.pkl"
+
+def load_index_snapshot() -> Optional[IndexState]:
+    path = _snapshot_path()
+    if not path.exists():
+        return None
+    try:
+        with open(path, "rb") as f:
+            snap = pickle.load(f)
+    except Exception:
+        return None  # ไฟล์เสีย/เขียนไม่จบ → สร้างใหม่
+    if snap.get("params") != index_params():
+        return None
+    # เก็บเป็น dict ธรรมดา: ไม่ผูกรูปแบบไฟล์กับ class ของ state
+    fields = snap["state"]
+    if isinstance(fields["X"], MappedMatrix):
+        try:
+            fields["X"], fields["Z"] = fields["X"].load()
+        except OSError:
+            return None
+    return IndexState(**fields)
+
+def save_index_snapshot(state: IndexState) -> None:
+    INDEX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = _snapshot_path()
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    # ข้อความ chunk แยกเป็นไฟล์ blob ต่อ fingerprint (เปิดแบบ mmap) — snapshot เก็บแค่ path
+    blob = INDEX_CACHE_DIR / f"chunks-v{INDEX_SNAPSHOT_VERSION}-{state.fingerprint[:16]}.bin"
+    state.chunks.spill(blob)
+    snap = {"params": index_params(), "state": dict(state.__dict__)}
+    matrix = INDEX_CACHE_DIR / f"matrix-v{INDEX_SNAPSHOT_VERSION}-{state.fingerprint[:16]}"
+    if isinstance(state.vect, HashedTfidfVectorizer):
+        # เมทริกซ์ float32 เป็น .npy แยก (mmap ตอนโหลด) — snapshot เก็บแค่ path
+        snap["state"]["X"], snap["state"]["Z"] = MappedMatrix.save(matrix, state.X, state.Z), None
+    with open(tmp, "wb") as f:
+        pickle.dump(snap, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)  # atomic → worker อื่นไม่เห็นไฟล์ครึ่ง ๆ กลาง ๆ
+    # โปรเซสอื่นที่ยัง mmap blob เก่าอยู่อ่านต่อได้ (ไฟล์ถูกลบเมื่อปิด map ครบ)
+    for old in [*INDEX_CACHE_DIR.glob("index-*.pkl"), *INDEX_CACHE_DIR.glob("chunks-*.bin")]:
+        if old not in (path, blob):
+            try:
+                old.unlink(missing_ok=True)
+            except OSError:
+                pass  # Windows: ไฟล์ที่ถูก map อยู่ลบไม่ได้ → รอบถัดไปลองใหม่
+    for old in INDEX_CACHE_DIR.glob("matrix-*"):
+        if old != matrix and old.is_dir():
+            shutil.rmtree(old, ignore_errors=True)
+
+# =========================
+# SHARED INDEX + BACKGROUND REFRESH
+# =========================
+class IndexHolder:
+    """ถือ IndexState ปัจจุบัน; refresh สร้าง state ใหม่แล้วสลับ reference ทีเดียว
+    คำขอที่กำลังค้นหาอยู่ (rerun ของ Streamlit หรือ request ของ API) จึงใช้ state เดิมได้จนจบ"""
+
+    def __init__(self, state: Optional[IndexState] = None, root: Path = BASE_DIR):
+        self.state = state
+        self.root = Path(root)
+        self._lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        with self._lock:
+            new_state = update_index(self.state, discover_all_files(str(self.root)), self.root)
+            if new_state is self.state:
+                return False
+            self.state = new_state
+        try:
+            save_index_snapshot(new_state)
+        except OSError:
+            pass  # ดิสก์อ่านอย่างเดียว → ใช้ดัชนีในหน่วยความจำต่อไป
+        return True
+
+    def start_refresher(self, interval: float) -> None:
+        def _loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception:
+                    pass  # รอบถัดไปลองใหม่ ดัชนีเดิมยังใช้งานได้
+        threading.Thread(target=_loop, name="index-refresher", daemon=True).start()
+
+def warm_tokenizer() -> None:
+    tokenize_words("ภาควิชา")  # โหลดตัวตัดคำตอนเตรียมดัชนี ไม่ใช่ตอนคำถามแรก
+
+def open_index(refresh_seconds: float = INDEX_REFRESH_SECONDS, root: Path = BASE_DIR,
+               warm: bool = True) -> IndexHolder:
+    """โหลด snapshot (ถ้ามี) → อัปเดตตามไฟล์ปัจจุบัน → เริ่ม refresher เบื้องหลัง
+    (warm=False: ผู้เรียกเรียก warm_tokenizer เอง เช่น เพื่อจับเวลาเป็นขั้นแยก)"""
+    holder = IndexHolder(load_index_snapshot() if Path(root) == BASE_DIR else None, root)
+    holder.refresh()  # snapshot เก่า → อัปเดตเฉพาะไฟล์ที่เปลี่ยนระหว่างปิดแอป
+    if warm:
+        warm_tokenizer()
+    if refresh_seconds > 0:
+        holder.start_refresher(refresh_seconds)
+    return holder
+
+# =========================
+# RETRIEVAL (HYBRID BM25 + CHAR N-GRAM)
+# =========================
+def _block(seg: Dict, aliases: Sequence[str] = ()) -> str:
+    # chunk ที่มีฉบับซ้ำถูกตัดไป: บอกที่มาอื่นไว้ในหัวข้อ (ให้โมเดลอ้างอิงได้ครบ) โดยไม่ส่งเนื้อหาซ้ำ
+    also = f" (เนื้อหาเดียวกับ {', '.join(aliases[:3])})" if aliases else ""
+    return f"{format_source(seg)}{also}\n{seg['text']}\n"
+
+def _dot_rows(X, rows: np.ndarray, qv) -> np.ndarray:
+    """X[rows] · qv (เวกเตอร์คำถาม sparse แถวเดียว) ผ่านเวกเตอร์คำถามแบบ dense
+    — เร็วกว่า sparse @ sparse ของ scipy ที่ต้องแปลง qv.T ขนาดเท่าจำนวนคอลัมน์ (hashed มีเป็นล้าน)"""
+    q = np.zeros(X.shape[1], dtype=X.dtype)
+    q[qv.indices] = qv.data
+    return X[rows] @ q
+
+def retrieve_context(state: IndexState, query: str, top_k: int = 8, max_chars: int = 6000,
+                     carry: Sequence[int] = ()) -> Tuple[str, List[Tuple[int, float]]]:
+    """carry = chunk ของเทิร์นก่อน: ต่อท้ายถ้างบยังเหลือ และไม่ส่งซ้ำถ้าถูกดึงมาอีกในเทิร์นนี้"""
+    chunks, X = state.chunks, state.X
+    if not query.strip() or X.shape[0] == 0:
+        return "", []
+    qv = state.vect.transform([query])
+    # 1) candidate = chunk ที่มีคำร่วมกับคำถามจาก inverted index (ไม่ต้องแตะทุกแถวของ X)
+    cand, bm = state.bm25.search(tokenize_words(query)) if state.bm25 is not None else (np.empty(0, dtype=np.int32), None)
+    if cand.size:
+        cos = _dot_rows(X, cand, qv)  # cosine sim for tfidf-normalized
+        scores = HYBRID_WORD_WEIGHT * bm / bm.max() + (1.0 - HYBRID_WORD_WEIGHT) * cos
+    else:
+        # ไม่มีคำตรงกันเลย (เช่น สะกดต่าง) → char n-gram ทั้งดัชนี แต่เก็บผลแบบ sparse
+        if state.Z is not None and X.shape[0] > PROJECTION_CANDIDATES:
+            # hashed: รอบแรกด้วยเวกเตอร์ dense มิติต่ำ แล้วคำนวณ cosine จริงเฉพาะ candidate
+            approx = state.Z @ state.vect.project(qv)[0]
+            cand = np.argpartition(-approx, PROJECTION_CANDIDATES - 1)[:PROJECTION_CANDIDATES].astype(np.int32)
+            scores = _dot_rows(X, cand, qv)
+        else:
+            res = (X @ qv.T).tocoo()
+            cand, scores = res.row.astype(np.int32), res.data
+    # 2) pool = top (top_k × POOL_FACTOR) แบบ partial selection → MMR เลือก top_k ที่ไม่ซ้ำกัน
+    keep = np.flatnonzero(scores > 0)
+    pool = top_k * MMR_POOL_FACTOR
+    if keep.size > pool:
+        keep = keep[np.argpartition(-scores[keep], pool - 1)[:pool]]
+    keep = keep[np.argsort(-scores[keep], kind="stable")]
+    cand, scores = cand[keep], scores[keep]
+    order = _mmr(X, cand, scores, top_k, state.Z)
+    score_of = {int(cand[j]): float(scores[j]) for j in order}
+    # 3) บรรจุลงงบแบบ greedy: block ที่ยาวเกินงบที่เหลือถูกข้ามไป ไม่หยุดทั้งหมด
+    parts, total, picked = [], 0, []
+
+    def fits(block: str) -> bool:
+        nonlocal total
+        if total + len(block) > max_chars:
+            return False
+        parts.append(block); total += len(block)
+        return True
+
+    # แถวตารางที่ตรงกับค่าในคำถาม (เช่น รหัสวิชา) มาก่อน: แม่นและสั้นกว่าทั้ง chunk
+    # chunk ที่แถวของมันอยู่ในบริบทแล้วไม่ส่งทั้ง chunk ซ้ำอีก (แถวเดียวกันจะปรากฏสองครั้ง)
+    tables = state.tables
+    row_hits = tables.match_query(query) if tables is not None else []
+    covered = set()
+    for ci in dict.fromkeys(ci for ci, _ in row_hits):
+        if fits(tables.format_rows([hit for hit in row_hits if hit[0] == ci], chunks)[0]):
+            covered.add(ci)
+            if ci in score_of:
+                picked.append((ci, score_of[ci]))
+    # 4) chunk ติดกันในไฟล์เดียวกันที่ overlap → รวมเป็นช่วงเดียว (ไม่ส่งส่วนที่ซ้อนกันซ้ำ, หัวข้อเดียว)
+    spans = _merge_adjacent(chunks, [int(cand[j]) for j in order if int(cand[j]) not in covered])
+    for rows in spans:
+        if fits(_span_block(state, rows)):
+            picked.extend((i, score_of[i]) for i in rows)
+    seen = covered | {i for rows in spans for i in rows}
+    for i in carry:
+        if i in seen or i >= len(chunks):
+            continue
+        seen.add(i)
+        fits(_block(chunks[i], state.aliases.get(i, ())))
+    return "\n".join(parts), picked
+
+def _mmr(X, cand: np.ndarray, scores: np.ndarray, k: int, Z: Optional[np.ndarray] = None,
+         lam: float = MMR_LAMBDA) -> List[int]:
+    """ลำดับ (ตำแหน่งใน cand) ของ k ตัวที่เลือกแบบ maximal marginal relevance
+    — cosine ระหว่าง candidate คำนวณครั้งเดียวเป็นเมทริกซ์ pool × pool จากแถวของ X (normalize แล้ว)
+    หรือจากเวกเตอร์ dense Z ถ้ามี (hashed: ถูกกว่ามาก ค่าใกล้เคียง cosine จริง)"""
+    n = len(cand)
+    if n == 0:
+        return []
+    if lam >= 1.0 or n <= 1:
+        return list(range(min(k, n)))
+    rel = scores / scores.max()
+    if Z is not None:
+        V = np.asarray(Z[cand])
+        sim = V @ V.T
+    else:
+        V = X[cand]
+        sim = (V @ V.T).toarray()
+    closest = np.zeros(n)  # cosine สูงสุดกับตัวที่เลือกแล้ว
+    gain = np.empty(n)
+    chosen: List[int] = []
+    avail = np.ones(n, dtype=bool)
+    for _ in range(min(k, n)):
+        np.subtract(lam * rel, (1.0 - lam) * closest, out=gain)
+        gain[~avail] = -np.inf
+        j = int(np.argmax(gain))
+        chosen.append(j)
+        avail[j] = False
+        np.maximum(closest, sim[j], out=closest)
+    return chosen
+
+def _merge_adjacent(chunks: ChunkStore, rows: List[int]) -> List[List[int]]:
+    """จัดกลุ่มแถวที่ติดกันและ overlap กันจริง (ใช้ไบต์ร่วมกันใน store) เป็นช่วงเดียว
+    คงลำดับตามแถวที่ถูกเลือกก่อนสุดในแต่ละช่วง"""
+    rank = {i: r for r, i in enumerate(rows)}
+    spans: List[List[int]] = []
+    for i in sorted(rows):
+        if spans and spans[-1][-1] == i - 1 and chunks.overlaps_previous(i):
+            spans[-1].append(i)
+        else:
+            spans.append([i])
+    spans.sort(key=lambda s: min(rank[i] for i in s))
+    return spans
+
+def _span_block(state: IndexState, rows: List[int]) -> str:
+    chunks = state.chunks
+    if len(rows) == 1:
+        return _block(chunks[rows[0]], state.aliases.get(rows[0], ()))
+    seg, last = chunks[rows[0]], chunks[rows[-1]]
+    seg["text"] = chunks.span_text(rows[0], rows[-1])
+    if seg.get("page") is not None:
+        seg["page_end"] = last.get("page_end") or last["page"]
+    if seg.get("row") is not None:
+        seg["row_end"] = last["row_end"]
+    aliases = list(dict.fromkeys(a for i in rows for a in state.aliases.get(i, ())))
+    return _block(seg, aliases)
+
+# =========================
+# SHARED ANSWER CACHE (ข้าม session, จับคำถามที่เกือบซ้ำด้วย char n-gram)
+# =========================
+_POLITE_PARTICLES = ("ครับผม", "ครับ", "คับ", "ค่ะ", "คะ", "ค่า", "จ้า", "นะ")
+
+def normalize_query(query: str) -> str:
+    # ไม่สนเครื่องหมาย/ช่องว่าง: "ค่าเทอม เท่าไหร่?" กับ "ค่าเทอมเท่าไหร่" คือคำถามเดียวกัน
+    # (สระ/วรรณยุกต์ไทยเป็น combining mark ซึ่ง \w ไม่นับ → กรองตาม Unicode category แทน)
+    q = "".join(ch for ch in query.casefold() if unicodedata.category(ch)[0] in "LMN")
+    for p in _POLITE_PARTICLES:  # ...และลงท้ายด้วย คะ/ครับ ก็เหมือนกัน
+        if q.endswith(p) and len(q) > len(p):
+            q = q[: -len(p)]
+            break
+    return q
+
+_CACHE_KEY_RE = re.compile(r"(?:\d|[a-z])+")
+_CACHE_FEATURES = 2 ** 18
+
+def _query_keys(norm: str) -> Tuple[str, ...]:
+    # ตัวเลข/อักษรละติน (ปี, เทอม, รหัสวิชา) ต้องตรงกันทุกตัว: "ปี 1" กับ "ปี 2" ต่างกันแค่ n-gram เดียว
+    return tuple(sorted(_CACHE_KEY_RE.findall(norm)))
+
+class AnswerCache:
+    """คำตอบของคำถามแรกในบทสนทนา ใช้ร่วมกันทุก session ในโปรเซส
+
+    จับคู่แบบตรงตัวหลัง normalize ก่อน แล้วจึงหา near-duplicate ด้วย cosine ของ char n-gram (hash)
+    ≥ threshold เฉพาะคำถามที่มีตัวเลข/คำละตินชุดเดียวกัน — ไม่ใช้ vectorizer ของดัชนี เพราะทิ้ง n-gram
+    ที่ไม่มีในเอกสาร (คำถามต่างกันแค่ตัวเลขได้ cosine = 1)
+    หมดอายุตาม TTL, ล้นแล้วทิ้งตัวที่ใช้ล่าสุดนานที่สุด (LRU)
+    และล้างทั้งหมดเมื่อ fingerprint ของดัชนีเปลี่ยน (เอกสารเปลี่ยน = คำตอบอาจเปลี่ยน)
+    """
+
+    def __init__(self, max_entries: int, ttl: float, threshold: float):
+        self.max_entries, self.ttl, self.threshold = max_entries, ttl, threshold
+        # norm → (เวลา, คำตอบ, เวกเตอร์, ตัวเลข/คำละติน)
+        self._entries: "OrderedDict[str, Tuple[float, str, object, Tuple[str, ...]]]" = OrderedDict()
+        self._matrix, self._matrix_keys = None, []  # vstack ของเวกเตอร์ (สร้างใหม่เมื่อชุด key เปลี่ยน)
+        self._fingerprint = None
+        self._hasher = None
+        self._lock = threading.Lock()
+
+    def _vector(self, norm: str):
+        if self._hasher is None:
+            from sklearn.feature_extraction.text import HashingVectorizer
+            self._hasher = HashingVectorizer(n_features=_CACHE_FEATURES, alternate_sign=False, **VECTORIZER_PARAMS)
+        return self._hasher.transform([norm])
+
+    def _sync(self, fingerprint: str) -> None:
+        if fingerprint != self._fingerprint:
+            self._entries.clear()
+            self._matrix = None
+            self._fingerprint = fingerprint
+        now = time.time()
+        expired = [k for k, (ts, _, _, _) in self._entries.items() if now - ts > self.ttl]
+        for k in expired:
+            del self._entries[k]
+        if expired:
+            self._matrix = None
+
+    def get(self, query: str, fingerprint: str) -> Optional[str]:
+        norm = normalize_query(query)
+        if not norm:
+            return None
+        with self._lock:
+            self._sync(fingerprint)
+            if norm not in self._entries and self._entries:
+                if self._matrix is None:
+                    self._matrix_keys = list(self._entries)
+                    self._matrix = sp.vstack([self._entries[k][2] for k in self._matrix_keys], format="csr")
+                sims = (self._matrix @ self._vector(norm).T).toarray().ravel()
+                keys = _query_keys(norm)
+                sims[[self._entries[k][3] != keys for k in self._matrix_keys]] = -1.0
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    norm = self._matrix_keys[best]
+            if norm not in self._entries:
+                return None
+            self._entries.move_to_end(norm)
+            return self._entries[norm][1]
+
+    def put(self, query: str, answer: str, fingerprint: str) -> None:
+        norm = normalize_query(query)
+        if not norm or not answer:
+            return
+        with self._lock:
+            self._sync(fingerprint)
+            self._entries[norm] = (time.time(), answer, self._vector(norm), _query_keys(norm))
+            self._entries.move_to_end(norm)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+# =========================
+# BUILD HISTORY FOR GEMINI (ใช้บริบทที่ดึงมา เฉพาะที่เกี่ยว)
+# =========================
+FOLLOWUPS = [
+    "\n\nต้องการข้อมูลส่วนไหนเพิ่มเติมอีกไหมคะ"
+]
+
+def estimate_tokens(text: str) -> int:
+    # ประมาณหยาบ ๆ แบบไม่ต้องเรียก API: ไทย/อังกฤษปนกันเฉลี่ยราว 3 ตัวอักษรต่อ token
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def strip_followup(content: str) -> str:
+    # ประโยคชวนคุยท้ายคำตอบมีไว้แสดงผู้ใช้เท่านั้น ไม่ต้องส่งกลับไปให้โมเดลทุกเทิร์น
+    for f in FOLLOWUPS:
+        if content.endswith(f) and len(content) > len(f):
+            return content[: -len(f)]
+    return content
+
+def _summary_line(m: Dict) -> str:
+    who = "ผู้ใช้ถาม" if m["role"] == "user" else "ผู้ช่วยตอบ"
+    text = " ".join(strip_followup(m["content"]).split())
+    if len(text) > SUMMARY_LINE_CHARS:
+        text = text[:SUMMARY_LINE_CHARS] + "…"
+    return f"- {who}: {text}"
+
+def summarize_messages(messages, upto: int, cache: Dict) -> str:
+    """สรุปแบบย่อของ messages[:upto] เก็บต่อยอดใน cache (บรรทัดละข้อความ, ตัดบรรทัดเก่าเกินงบ)"""
+    sig = hashlib.sha1("\0".join(m["content"] for m in messages[:cache.get("upto", 0)]).encode("utf-8")).hexdigest()
+    if cache.get("upto", 0) > upto or cache.get("sig") != sig:
+        cache.clear()  # history ถูกล้าง/กู้คืน → เริ่มสรุปใหม่
+    lines = cache.setdefault("lines", [])
+    for m in messages[cache.get("upto", 0):upto]:
+        lines.append(_summary_line(m))
+    total = 0
+    for k in range(len(lines) - 1, -1, -1):
+        total += estimate_tokens(lines[k])
+        if total > SUMMARY_TOKEN_BUDGET:
+            del lines[:k + 1]
+            break
+    cache["upto"] = upto
+    cache["sig"] = hashlib.sha1("\0".join(m["content"] for m in messages[:upto]).encode("utf-8")).hexdigest()
+    return "\n".join(lines)
+
+def build_history_for_gemini(messages, context_text: str, summary_cache: Optional[Dict] = None,
+                             token_budget: int = HISTORY_TOKEN_BUDGET,
+                             max_turns: int = HISTORY_MAX_TURNS):
+    """history สำหรับ Gemini: N เทิร์นล่าสุดแบบคำต่อคำภายในงบ token, ที่เก่ากว่านั้นเป็นสรุปย่อ"""
+    contents = [strip_followup(m["content"]) or m["content"] for m in messages]
+    # เดินย้อนจากข้อความล่าสุดจนกว่าจะเกินงบ token หรือจำนวนเทิร์น (ข้อความล่าสุดเก็บไว้เสมอ)
+    start, used = len(messages), 0
+    while start > 0 and len(messages) - start < max_turns * 2:
+        cost = estimate_tokens(contents[start - 1])
+        if used + cost > token_budget and start < len(messages):
+            break
+        used += cost
+        start -= 1
+    # ให้ส่วนที่เก็บคำต่อคำเริ่มด้วยข้อความของโมเดล เพื่อสลับ user/model ต่อจาก turn บริบท
+    while start < len(messages) - 1 and messages[start]["role"] == "user":
+        start += 1
+
+    preface = []
+    if start > 0:
+        summary = summarize_messages(messages, start, summary_cache if summary_cache is not None else {})
+        if summary:
+            preface.append("สรุปบทสนทนาก่อนหน้า:\n" + summary)
+    if context_text:
+        preface.append("บริบทอ้างอิง (ซ่อนจากผู้ใช้):\n" + context_text)
+
+    history = []
+    if preface:
+        history.append({"role": "user", "parts": [{"text": "\n\n".join(preface)}]})
+    for m, content in zip(messages[start:], contents[start:]):
+        role = "user" if m["role"] == "user" else "model"
+        history.append({"role": role, "parts": [{"text": content}]})
+    return history
+
+# =========================
+# STREAMING RENDERER
+# =========================
+class StreamRenderer:
+    """รวม chunk ที่สตรีมเข้ามาแล้ว render เป็นเฟรม แทนการ render ใหม่ทุกตัวอักษร
+
+    render เมื่อได้ token แรก (ให้ผู้ใช้เห็นเร็วที่สุด) และหลังจากนั้นเมื่อผ่านไป interval
+    วินาทีหรือมีข้อความใหม่สะสม ≥ min_chars ตัวอักษร; close() render เฟรมสุดท้ายเสมอ
+    """
+
+    def __init__(self, sink: Callable[[str], None],
+                 interval: float = RENDER_INTERVAL,
+                 min_chars: int = RENDER_MIN_CHARS,
+                 cursor: str = "▌",
+                 started: Optional[float] = None):
+        self.sink, self.interval, self.min_chars, self.cursor = sink, interval, min_chars, cursor
+        self.started = started if started is not None else time.perf_counter()  # จุดเริ่มนับ TTFT
+        self.first_token_at: Optional[float] = None
+        self.text = ""
+        self.renders = 0
+        self.render_time = 0.0
+        self._pending = 0
+        self._last_render = 0.0
+
+    def _render(self, text: str) -> None:
+        t0 = time.perf_counter()
+        self.sink(text)
+        self._last_render = time.perf_counter()
+        self.render_time += self._last_render - t0
+        self.renders += 1
+        self._pending = 0
+
+    def feed(self, piece: str) -> None:
+        if not piece:
+            return
+        self.text += piece
+        self._pending += len(piece)
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+            self._render(self.text + self.cursor)
+        elif now - self._last_render >= self.interval or self._pending >= self.min_chars:
+            self._render(self.text + self.cursor)
+
+    def close(self) -> str:
+        if self.text:
+            self._render(self.text)
+        return self.text
+
+    def stats(self) -> Dict:
+        end = time.perf_counter()
+        return {
+            "ttft": None if self.first_token_at is None else self.first_token_at - self.started,
+            "total": end - self.started,
+            "render_time": self.render_time,
+            "renders": self.renders,
+            "chars": len(self.text),
+        }
+
+# =========================
+# LLM BACKENDS + CIRCUIT BREAKER + HEDGED FALLBACK
+# =========================
+class ModelUnavailableError(RuntimeError):
+    """ทั้งโมเดลหลักและโมเดลสำรองสร้างคำตอบไม่ได้"""
+
+class LLMBackend:
+    """สตรีมคำตอบจากโมเดล: stream(ชื่อโมเดล, history, คำถาม) → ข้อความทีละชิ้น
+
+    prefix_cache (ถ้ามี) เก็บ system instruction (PROMPT_FTE) ไว้ฝั่งผู้ให้บริการ — ไม่ขึ้นกับดัชนี
+    """
+    prefix_cache: Optional[PrefixCache] = None
+
+    def stream(self, model_name: str, history: List[Dict], prompt: str) -> Iterator[str]:
+        raise NotImplementedError
+
+    def _prefix_handle(self, model_name: str) -> Optional[str]:
+        if self.prefix_cache is None:
+            return None
+        return self.prefix_cache.get(model_name, PROMPT_FTE)
+
+class GeminiBackend(LLMBackend):
+    """client ของ Gemini หนึ่งตัวต่อโปรเซส: GenerativeModel ต่อ (โมเดล, handle ของ prefix) สร้างครั้งเดียวแล้วใช้ซ้ำ"""
+
+    def __init__(self, api_key: str, prefix_cache: Optional[PrefixCache] = None):
+        import google.generativeai as genai
+        from google.generativeai.types import HarmCategory, HarmBlockThreshold
+
+        genai.configure(api_key=api_key)
+        self._genai = genai
+        self.safety_settings = {
+            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+        }
+        if prefix_cache is None and PREFIX_CACHE_ENABLED:
+            prefix_cache = PrefixCache(GeminiPrefixStore(genai))
+        self.prefix_cache = prefix_cache
+        self._models: Dict[Tuple[str, Optional[str]], object] = {}
+        self._lock = threading.Lock()
+
+    def make_model(self, name: str, handle: Optional[str] = None):
+        if handle is not None:
+            # system instruction อยู่ใน cached content แล้ว ไม่ส่งซ้ำ
+            return self._genai.GenerativeModel.from_cached_content(
+                handle, generation_config=GENERATION_CONFIG, safety_settings=self.safety_settings)
+        return self._genai.GenerativeModel(
+            model_name=name,
+            safety_settings=self.safety_settings,
+            generation_config=GENERATION_CONFIG,
+            system_instruction=PROMPT_FTE,
+        )
+
+    def model(self, name: str, handle: Optional[str] = None):
+        with self._lock:
+            model = self._models.get((name, handle))
+            if model is None:
+                if handle is not None:
+                    # handle ใหม่แทนที่ handle เก่าของโมเดลเดียวกัน (prefix เปลี่ยน หรือสร้างใหม่ก่อนหมดอายุ)
+                    for key in [k for k in self._models if k[0] == name and k[1] is not None]:
+                        del self._models[key]
+                model = self._models[(name, handle)] = self.make_model(name, handle)
+            return model
+
+    def stream(self, model_name: str, history: List[Dict], prompt: str) -> Iterator[str]:
+        # ไม่สร้าง ChatSession ต่อคำขอ: history + คำถามส่งเป็น contents ชุดเดียวกับที่ session จะส่ง
+        contents = list(history) + [{"role": "user", "parts": [{"text": prompt}]}]
+        handle = self._prefix_handle(model_name)
+        started = False
+        try:
+            for chunk in self.model(model_name, handle).generate_content(contents, stream=True):
+                text = getattr(chunk, "text", "") or ""
+                if text:
+                    started = True
+                    yield text
+        except Exception as e:
+            if handle is None or started or not _prefix_error(e):
+                raise
+            # cached content ใช้ไม่ได้ (หมดอายุ/ถูกลบ) → ทิ้ง handle แล้วส่ง prefix เต็มครั้งนี้
+            self.prefix_cache.invalidate(model_name, handle)
+            for chunk in self.model(model_name).generate_content(contents, stream=True):
+                text = getattr(chunk, "text", "") or ""
+                if text:
+                    yield text
+
+def _prefix_error(e: Exception) -> bool:
+    msg = str(e).lower()
+    return any(k in msg for k in ["cachedcontent", "cached content", "not found", "404"])
+
+class StubBackend(LLMBackend):
+    """โมเดลจำลองสำหรับทดสอบ/benchmark: ไม่ต่อเครือข่าย ตอบแบบ deterministic จากคำถาม + บริบท
+
+    จำลองความผิดพลาดได้: error_rate = โอกาสที่คำขอโดน 429 ทันที, fail_after = จำนวนชิ้นก่อนสตรีมขาดกลางทาง
+    faults = ค่าที่ต่างกันต่อโมเดล เช่น {"gemini-2.5-flash": {"error_rate": 1.0}} หรือ {"first_token_delay": 5}
+    prefill_delay = เวลาประมวลผล system instruction เพิ่มก่อน token แรก เมื่อไม่ได้ใช้ prefix ที่ cache ไว้
+    (ใช้ร่วมกับ PrefixCache(LocalPrefixStore()) แทน CachedContent ของ Gemini)
+    """
+
+    def __init__(self, reply_chars: int = 600, piece_chars: int = 24,
+                 first_token_delay: float = 0.0, piece_delay: float = 0.0,
+                 error_rate: float = 0.0, fail_after: Optional[int] = None,
+                 faults: Optional[Dict[str, Dict]] = None, seed: int = 0,
+                 prefill_delay: float = 0.0, prefix_cache: Optional[PrefixCache] = None):
+        self.reply_chars, self.piece_chars = reply_chars, piece_chars
+        self.defaults = {"first_token_delay": first_token_delay, "piece_delay": piece_delay,
+                         "error_rate": error_rate, "fail_after": fail_after, "prefill_delay": prefill_delay}
+        self.prefix_cache = prefix_cache
+        self.faults = faults or {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def stream(self, model_name: str, history: List[Dict], prompt: str) -> Iterator[str]:
+        conf = {**self.defaults, **self.faults.get(model_name, {})}
+        handle = self._prefix_handle(model_name)
+        with self._lock:
+            failed = self._rng.random() < conf["error_rate"]
+        if failed:
+            raise RuntimeError(f"429 Resource exhausted (stub {model_name})")
+        context = history[0]["parts"][0]["text"] if history and history[0]["role"] == "user" else ""
+        body = f"[{model_name}] คำตอบสำหรับ: {prompt}\n" + " ".join(context.split())
+        text = (body * (self.reply_chars // max(len(body), 1) + 1))[:self.reply_chars]
+        delay = conf["first_token_delay"] + (conf["prefill_delay"] if handle is None else 0.0)
+        if delay:
+            time.sleep(delay)
+        for n, i in enumerate(range(0, len(text), self.piece_chars)):
+            if conf["fail_after"] is not None and n >= conf["fail_after"]:
+                raise RuntimeError(f"503 stream interrupted (stub {model_name})")
+            if i and conf["piece_delay"]:
+                time.sleep(conf["piece_delay"])
+            yield text[i:i + self.piece_chars]
+
+def hedge_delay(breaker: CircuitBreaker, model_name: str = PRIMARY_MODEL_NAME) -> Optional[float]:
+    """deadline (วินาที) ก่อนส่ง hedged request ไปโมเดลสำรอง; None = ไม่ hedge"""
+    if HEDGE_MAX_DELAY <= 0:
+        return None
+    p90 = breaker.ttft_quantile(model_name, 0.9)
+    if p90 is None:
+        return HEDGE_MAX_DELAY
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, HEDGE_TTFT_FACTOR * p90))
+
+class _ModelStream:
+    """สตรีมของโมเดลหนึ่งตัวใน thread แยก: ส่ง (ตัวเอง, ชิ้นข้อความ | None เมื่อจบ | exception) เข้า queue ร่วม
+    ยกเลิกได้ระหว่างชิ้น (คำขอ HTTP ที่ค้างอยู่ปล่อยให้จบเอง ผลถูกทิ้ง)"""
+
+    def __init__(self, backend: LLMBackend, model_name: str, span_name: str,
+                 history_payload, prompt_text: str, events: "queue.Queue", **attrs):
+        self.model, self.span_name, self.attrs = model_name, span_name, attrs
+        self.started = time.perf_counter()
+        self.first_at: Optional[float] = None
+        self.chars = 0
+        self.cancelled = threading.Event()
+        threading.Thread(target=self._run, args=(backend, history_payload, prompt_text, events),
+                         name=f"model-{model_name}", daemon=True).start()
+
+    def _run(self, backend, history_payload, prompt_text, events) -> None:
+        try:
+            for piece in backend.stream(self.model, history_payload, prompt_text):
+                if self.cancelled.is_set():
+                    return
+                if piece:
+                    events.put((self, piece))
+            events.put((self, None))
+        except Exception as e:
+            events.put((self, e))
+
+    @property
+    def ttft(self) -> Optional[float]:
+        return None if self.first_at is None else self.first_at - self.started
+
+    def span(self, trace: Trace, **attrs) -> None:
+        ttft = self.ttft
+        trace.add_span(self.span_name, (time.perf_counter() - self.started) * 1000, start=self.started,
+                       model=self.model, ttft_ms=None if ttft is None else round(ttft * 1000, 3),
+                       chars=self.chars, **self.attrs, **attrs)
+
+def stream_with_fallback(backend: LLMBackend, history_payload, prompt_text: str,
+                         breaker: Optional[CircuitBreaker] = None,
+                         on_restart: Optional[Callable[[str], None]] = None,
+                         stats: Optional[Dict] = None,
+                         trace: Optional[Trace] = None) -> Iterator[str]:
+    """สตรีมจากโมเดลหลัก โดยมีโมเดลสำรองรับช่วงเมื่อโมเดลหลักล้ม ช้า หรือถูกตัดวงจร
+
+    - breaker ของโมเดลหลัก open → ไปโมเดลสำรองทันที; โมเดลสำรองก็ผ่าน breaker ของตัวเอง (open ทั้งคู่ → error ทันที)
+    - โมเดลหลักล้มก่อน token แรก → เริ่มโมเดลสำรองทันที (ไม่หน่วง backoff)
+    - เกิน hedge_delay ยังไม่มี token แรก → ส่งโมเดลสำรองคู่ขนาน ใครได้ token แรกก่อนชนะ อีกตัวถูกยกเลิก
+    - สตรีมขาดกลางทาง → on_restart(ชื่อโมเดลสำรอง) แล้วเริ่มใหม่ที่โมเดลสำรอง ผู้เรียกควรทิ้งข้อความที่ได้มาก่อนหน้า
+    ทุกโมเดลล้ม → ModelUnavailableError; ผลทุกครั้ง (สำเร็จ/ล้ม/แพ้ hedge) บันทึกลง breaker
+    span "model" / "fallback" ต่อการเรียกหนึ่งครั้ง (attrs: hedge, won, cancelled, error)
+    """
+    stats = stats if stats is not None else {}
+    trace = trace if trace is not None else Trace()
+    breaker = breaker if breaker is not None else CircuitBreaker()
+    events: "queue.Queue" = queue.Queue()
+    running: List[_ModelStream] = []
+    tried = set()
+    error: Optional[Exception] = None
+
+    def launch(model_name: str, span_name: str, **attrs) -> _ModelStream:
+        s = _ModelStream(backend, model_name, span_name, history_payload, prompt_text, events,
+                         **attrs)
+        running.append(s)
+        tried.add(model_name)
+        return s
+
+    def fallback(span_name: str = "fallback", **attrs) -> bool:
+        # โมเดลสำรองผ่าน breaker ของตัวเองเหมือนโมเดลหลัก (open → ไม่เรียก, half-open → คำขอทดลองเดียว)
+        if FALLBACK_MODEL_NAME in tried or not breaker.allow(FALLBACK_MODEL_NAME):
+            return False
+        launch(FALLBACK_MODEL_NAME, span_name, **attrs)
+        return True
+
+    def fail(s: _ModelStream, e: Optional[Exception], **attrs) -> None:
+        running.remove(s)
+        s.cancelled.set()
+        breaker.record(s.model, False, s.ttft)
+        s.span(trace, error=type(e).__name__ if e else "no first token", **attrs)
+
+    stats["hedged"] = False
+    if breaker.allow(PRIMARY_MODEL_NAME):
+        stats["route"] = "primary"
+        launch(PRIMARY_MODEL_NAME, "model")
+        delay = hedge_delay(breaker)
+    else:
+        stats["route"] = "breaker_open"
+        if not fallback():
+            raise ModelUnavailableError("circuit open for all models")
+        delay = None
+    hedge_at = None if delay is None else time.perf_counter() + delay
+    try:
+        while True:
+            # 1) รอ token แรกจากตัวที่ยังทำงาน — ตัวแรกที่ได้ชิ้นข้อความ (หรือจบเปล่า) เป็นผู้ชนะ
+            winner, first = None, None
+            while winner is None:
+                if not running:
+                    raise ModelUnavailableError(str(error) if error else "no model available")
+                timeout = None if hedge_at is None else max(0.0, hedge_at - time.perf_counter())
+                try:
+                    s, item = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedge_at = None
+                    if fallback(hedge=True):
+                        stats["hedged"] = True
+                    continue
+                if s not in running:
+                    continue  # ถูกยกเลิกไปแล้ว
+                if isinstance(item, Exception):
+                    error = item
+                    fail(s, item)
+                    if fallback():
+                        hedge_at = None
+                        stats["route"] = "fallback"
+                    continue
+                winner, first = s, item
+                winner.first_at = time.perf_counter()
+                if stats["hedged"] and winner.model == FALLBACK_MODEL_NAME:
+                    stats["route"] = "hedge"
+            for s in [s for s in running if s is not winner]:
+                if s.model == PRIMARY_MODEL_NAME:
+                    fail(s, None, cancelled=True)  # แพ้ hedge = ช้าเกินไป นับเป็นความล้มเหลว
+                else:
+                    running.remove(s)
+                    s.cancelled.set()
+                    breaker.release(s.model)
+                    s.span(trace, cancelled=True)
+            hedge_at = None
+
+            # 2) สตรีมของผู้ชนะจนจบ
+            if stats.get("model") not in (None, winner.model) and on_restart:
+                on_restart(winner.model)
+            stats["model"] = winner.model
+            item = first
+            while True:
+                if isinstance(item, Exception):
+                    break
+                if item is None:
+                    running.remove(winner)
+                    breaker.record(winner.model, True, winner.ttft)
+                    winner.span(trace, won=True)
+                    return
+                winner.chars += len(item)
+                yield item
+                s, item = events.get()
+                while s is not winner:
+                    s, item = events.get()
+            # ขาดกลางทาง: ลองโมเดลสำรองถ้ายังไม่ได้ลอง ไม่งั้นจบด้วย error
+            error = item
+            fail(winner, item, won=True)
+            if not fallback():
+                raise ModelUnavailableError(str(item)) from item
+            stats["route"] = "fallback"
+            if on_restart:
+                on_restart(FALLBACK_MODEL_NAME)
+            stats["model"] = FALLBACK_MODEL_NAME
+    finally:
+        # ผู้เรียกเลิกอ่านกลางทาง (ผู้ใช้ปิดหน้า) หรือ error → ไม่ปล่อย thread ค้างส่งชิ้นข้อความต่อ
+        for s in running:
+            s.cancelled.set()
+            breaker.release(s.model)
+
+# =========================
+# CHAT ENGINE
+# =========================
+class ChatEngine:
+    """หนึ่งอินสแตนซ์ต่อโปรเซส ใช้พร้อมกันได้หลายบทสนทนา
+
+    state ของแต่ละบทสนทนา (messages + dict session สำหรับสรุป history / chunk ของเทิร์นก่อน)
+    เป็นของผู้เรียก; engine ถือเฉพาะของที่ใช้ร่วมกัน: ดัชนี, cache คำตอบ, backend ของโมเดล,
+    circuit breaker ของโมเดล และ tracer
+    """
+
+    def __init__(self, holder: IndexHolder, backend: LLMBackend,
+                 answer_cache: Optional[AnswerCache] = None,
+                 tracer: Optional[Tracer] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.holder = holder
+        self.backend = backend
+        self.answer_cache = answer_cache or AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY)
+        self.tracer = tracer or Tracer()
+        self.breaker = breaker or CircuitBreaker()
+
+    def stream_reply(self, messages: List[Dict], prompt: str,
+                     session: Optional[Dict] = None,
+                     stats: Optional[Dict] = None,
+                     on_restart: Optional[Callable[[str], None]] = None,
+                     trace: Optional[Trace] = None) -> Iterator[str]:
+        """messages = ข้อความก่อนหน้า (ไม่รวม prompt), yield คำตอบทีละชิ้น
+
+        ถ้าส่ง trace มา ผู้เรียกเพิ่ม span ของตัวเอง (เช่น render) แล้วเรียก tracer.finish เอง;
+        ไม่ส่งมา engine สร้างและ finish ให้เมื่อจบเทิร์น
+        """
+        session = session if session is not None else {}
+        stats = stats if stats is not None else {}
+        own_trace = trace is None
+        trace = self.tracer.start() if own_trace else trace
+        stats["trace_id"] = trace.id
+        state = self.holder.state  # ใช้ดัชนีชุดเดียวตลอดคำขอ แม้ refresher จะสลับระหว่างทาง
+        parts: List[str] = []
+        try:
+            # คำถามแรกของบทสนทนาไม่ขึ้นกับ history → ใช้คำตอบที่ cache ไว้ได้; คำถามต่อเนื่องข้าม cache
+            first_turn = not any(m["role"] == "user" for m in messages)
+            trace.set(first_turn=first_turn, prompt_chars=len(prompt), index=state.fingerprint[:12])
+            with trace.span("cache", checked=first_turn):
+                cached = self.answer_cache.get(prompt, state.fingerprint) if first_turn else None
+            stats["cached"] = bool(cached)
+            if cached:
+                parts.append(cached)
+                yield cached
+                return
+
+            # 1) ดึงบริบทที่เกี่ยวข้องจากดัชนี (+ chunk ของเทิร์นก่อนที่ยังไม่ซ้ำ ถ้างบเหลือ)
+            carry = [] if first_turn else session.get("context_ids", [])
+            with trace.span("retrieve", carry=len(carry)) as span:
+                context_text, hits = retrieve_context(state, prompt, top_k=8, max_chars=6000, carry=carry)
+                span["hits"] = [[i, round(float(s), 4)] for i, s in hits]
+                span["context_chars"] = len(context_text)
+                span["context_tokens"] = estimate_tokens(context_text)
+            session["context_ids"] = [i for i, _ in hits]
+            stats["hits"] = hits
+
+            # 2) สร้าง history ที่รวม 'บริบทอ้างอิง' (ไม่แสดงต่อผู้ใช้) ภายในงบ token
+            with trace.span("history", messages=len(messages)) as span:
+                history_payload = build_history_for_gemini(messages, context_text,
+                                                           session.setdefault("history_summary", {}))
+                span["turns"] = len(history_payload)
+                span["tokens"] = sum(estimate_tokens(p["text"]) for h in history_payload for p in h["parts"])
+            trace.set(prompt_tokens=span["tokens"] + estimate_tokens(prompt))
+
+            # 3) ส่งถามโมเดล (circuit breaker + hedged request ไปโมเดลสำรอง)
+            def _restart(model_name: str) -> None:
+                parts.clear()
+                if on_restart:
+                    on_restart(model_name)
+
+            for piece in stream_with_fallback(self.backend, history_payload, prompt, breaker=self.breaker,
+                                              on_restart=_restart, stats=stats, trace=trace):
+                parts.append(piece)
+                yield piece
+            reply = "".join(parts)
+            if first_turn and reply:
+                self.answer_cache.put(prompt, reply, state.fingerprint)
+        except ModelUnavailableError as e:
+            trace.set(error=str(e)[:200])
+            raise
+        finally:
+            trace.set(cached=stats.get("cached", False), model=stats.get("model"),
+                      route=stats.get("route"), hedged=stats.get("hedged", False), response_tokens=estimate_tokens("".join(parts)))
+            if own_trace:
+                self.tracer.finish(trace)
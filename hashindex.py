@@ -0,0 +1,122 @@
+# hashindex.py
+# ดัชนี char n-gram แบบประหยัดหน่วยความจำ (FTE_INDEX_BACKEND=hashed) ใช้แทน TfidfVectorizer
+# - hash n-gram ลงคอลัมน์จำนวนคงที่ → ไม่มี vocabulary dict (ก้อนใหญ่ที่สุดในโปรเซสเมื่อเป็นภาษาไทย)
+# - น้ำหนัก TF-IDF และเมทริกซ์เก็บเป็น float32
+# - ฉายเป็นเวกเตอร์ dense มิติต่ำ (count sketch) สำหรับหา candidate รอบแรกเมื่อไม่มีคำตรงกันใน BM25
+# - บันทึกเมทริกซ์เป็นไฟล์ .npy ที่เปิดแบบ mmap (read-only) ใช้ร่วมกันได้ทุกโปรเซส
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+
+# จำนวนคอลัมน์ hash (ชนกันบ้างไม่เป็นไรสำหรับ char n-gram) และมิติของเวกเตอร์ dense (0 = ไม่ใช้)
+HASH_FEATURES = int(os.environ.get("FTE_HASH_FEATURES", str(2 ** 20)))
+PROJECTION_DIM = int(os.environ.get("FTE_PROJECTION_DIM", "256"))
+PROJECTION_SEED = 0
+
+class HashedTfidfVectorizer:
+    """TF-IDF บนคอลัมน์ hash: fit เก็บแค่ idf (float32 หนึ่งค่าต่อคอลัมน์) ไม่มี vocab
+
+    สูตร idf และการ normalize (L2) เหมือน TfidfVectorizer ค่าเริ่มต้น → คะแนน cosine เทียบกันได้
+    คอลัมน์ที่ไม่มีในเอกสารตอน fit ได้ idf = 0 (เทียบเท่า n-gram นอก vocab ที่ TfidfVectorizer ทิ้ง)
+    """
+
+    def __init__(self, n_features: int = HASH_FEATURES, projection_dim: int = PROJECTION_DIM,
+                 seed: int = PROJECTION_SEED, **params):
+        self.n_features, self.projection_dim, self.seed = n_features, projection_dim, seed
+        self.params = params
+        self.idf_: Optional[np.ndarray] = None
+        self._init()
+
+    def _init(self) -> None:
+        from sklearn.feature_extraction.text import HashingVectorizer  # เฉพาะ backend นี้ (import ช้า)
+        self._hasher = HashingVectorizer(n_features=self.n_features, alternate_sign=False, norm=None,
+                                         dtype=np.float32, **self.params)
+        # count sketch: คอลัมน์ hash → (ช่องในเวกเตอร์ dense, เครื่องหมาย) สุ่มแบบกำหนด seed
+        self._bucket = self._sign = None
+        if self.projection_dim:
+            raw = np.random.default_rng(self.seed).integers(0, 2 * self.projection_dim,
+                                                            size=self.n_features, dtype=np.int32)
+            self._bucket = raw >> 1
+            self._sign = (1 - 2 * (raw & 1)).astype(np.int8)
+
+    def __getstate__(self):
+        # hasher และตาราง sketch สร้างใหม่จาก seed ได้ → ไม่ต้องเก็บใน snapshot; idf เก็บเฉพาะคอลัมน์ที่ไม่เป็น 0
+        state = {k: v for k, v in self.__dict__.items() if k not in ("_hasher", "_bucket", "_sign")}
+        if self.idf_ is not None:
+            cols = np.flatnonzero(self.idf_).astype(np.int32)
+            state["idf_"] = (cols, self.idf_[cols])
+        return state
+
+    def __setstate__(self, state):
+        idf = state.pop("idf_", None)
+        self.__dict__.update(state)
+        self.idf_ = None
+        if idf is not None:
+            cols, values = idf
+            self.idf_ = np.zeros(self.n_features, dtype=np.float32)
+            self.idf_[cols] = values
+        self._init()
+
+    def _weigh(self, counts):
+        from sklearn.preprocessing import normalize
+        counts.data *= self.idf_[counts.indices]
+        counts.eliminate_zeros()
+        return normalize(counts, copy=False)
+
+    def fit_transform(self, texts):
+        counts = self._hasher.transform(texts).tocsr()
+        n = counts.shape[0]
+        df = np.bincount(counts.indices, minlength=self.n_features)
+        self.idf_ = np.where(df > 0, np.log((1.0 + n) / (1.0 + df)) + 1.0, 0.0).astype(np.float32)
+        return self._weigh(counts)
+
+    def transform(self, texts):
+        return self._weigh(self._hasher.transform(texts).tocsr())
+
+    def project(self, X) -> Optional[np.ndarray]:
+        """แถวของ X (csr) → เวกเตอร์ dense float32 ขนาด projection_dim ที่ normalize แล้ว"""
+        if not self.projection_dim:
+            return None
+        X = X.tocsr()
+        rows = np.repeat(np.arange(X.shape[0], dtype=np.int64), np.diff(X.indptr))
+        slots = rows * self.projection_dim + self._bucket[X.indices]
+        Z = np.bincount(slots, weights=X.data * self._sign[X.indices],
+                        minlength=X.shape[0] * self.projection_dim)
+        Z = Z.reshape(X.shape[0], self.projection_dim).astype(np.float32)
+        norms = np.linalg.norm(Z, axis=1, keepdims=True)
+        np.divide(Z, norms, out=Z, where=norms > 0)
+        return Z
+
+class MappedMatrix:
+    """อ้างอิงไฟล์ .npy ของเมทริกซ์ในดัชนี — pickle เฉพาะ path/shape, load() เปิดแบบ mmap"""
+
+    def __init__(self, path: Path, shape: Tuple[int, int], dense: bool):
+        self.path, self.shape, self.dense = str(path), shape, dense
+
+    @classmethod
+    def save(cls, path: Path, X, Z: Optional[np.ndarray]) -> "MappedMatrix":
+        path = Path(path)
+        if not path.exists():
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.mkdir(parents=True)
+            for name, arr in (("data", X.data), ("indices", X.indices), ("indptr", X.indptr)):
+                np.save(tmp / f"{name}.npy", arr)
+            if Z is not None:
+                np.save(tmp / "dense.npy", Z)
+            try:
+                os.replace(tmp, path)
+            except OSError:
+                shutil.rmtree(tmp, ignore_errors=True)  # โปรเซสอื่นเขียนชุดเดียวกันเสร็จก่อน
+        return cls(path, X.shape, Z is not None)
+
+    def load(self):
+        path = Path(self.path)
+        parts = [np.load(path / f"{name}.npy", mmap_mode="r") for name in ("data", "indices", "indptr")]
+        X = sp.csr_matrix(tuple(parts), shape=self.shape, copy=False)
+        Z = np.load(path / "dense.npy", mmap_mode="r") if self.dense else None
+        return X, Z
@@ -0,0 +1,389 @@
+# ingest.py
+# อ่านไฟล์เอกสาร (DOCX / PDF / CSV / Excel) แล้วตัดเป็น chunk สำหรับดัชนีค้นหา
+# แยกออกจาก app.py เพราะงานใน process pool ต้อง pickle ฟังก์ชันจากโมดูลที่ import ได้
+import io
+import os
+import re
+import csv
+import logging
+import multiprocessing as mp
+from pathlib import Path
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
+
+# pandas / python-docx / openpyxl / PyPDF2 import ในฟังก์ชันที่อ่านไฟล์ชนิดนั้น: เปิดแอปจาก snapshot
+# ของดัชนีไม่ต้องอ่านไฟล์เลย จึงไม่ต้องเสียเวลา import (pandas อย่างเดียวราวครึ่งวินาที)
+
+from bm25 import count_terms
+from dedup import signature
+
+log = logging.getLogger(__name__)
+
+DOC_EXTS     = {".docx"}
+TABULAR_EXTS = {".csv", ".xlsx", ".xls"}
+PDF_EXTS     = {".pdf"}
+
+KIND_LABELS = {"docx": "DOCX", "tabular": "TABLE", "pdf": "PDF"}
+
+# พารามิเตอร์การตัด chunk (เป็นส่วนหนึ่งของ fingerprint ของ snapshot ดัชนี)
+CHUNK_SIZE    = 900
+CHUNK_OVERLAP = 150
+
+# ตาราง: จำนวนแถวต่อก้อนที่อ่านจาก CSV, ความยาวค่าสูงสุดที่ทำดัชนีค้นหาแบบตรงตัว
+# และจำนวนแถวสูงสุดที่คืนต่อคำถาม (ค่าที่ตรงมากกว่านี้ถือว่าไม่เจาะจง)
+TABLE_READ_CHUNKSIZE = 2000
+TABLE_MAX_KEY_LEN    = 64
+TABLE_MAX_ROWS       = 20
+
+# จำนวน worker (0 = ตามจำนวน CPU, 1 = อ่านทีละไฟล์ในโปรเซสหลัก), เวลาสูงสุดต่อไฟล์
+# และ start method ของ multiprocessing — ค่าเริ่มต้นไม่ใช้ fork: collect_chunks ถูกเรียกจาก thread เบื้องหลัง
+# (engine-loader, index-refresher) ในเซิร์ฟเวอร์ที่มีหลาย thread → fork อาจได้ลูกที่ค้าง lock ที่ thread อื่น
+# ถืออยู่ตอน fork (เช่น lock ของ logging) แล้วไฟล์นั้นหมดเวลาเงียบ ๆ ได้ 0 chunk
+INGEST_WORKERS = int(os.environ.get("FTE_INGEST_WORKERS", "0")) or (os.cpu_count() or 1)
+INGEST_TIMEOUT = float(os.environ.get("FTE_INGEST_TIMEOUT", "120"))
+INGEST_START_METHOD = (os.environ.get("FTE_INGEST_START_METHOD")
+                       or ("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"))
+
+# =========================
+# FILE READERS PDF & Docx
+# =========================
+def iter_docx_paragraphs(docx_path: str) -> Iterator[str]:
+    import docx
+    try:
+        d = docx.Document(docx_path)
+    except Exception as e:
+        log.warning("Error reading Word file '%s': %s", docx_path, e)
+        return
+    for p in d.paragraphs:
+        if p.text.strip():
+            yield p.text
+
+def extract_text_from_docx(docx_path: str) -> str:
+    return "\n".join(iter_docx_paragraphs(docx_path))
+
+def iter_pdf_pages(pdf_path: str) -> Iterator[Tuple[int, str]]:
+    """yield (เลขหน้าเริ่มที่ 1, ข้อความ) ทีละหน้า — หน้าที่อ่านไม่ได้จะถูกข้ามแทนที่จะทิ้งทั้งไฟล์"""
+    from PyPDF2 import PdfReader
+    try:
+        reader = PdfReader(pdf_path)
+        pages = reader.pages
+    except Exception as e:
+        log.warning("Error reading PDF file '%s': %s", pdf_path, e)
+        return
+    for no, page in enumerate(pages, start=1):
+        try:
+            yield no, page.extract_text() or ""
+        except Exception as e:
+            log.warning("Error reading page %d of PDF file '%s': %s", no, pdf_path, e)
+
+def extract_pdf_page(pdf_path: str, page_no: int) -> str:
+    """อ่านซ้ำเฉพาะหน้าเดียว (เช่นเพื่ออ้างอิง/ตรวจสอบ chunk ที่มาจากหน้านั้น)"""
+    from PyPDF2 import PdfReader
+    try:
+        return PdfReader(pdf_path).pages[page_no - 1].extract_text() or ""
+    except Exception as e:
+        log.warning("Error reading page %d of PDF file '%s': %s", page_no, pdf_path, e)
+        return ""
+
+def extract_text_from_pdf(pdf_path: str) -> str:
+    return "\n".join(text for _, text in iter_pdf_pages(pdf_path))
+
+def _cell(v) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))  # 1010.0 → "1010" (รหัสวิชาที่ pandas/openpyxl อ่านเป็น float)
+    return str(v).strip()
+
+def iter_table_rows(path: str) -> Iterator[Tuple[str, List[str], List[str]]]:
+    """yield (ชื่อชีต, header, แถว) ทีละแถวโดยไม่โหลดทั้งตารางเข้าหน่วยความจำ
+
+    CSV อ่านเป็นก้อนละ TABLE_READ_CHUNKSIZE แถว, .xlsx ใช้ openpyxl แบบ read-only ทุกชีต
+    """
+    suffix = Path(path).suffix.lower()
+    try:
+        if suffix == ".csv":
+            import pandas as pd
+            reader = pd.read_csv(path, engine="python", encoding_errors="ignore", dtype=str,
+                                 keep_default_na=False, chunksize=TABLE_READ_CHUNKSIZE)
+            for df in reader:
+                header = [_cell(c) for c in df.columns]
+                for row in df.itertuples(index=False, name=None):
+                    yield "", header, [_cell(v) for v in row]
+        elif suffix == ".xlsx":
+            import openpyxl
+            wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+            try:
+                for ws in wb.worksheets:
+                    header = None
+                    for row in ws.iter_rows(values_only=True):
+                        cells = [_cell(v) for v in row]
+                        if not any(cells):
+                            continue
+                        if header is None:
+                            header = cells
+                            continue
+                        yield ws.title, header, cells
+            finally:
+                wb.close()
+        else:
+            # .xls (รูปแบบเก่า) openpyxl อ่านไม่ได้ → ใช้ pandas ทั้งชีต
+            import pandas as pd
+            for sheet, df in pd.read_excel(path, sheet_name=None, dtype=str).items():
+                header = [_cell(c) for c in df.columns]
+                for row in df.fillna("").itertuples(index=False, name=None):
+                    yield str(sheet), header, [_cell(v) for v in row]
+    except Exception as e:
+        log.warning("Error reading table file '%s': %s", path, e)
+
+def _csv_line(cells: List[str]) -> str:
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="").writerow(cells)
+    return buf.getvalue()
+
+def chunk_table_rows(rows: Iterable[Tuple[str, List[str], List[str]]],
+                     size: int = CHUNK_SIZE) -> Iterator[Dict]:
+    """รวมแถวเป็น chunk (header + แถวเต็ม ๆ) ไม่เกิน size ตัวอักษร — ไม่ตัดกลางแถว
+
+    แถวที่ยาวเกิน size จะได้ chunk ของตัวเอง ข้อความของ chunk เป็น CSV ที่ parse กลับได้
+    """
+    sheet, header_line, lines, first = None, "", [], 0
+    row_no = 0
+
+    def _flush():
+        text = header_line + "\n" + "\n".join(lines)
+        return {"text": text, "sheet": sheet, "row": first, "row_end": row_no}
+
+    for row_sheet, header, cells in rows:
+        if not any(cells):
+            continue
+        line = _csv_line(cells[:len(header)] if len(cells) > len(header) else cells)
+        if row_sheet != sheet or (lines and len(header_line) + sum(len(l) + 1 for l in lines) + len(line) + 1 > size):
+            if lines:
+                yield _flush()
+            if row_sheet != sheet:
+                row_no = 0
+            sheet, header_line, lines, first = row_sheet, _csv_line(header), [], row_no + 1
+        row_no += 1
+        lines.append(line)
+    if lines:
+        yield _flush()
+
+# =========================
+# DISCOVER FILES (RECURSIVE)
+# =========================
+def rglob_many(root: Path, exts: Iterable[str]) -> list[Path]:
+    exts_low = {e.lower() for e in exts}
+    # เพิ่มเงื่อนไข .name.startswith("~$") เพื่อละเว้นไฟล์ชั่วคราว
+    return [p for p in root.rglob("*") if p.is_file() and p.suffix.lower() in exts_low and not p.name.startswith("~$")]
+
+def discover_all_files(base_dir: str) -> dict:
+    # ไม่ cache: ตัว refresher ต้องเห็นไฟล์ที่อัปโหลดเพิ่มระหว่างที่แอปทำงาน
+    root = Path(base_dir)
+    found_docx  = rglob_many(root, DOC_EXTS)
+    found_tab   = rglob_many(root, TABULAR_EXTS)
+    found_pdf   = rglob_many(root, PDF_EXTS)
+
+    # ไฟล์ข้อมูลหลักอยู่ใต้ root อยู่แล้ว (rglob เจอแล้ว) → เพิ่มเฉพาะเมื่อยังไม่อยู่ในรายการ
+    dataset_file = root / "workaw" / "Data คำตอบ  ครุล่าสุด.docx"
+    if dataset_file.exists() and dataset_file not in found_docx:
+        found_docx.append(dataset_file)
+    return {"docx": sorted(found_docx), "tabular": sorted(found_tab), "pdf": sorted(found_pdf)}
+
+# =========================
+# CHUNKING
+# =========================
+def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    text = (text or "").strip()
+    if not text:
+        return []
+    chunks, i, n = [], 0, len(text)
+    while i < n:
+        j = min(i + size, n)
+        chunks.append(text[i:j])
+        i = j - overlap if j - overlap > i else j
+    return [c for c in chunks if c.strip()]
+
+def chunk_segments(segments: Iterable[Tuple[Optional[int], str]],
+                   size: int = CHUNK_SIZE,
+                   overlap: int = CHUNK_OVERLAP) -> Iterator[Tuple[str, Optional[int], Optional[int]]]:
+    """ตัด chunk แบบสตรีมจาก (เลขหน้า, ข้อความ) ทีละส่วน → yield (chunk, หน้าแรก, หน้าสุดท้าย)
+
+    ใช้หน่วยความจำไม่เกินราว size + ความยาวของส่วนที่ยาวที่สุด ไม่ว่าเอกสารจะยาวแค่ไหน
+    ขนาด/overlap ของ chunk เหมือน chunk_text
+    """
+    step = size - overlap if size > overlap else size
+    buf = ""
+    marks: List[Tuple[int, Optional[int]]] = []  # (offset ใน buf ที่ส่วนนั้นเริ่ม, เลขหน้า)
+    emitted = False
+
+    def _pages(end: int) -> Tuple[Optional[int], Optional[int]]:
+        covered = [page for off, page in marks if off < end] or [marks[-1][1]]
+        return covered[0], covered[-1]
+
+    for page, text in segments:
+        if not buf:
+            text = text.lstrip()
+            if not text:
+                continue
+        else:
+            buf += "\n"
+        marks.append((len(buf), page))
+        buf += text
+        while len(buf) > size:
+            chunk = buf[:size]
+            if chunk.strip():
+                yield (chunk, *_pages(size))
+                emitted = True
+            buf = buf[step:]
+            shifted = [(off - step, p) for off, p in marks]
+            # คง mark สุดท้ายที่เริ่มก่อนต้น buffer ไว้ (ส่วนนั้นยังต่อเนื่องอยู่ใน buffer)
+            first = max((k for k, (off, _) in enumerate(shifted) if off <= 0), default=0)
+            marks = [(max(off, 0), p) for off, p in shifted[first:]]
+
+    buf = buf.rstrip()
+    # ส่วนท้ายที่เป็นแค่ overlap ของ chunk ก่อนหน้าไม่ต้อง yield ซ้ำ
+    if buf.strip() and not (emitted and len(buf) <= overlap):
+        yield (buf, *_pages(len(buf)))
+
+def extract_file_chunks(path: Path, kind: str) -> List[Dict]:
+    label = KIND_LABELS[kind]
+    if kind == "pdf":
+        rows = []
+        for text, first, last in chunk_segments(iter_pdf_pages(str(path))):
+            rows.append({"source": path.name, "kind": label, "text": text, "page": first, "page_end": last})
+        return rows
+    if kind == "docx":
+        segments = ((None, para) for para in iter_docx_paragraphs(str(path)))
+        return [{"source": path.name, "kind": label, "text": text} for text, _, _ in chunk_segments(segments)]
+    rows = []
+    for part in chunk_table_rows(iter_table_rows(str(path))):
+        rows.append({"source": path.name, "kind": label, **part})
+    return rows
+
+def format_source(seg: Dict) -> str:
+    """หัวข้อของ block บริบท เช่น [PDF] คู่มือ.pdf หน้า 3-4"""
+    label = f"[{seg['kind']}] {seg['source']}"
+    if seg.get("sheet"):
+        label += f" ชีต {seg['sheet']}"
+    if seg.get("row") is not None:
+        return f"{label} แถว {seg['row']}-{seg['row_end']}"
+    page = seg.get("page")
+    if page is None:
+        return label
+    end = seg.get("page_end") or page
+    return f"{label} หน้า {page}" if end == page else f"{label} หน้า {page}-{end}"
+
+def _extract_safe(path: str, kind: str) -> Optional[List[Dict]]:
+    # รันใน worker: ไฟล์เสียไฟล์เดียวต้องไม่ทำให้ทั้ง build ล้ม (None = ล้มเหลว ต่างจากไฟล์ว่าง [])
+    try:
+        rows = extract_file_chunks(Path(path), kind)
+        for r in rows:
+            r["terms"] = count_terms(r["text"])  # ตัดคำใน worker ไปพร้อมกัน
+            r["dedup"] = signature(r["text"])     # digest + MinHash สำหรับตัด chunk ซ้ำตอนประกอบดัชนี
+        return rows
+    except Exception as e:
+        log.warning("Error ingesting '%s': %s", path, e)
+        return None
+
+# =========================
+# TABLE ROW LOOKUP (เช่น รหัสวิชา → แถวในตาราง)
+# =========================
+def _norm_value(v: str) -> str:
+    return " ".join(v.casefold().split())
+
+class TableIndex:
+    """ดัชนีค่าในเซลล์ → แถวของตาราง สร้างจาก chunk ประเภท TABLE
+
+    เก็บเพียงตำแหน่ง (chunk, ลำดับแถวใน chunk, คอลัมน์) เนื้อหาแถวอ่านจากข้อความ CSV ของ chunk
+    """
+
+    def __init__(self, chunks: List[Dict]):
+        self.values: Dict[str, List[Tuple[int, int, str]]] = {}
+        for ci, seg in enumerate(chunks):
+            if seg.get("kind") != KIND_LABELS["tabular"]:
+                continue
+            header, *rows = csv.reader(io.StringIO(seg["text"]))
+            for ri, row in enumerate(rows):
+                for col, v in zip(header, row):
+                    key = _norm_value(v)
+                    if 2 <= len(key) <= TABLE_MAX_KEY_LEN:
+                        self.values.setdefault(key, []).append((ci, ri, col))
+
+    def lookup(self, value: str, column: Optional[str] = None) -> List[Tuple[int, int]]:
+        """ค่า (และคอลัมน์ถ้าระบุ) → [(chunk index, ลำดับแถวใน chunk)]"""
+        hits = self.values.get(_norm_value(value), [])
+        return [(ci, ri) for ci, ri, col in hits if column is None or col == column]
+
+    def match_query(self, query: str, max_rows: int = TABLE_MAX_ROWS) -> List[Tuple[int, int]]:
+        # รหัส/ตัวเลข/คำที่คั่นด้วยช่องว่างในคำถาม; ข้ามค่าที่ซ้ำในหลายแถวเกินไป (ไม่เจาะจง)
+        terms = re.findall(r"[0-9A-Za-z][0-9A-Za-z\-_./]{2,}", query) + query.split() + [query]
+        out, seen = [], set()
+        for term in terms:
+            hits = self.lookup(term)
+            if not hits or len(hits) > max_rows:
+                continue
+            for hit in hits:
+                if hit not in seen:
+                    seen.add(hit)
+                    out.append(hit)
+        return out[:max_rows]
+
+    def format_rows(self, hits: List[Tuple[int, int]], chunks: List[Dict]) -> List[str]:
+        """รวมแถวที่ตรงกันเป็น block ละ chunk: หัวข้อ + header + เฉพาะแถวที่ตรง"""
+        by_chunk: Dict[int, List[int]] = {}
+        for ci, ri in hits:
+            by_chunk.setdefault(ci, []).append(ri)
+        blocks = []
+        for ci, ris in by_chunk.items():
+            seg = chunks[ci]
+            header, *rows = csv.reader(io.StringIO(seg["text"]))
+            lines = [_csv_line(header)] + [_csv_line(rows[ri]) for ri in sorted(set(ris))]
+            title = f"[{seg['kind']}] {seg['source']}" + (f" ชีต {seg['sheet']}" if seg.get("sheet") else "")
+            blocks.append(f"{title} (แถวที่ตรงกับคำถาม)\n" + "\n".join(lines) + "\n")
+        return blocks
+
+# =========================
+# PARALLEL COLLECT
+# =========================
+def collect_chunks(files: Iterable[Tuple[Path, str]],
+                   workers: Optional[int] = None,
+                   timeout: float = INGEST_TIMEOUT) -> List[Optional[List[Dict]]]:
+    """อ่าน + ตัด chunk ทีละไฟล์ คืน list ของ chunk ต่อไฟล์ตามลำดับ input เสมอ
+
+    ไฟล์ที่ parser ล้ม, worker ตาย หรือใช้เวลาเกิน timeout จะได้ None (ผู้เรียกควรลองใหม่ภายหลัง)
+    ไม่ใช่ [] ซึ่งหมายถึงไฟล์ที่อ่านได้แต่ไม่มีข้อความ
+    เมื่อมีไฟล์ค้าง pool จะถูก terminate แล้วไฟล์ที่ยังไม่เสร็จถูกส่งเข้า pool ใหม่
+    """
+    files = [(Path(p), kind) for p, kind in files]
+    results: List[Optional[List[Dict]]] = [None for _ in files]
+    workers = min(workers or INGEST_WORKERS, len(files))
+    if workers <= 1:
+        for i, (p, kind) in enumerate(files):
+            results[i] = _extract_safe(str(p), kind)
+        return results
+
+    ctx = mp.get_context(INGEST_START_METHOD)
+    todo = list(range(len(files)))
+    while todo:
+        pool = ctx.Pool(min(workers, len(todo)))
+        try:
+            pending = [(i, pool.apply_async(_extract_safe, (str(files[i][0]), files[i][1]))) for i in todo]
+            todo = []
+            for pos, (i, res) in enumerate(pending):
+                try:
+                    results[i] = res.get(timeout=timeout)
+                except mp.TimeoutError:
+                    log.warning("Timed out ingesting '%s' after %.0fs", files[i][0], timeout)
+                    # worker ค้างอยู่กับไฟล์นี้: เก็บผลที่เสร็จแล้ว ที่เหลือไปรอบ pool ใหม่
+                    for j, other in pending[pos + 1:]:
+                        if other.ready():
+                            results[j] = other.get() if other.successful() else None
+                        else:
+                            todo.append(j)
+                    break
+                except Exception as e:
+                    log.warning("Worker failed on '%s': %s", files[i][0], e)
+        finally:
+            pool.terminate()
+            pool.join()
+    return results
@@ -0,0 +1,171 @@
+# prefixcache.py
+# cache ส่วนต้นของ prompt ที่ไม่เปลี่ยนระหว่างเทิร์น (system instruction = PROMPT_FTE) ไว้ฝั่งผู้ให้บริการโมเดล
+# ลงทะเบียนครั้งเดียวต่อโมเดลแล้วอ้างอิงด้วย handle แทนการส่ง prefix เต็มทุกคำขอ
+# - key = (โมเดล, hash ของ prefix): prefix คือ PROMPT_FTE เท่านั้น (บริบทจากดัชนีอยู่ในคำขอแต่ละครั้ง)
+#   ดัชนีเปลี่ยนจึงไม่ต้องสร้างใหม่; PROMPT_FTE เปลี่ยน → key ใหม่ สร้าง handle ใหม่และลบ handle เก่าของโมเดลนั้นทิ้ง
+# - ใกล้หมดอายุ → คืน handle เดิมไปก่อนแล้วสร้างใหม่ใน thread เบื้องหลัง (คำขอไม่ต้องรอ create)
+#   มีแค่คำขอแรกของแต่ละโมเดลที่รอ create
+# - ที่เก็บฝั่งผู้ให้บริการเสียบเปลี่ยนได้: GeminiPrefixStore (CachedContent) หรือ LocalPrefixStore (ทดสอบ/stub)
+# - สร้างไม่ได้ (เช่น prefix สั้นกว่าขั้นต่ำของโมเดล) → จำไว้ช่วงหนึ่งแล้วใช้แบบไม่ cache ไม่ลองซ้ำทุกเทิร์น
+import os
+import time
+import hashlib
+import threading
+from datetime import timedelta
+from typing import Dict, Optional, Tuple
+
+PREFIX_CACHE_ENABLED = os.environ.get("FTE_PREFIX_CACHE", "1") != "0"
+# อายุของ handle ฝั่งผู้ให้บริการ (วินาที), สร้างใหม่ก่อนหมดอายุเท่านี้ และเวลาพักหลังสร้างไม่สำเร็จ
+PREFIX_CACHE_TTL = float(os.environ.get("FTE_PREFIX_CACHE_TTL", "3600"))
+PREFIX_REFRESH_MARGIN = 300.0
+PREFIX_RETRY_SECONDS = 600.0
+
+class PrefixStore:
+    """ที่เก็บ prefix ฝั่งผู้ให้บริการ: create คืน handle ที่ใช้อ้างอิงในคำขอ, delete คืนพื้นที่"""
+
+    def create(self, model_name: str, system_instruction: str, ttl: float) -> str:
+        raise NotImplementedError
+
+    def delete(self, handle: str) -> None:
+        raise NotImplementedError
+
+class GeminiPrefixStore(PrefixStore):
+    def __init__(self, genai):
+        self._caching = genai.caching
+
+    def create(self, model_name: str, system_instruction: str, ttl: float) -> str:
+        cached = self._caching.CachedContent.create(model=f"models/{model_name}", display_name="fte-prefix",
+                                                    system_instruction=system_instruction,
+                                                    ttl=timedelta(seconds=ttl))
+        return cached.name
+
+    def delete(self, handle: str) -> None:
+        self._caching.CachedContent.get(handle).delete()
+
+class LocalPrefixStore(PrefixStore):
+    """แทนผู้ให้บริการในโปรเซส (StubBackend/ทดสอบ): นับจำนวนครั้งที่สร้าง/ลบได้"""
+
+    def __init__(self, min_chars: int = 0):
+        self.min_chars = min_chars
+        self.handles: Dict[str, Tuple[str, str]] = {}  # handle → (โมเดล, prefix)
+        self.created = self.deleted = 0
+        self._lock = threading.Lock()
+
+    def create(self, model_name: str, system_instruction: str, ttl: float) -> str:
+        if len(system_instruction) < self.min_chars:
+            raise ValueError("400 cached content is too small")
+        with self._lock:
+            self.created += 1
+            handle = f"cachedContents/local-{self.created}"
+            self.handles[handle] = (model_name, system_instruction)
+        return handle
+
+    def delete(self, handle: str) -> None:
+        with self._lock:
+            if self.handles.pop(handle, None) is not None:
+                self.deleted += 1
+
+    def text(self, handle: str) -> Optional[str]:
+        entry = self.handles.get(handle)
+        return entry[1] if entry else None
+
+def prefix_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+class PrefixCache:
+    """(โมเดล, prefix) → handle ที่ยังไม่หมดอายุ — thread-safe, สร้างครั้งเดียวต่อ key แม้เรียกพร้อมกัน"""
+
+    def __init__(self, store: PrefixStore, ttl: float = PREFIX_CACHE_TTL, clock=time.monotonic):
+        self.store, self.ttl = store, ttl
+        self._clock = clock
+        self._entries: Dict[Tuple[str, str], Tuple[Optional[str], float]] = {}  # key → (handle | None, หมดอายุ)
+        self._key_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = self.creates = self.failures = 0
+
+    def get(self, model_name: str, system_instruction: str) -> Optional[str]:
+        """handle สำหรับ prefix นี้ หรือ None = ส่ง prefix เต็มแบบเดิม"""
+        key = (model_name, prefix_digest(system_instruction))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._fresh(entry):
+                if entry[0] is not None:
+                    self.hits += 1
+                return entry[0]
+            if entry is not None and entry[0] is not None and entry[1] > self._clock():
+                # ยังใช้ได้แต่ใกล้หมดอายุ: ใช้ต่อ แล้วสร้างใหม่เบื้องหลังครั้งเดียว
+                self.hits += 1
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._create, args=(key, model_name, system_instruction),
+                                     name="prefix-refresh", daemon=True).start()
+                return entry[0]
+        return self._create(key, model_name, system_instruction)
+
+    def _create(self, key: Tuple[str, str], model_name: str, system_instruction: str) -> Optional[str]:
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:  # คำขอพร้อมกันของ key เดียวกันรอผู้สร้างคนแรก
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and self._fresh(entry):
+                    self._refreshing.discard(key)
+                    return entry[0]
+            try:
+                handle = self.store.create(model_name, system_instruction, self.ttl)
+                entry = (handle, self._clock() + self.ttl)
+            except Exception:
+                handle, entry = None, (None, self._clock() + PREFIX_RETRY_SECONDS)
+            with self._lock:
+                if handle is None:
+                    self.failures += 1
+                    previous = self._entries.get(key)
+                    if previous is not None and previous[0] is not None and previous[1] > self._clock():
+                        # refresh ล้ม: ใช้ handle เดิมจนหมดอายุ ไม่ลองเบื้องหลังซ้ำ (คง key ไว้ใน _refreshing)
+                        return previous[0]
+                else:
+                    self.creates += 1
+                self._refreshing.discard(key)
+                # handle เดิมของ key นี้ปล่อยหมดอายุเอง (คำขอที่กำลังใช้อยู่ไม่พัง); prefix อื่นของโมเดลนี้ลบทิ้ง
+                stale = [k for k in self._entries if k[0] == model_name and k != key]
+                old = [self._entries.pop(k)[0] for k in stale]
+                for k in stale:
+                    self._key_locks.pop(k, None)
+                self._entries[key] = entry
+        for h in old:
+            self._delete(h)
+        return handle
+
+    def _fresh(self, entry: Tuple[Optional[str], float]) -> bool:
+        handle, expires = entry
+        margin = PREFIX_REFRESH_MARGIN if handle is not None else 0.0
+        return expires - self._clock() > margin
+
+    def _delete(self, handle: Optional[str]) -> None:
+        if handle is None:
+            return
+        try:
+            self.store.delete(handle)
+        except Exception:
+            pass  # ลบไม่ได้ก็หมดอายุเองตาม TTL
+
+    def invalidate(self, model_name: str, handle: str) -> None:
+        """handle ใช้ไม่ได้แล้ว (เช่น หมดอายุ/ถูกลบฝั่งผู้ให้บริการก่อนกำหนด) → คำขอถัดไปสร้างใหม่"""
+        with self._lock:
+            for k in [k for k, (h, _) in self._entries.items() if k[0] == model_name and h == handle]:
+                del self._entries[k]
+        self._delete(handle)
+
+    def clear(self) -> None:
+        with self._lock:
+            handles = [h for h, _ in self._entries.values()]
+            self._entries.clear()
+            self._key_locks.clear()
+        for h in handles:
+            self._delete(h)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"handles": sum(1 for h, _ in self._entries.values() if h is not None),
+                    "hits": self.hits, "creates": self.creates, "failures": self.failures}
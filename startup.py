@@ -0,0 +1,67 @@
+# startup.py
+# เปิดแอปแบบเป็นขั้น: หน้าแชทและประวัติแสดงทันที ส่วน import ไลบรารีหนัก + โหลด/สร้างดัชนีทำใน thread เบื้องหลัง
+# โมดูลนี้ import เฉพาะ stdlib (app.py import ก่อนวาดหน้าแรก) — ของหนักอยู่ในฟังก์ชัน build ที่ผู้เรียกส่งมา
+import os
+import time
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+# ≈ เวลาเริ่มโปรเซส: Streamlit import โมดูลนี้ใน rerun แรกของ session แรก
+PROCESS_STARTED = time.perf_counter()
+# คำถามที่มาก่อนดัชนีพร้อม: รอในคิวได้นานสุดเท่านี้ (วินาที) ก่อนตอบแบบ degraded
+STARTUP_WAIT_SECONDS = float(os.environ.get("FTE_STARTUP_WAIT", "90"))
+
+STARTING, IMPORTING, INDEXING, READY, FAILED = "starting", "importing", "indexing", "ready", "failed"
+
+class EngineLoader:
+    """สร้าง engine ใน thread เบื้องหลังหนึ่งครั้งต่อโปรเซส; อ่าน stage / timings ได้จากทุก thread
+
+    build(stage) คืน engine และเรียก stage(ชื่อขั้น) เมื่อเริ่มแต่ละขั้น → เวลาของแต่ละขั้นอยู่ใน timings
+    ("<ขั้น>_s") พร้อม "ready_s" = เวลาตั้งแต่เริ่มโปรเซสจนพร้อมตอบ (cold start)
+    """
+
+    def __init__(self, build: Callable[[Callable[[str], None]], object], started: float = PROCESS_STARTED):
+        self.stage = STARTING
+        self.engine = None
+        self.error: Optional[Exception] = None
+        self.timings: Dict[str, float] = {}
+        self._build, self._started = build, started
+        self._stage_at = time.perf_counter()
+        self._done = threading.Event()
+        threading.Thread(target=self._run, name="engine-loader", daemon=True).start()
+
+    def _enter(self, stage: str) -> None:
+        now = time.perf_counter()
+        if self.stage not in (STARTING, READY, FAILED):
+            self.timings[f"{self.stage}_s"] = round(now - self._stage_at, 3)
+        self.stage, self._stage_at = stage, now
+
+    def _run(self) -> None:
+        try:
+            engine = self._build(self._enter)
+            self.engine = engine
+            self._enter(READY)
+            self.timings["ready_s"] = round(time.perf_counter() - self._started, 3)
+            log.info("engine ready: %s", self.timings)
+        except Exception as e:  # ต้องรายงานทุกอย่าง ไม่งั้นคำถามที่รออยู่ค้างจนหมดเวลา
+            self.error = e
+            self._enter(FAILED)
+            log.exception("engine startup failed")
+        finally:
+            self._done.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.stage == READY
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """รอจน build จบ (สำเร็จหรือล้มเหลว) หรือหมดเวลา → พร้อมใช้หรือไม่"""
+        self._done.wait(timeout)
+        return self.ready
+
+    def mark(self, name: str) -> None:
+        """บันทึกเหตุการณ์ครั้งแรก (เช่น first paint ของหน้าแชท) เป็นเวลานับจากเริ่มโปรเซส"""
+        self.timings.setdefault(name, round(time.perf_counter() - self._started, 3))
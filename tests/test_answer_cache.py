@@ -0,0 +1,27 @@
+from engine import AnswerCache
+
+def _cache():
+    return AnswerCache(max_entries=8, ttl=3600, threshold=0.9)
+
+def test_exact_after_normalize():
+    cache = _cache()
+    cache.put("ค่าเทอม เท่าไหร่ครับ", "A", "fp")
+    assert cache.get("ค่าเทอมเท่าไหร่คะ", "fp") == "A"
+
+def test_numbers_must_match():
+    cache = _cache()
+    cache.put("ค่าเทอมปี 1 เท่าไหร่", "ปี 1", "fp")
+    assert cache.get("ค่าเทอมปี 2 เท่าไหร่", "fp") is None
+    cache.put("วิชา FTE1 คืออะไร", "FTE1", "fp")
+    assert cache.get("วิชา FTE2 คืออะไร", "fp") is None
+
+def test_near_duplicate_hit():
+    cache = AnswerCache(max_entries=8, ttl=3600, threshold=0.7)
+    cache.put("ค่าเทอมเท่าไหร่", "A", "fp")
+    assert cache.get("ค่าเทอมเท่าไร", "fp") == "A"
+    assert cache.get("ฝึกงานกี่ชั่วโมง", "fp") is None
+
+def test_fingerprint_change_clears():
+    cache = _cache()
+    cache.put("ค่าเทอมเท่าไหร่", "A", "fp1")
+    assert cache.get("ค่าเทอมเท่าไหร่", "fp2") is None
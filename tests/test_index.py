@@ -0,0 +1,172 @@
+import re
+import random
+
+import pytest
+
+import engine
+from dedup import DEDUP_PERMUTATIONS, Deduper, signature
+from engine import BASE_DIR, discover_all_files, retrieve_context, update_index
+from ingest import collect_chunks
+
+def _build(root, state=None):
+    return update_index(state, discover_all_files(str(root)), root)
+
+def _write_csv(path, rows):
+    path.write_text("วิชา,ชื่อ\n" + "".join(f"{a},{b}\n" for a, b in rows), encoding="utf-8")
+
+# ---------- update_index: ว่าง / เพิ่ม / ลบไฟล์ ----------
+def test_empty_corpus(tmp_path):
+    state = _build(tmp_path)
+    assert len(state.chunks) == 0
+    assert state.signatures.shape == (0, DEDUP_PERMUTATIONS)
+    assert retrieve_context(state, "ค่าเทอมเท่าไหร่") == ("", [])
+
+def test_incremental_add_and_remove(tmp_path):
+    _write_csv(tmp_path / "a.csv", [("FTE1", "คณิต")])
+    state = _build(tmp_path)
+    assert set(state.row_ranges) == {"a.csv"}
+
+    _write_csv(tmp_path / "b.csv", [("FTE2", "ฟิสิกส์")])
+    state = _build(tmp_path, state)
+    assert set(state.row_ranges) == {"a.csv", "b.csv"}
+    assert "FTE2" in retrieve_context(state, "FTE2")[0]
+
+    (tmp_path / "a.csv").unlink()
+    state = _build(tmp_path, state)
+    assert set(state.row_ranges) == {"b.csv"}
+    assert all("FTE1" not in t for t in state.chunks.texts())
+
+    (tmp_path / "b.csv").unlink()
+    state = _build(tmp_path, state)  # ลบไฟล์สุดท้าย → ดัชนีว่าง ไม่ใช่ exception (refresher จะค้างที่ state เดิม)
+    assert len(state.chunks) == 0 and state.X.shape[0] == 0
+
+def test_collect_failure_is_not_empty(tmp_path):
+    path = tmp_path / "empty.csv"
+    path.write_text("วิชา,ชื่อ\n", encoding="utf-8")
+    assert collect_chunks([(path, "tabular"), (path, "unknown-kind")], workers=1) == [[], None]
+
+def _failing_collect(monkeypatch, failing):
+    real = engine.collect_chunks
+
+    def collect(files, *args, **kw):
+        files = list(files)
+        results = real(files, *args, **kw)
+        return [None if p.name in failing else rows for (p, _), rows in zip(files, results)]
+    monkeypatch.setattr(engine, "collect_chunks", collect)
+
+def test_failed_extraction_is_retried(tmp_path, monkeypatch):
+    _write_csv(tmp_path / "a.csv", [("FTE1", "คณิต")])
+    _write_csv(tmp_path / "b.csv", [("FTE2", "ฟิสิกส์")])
+    _failing_collect(monkeypatch, {"a.csv"})
+    state = _build(tmp_path)
+    assert state.failed == ("a.csv",) and "a.csv" not in state.row_ranges  # ไม่ใช่ไฟล์ว่าง 0 chunk
+    assert _build(tmp_path, state).failed == ("a.csv",)  # ยังล้ม → ลองทุกรอบ ไม่ early return
+
+    monkeypatch.undo()
+    state = _build(tmp_path, state)
+    assert state.failed == () and state.chunk_counts() == {"a.csv": 1, "b.csv": 1}
+    assert "FTE1" in retrieve_context(state, "FTE1")[0]
+    assert _build(tmp_path, state) is state
+
+def test_failed_reextract_keeps_old_rows(tmp_path, monkeypatch):
+    _write_csv(tmp_path / "a.csv", [("FTE1", "คณิต")])
+    state = _build(tmp_path)
+    fingerprint = state.fingerprint
+    _write_csv(tmp_path / "a.csv", [("FTE1", "คณิต"), ("FTE9", "ชีววิทยา")])
+    _failing_collect(monkeypatch, {"a.csv"})
+    state = _build(tmp_path, state)
+    assert state.failed == ("a.csv",) and state.fingerprint != fingerprint
+    assert "FTE1" in retrieve_context(state, "FTE1")[0]  # แถวเดิมยังตอบได้ระหว่างรอลองใหม่
+
+    monkeypatch.undo()
+    state = _build(tmp_path, state)
+    assert state.failed == () and "FTE9" in retrieve_context(state, "FTE9")[0]
+
+def test_removed_original_restores_duplicate(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "DEDUP_ENABLED", True)
+    rows = [(f"FTE{i}", f"วิชาที่ {i}") for i in range(5)]
+    _write_csv(tmp_path / "a.csv", rows)
+    _write_csv(tmp_path / "b.csv", rows)
+    state = _build(tmp_path)
+    assert state.row_ranges["b.csv"][0] == state.row_ranges["b.csv"][1]  # ซ้ำตรงตัวกับ a.csv
+    assert state.file_drops["b.csv"]
+
+    (tmp_path / "a.csv").unlink()
+    state = _build(tmp_path, state)  # ต้นฉบับหาย → b.csv ถูกอ่านใหม่และเก็บไว้
+    start, end = state.row_ranges["b.csv"]
+    assert end > start and not state.file_drops["b.csv"]
+
+def test_matched_rows_not_repeated(tmp_path):
+    _write_csv(tmp_path / "a.csv", [("FTE1", "คณิต"), ("FTE2", "ฟิสิกส์"), ("FTE3", "เคมี")])
+    state = _build(tmp_path)
+    context, hits = retrieve_context(state, "วิชา FTE1 คืออะไร")
+    assert context.count("FTE1,คณิต") == 1
+    assert "FTE2" not in context  # แถวอื่นของ chunk เดียวกันไม่ถูกส่งมาด้วย
+    context, _ = retrieve_context(state, "วิชา FTE1 คืออะไร", carry=[i for i, _ in hits])
+    assert context.count("FTE1,คณิต") == 1
+
+# ---------- Deduper ----------
+def _text(rng, n=300):
+    return "".join(rng.choice("กขคงจฉชซฌญฎฏฐฑฒณดตถทธนบปผพฟภมยรลวศษสหฬอฮ") for _ in range(n))
+
+def _deduper(texts, groups):
+    dd = Deduper(lambda i: texts[i])
+    for text, group in zip(texts, groups):
+        dd.add(*signature(text), group)
+    return dd
+
+def test_near_duplicate_needs_one_location():
+    rng = random.Random(7)
+    part1, filler, part2 = _text(rng), _text(rng), _text(rng)
+    new = part1 + part2
+    # สองส่วนอยู่คนละที่ในไฟล์ a (แม่แบบเดียวกันที่กระจายอยู่) → ไม่นับว่าซ้ำ
+    dd = _deduper([part1, filler, part2], ["a", "a", "a"])
+    assert dd.find(new, *signature(new), "b") is None
+    # chunk ติดกันในไฟล์ a (ตัดคนละตำแหน่งกับไฟล์ b) → ซ้ำ
+    dd = _deduper([part1, part2], ["a", "a"])
+    assert dd.find(new, *signature(new), "b") in (0, 1)
+
+def test_within_file_only_exact():
+    rng = random.Random(11)
+    base = _text(rng)
+    near = base[:-5] + "ผผผผผ"
+    dd = _deduper([base], ["a"])
+    assert dd.find(near, *signature(near), "a") is None
+    assert dd.find(near, *signature(near), "b") == 0
+    assert dd.find(base, *signature(base), "a") == 0
+
+# ---------- เอกสารที่มากับ repo ----------
+_MARKER_RE = re.compile(r"^(?:[\d.]+|[ก-ฮa-z]\)|[-•])+")
+
+def _lines(text):
+    # ตัดช่องว่างและเลขข้อ/ตัวนำรายการ: DOCX ใช้เลขอัตโนมัติที่ไม่อยู่ในข้อความ ส่วน PDF พิมพ์ไว้
+    out = (_MARKER_RE.sub("", re.sub(r"\s+", "", line)) for line in text.splitlines())
+    return [line for line in out if len(line) >= 20]
+
+@pytest.fixture(scope="module")
+def bundled():
+    found = discover_all_files(str(BASE_DIR))
+    if not any(found.values()):
+        pytest.skip("ไม่มีเอกสารใน repo")
+    enabled = engine.DEDUP_ENABLED
+    try:
+        engine.DEDUP_ENABLED = True
+        deduped = update_index(None, found)
+        engine.DEDUP_ENABLED = False
+        full = update_index(None, found)
+    finally:
+        engine.DEDUP_ENABLED = enabled
+    return deduped, full
+
+def test_bundled_dedup_keeps_unique_text(bundled):
+    deduped, full = bundled
+    kept = re.sub(r"\s+", "", "".join(deduped.chunks.texts()))
+    lost = [line for text in full.chunks.texts() for line in _lines(text) if line not in kept]
+    assert not lost, lost[:5]
+    assert len(deduped.chunks) < len(full.chunks)  # PDF ฉบับเดียวกับ DOCX ยังถูกตัด
+
+def test_bundled_department_rules(bundled):
+    deduped, _ = bundled
+    context, _ = retrieve_context(deduped, "เกณฑ์คะแนนรอบ Admission ภาควิชาครุศาสตร์โยธา")
+    assert "ภาควิชาครุศาสตร์โยธา รอบAdmission" in context
+    assert "ไม่รับผู้สมัครที่จบจาก รร. หลักสูตรอาชีวะ" in context
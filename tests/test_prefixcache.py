@@ -0,0 +1,189 @@
+import threading
+import time
+
+import pytest
+
+from engine import PROMPT_FTE, GeminiBackend
+from prefixcache import (PREFIX_REFRESH_MARGIN, PREFIX_RETRY_SECONDS, LocalPrefixStore, PrefixCache,
+                         prefix_digest)
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class SlowStore(LocalPrefixStore):
+    """create ช้า + ล้มได้ตามสั่ง เพื่อให้คำขอพร้อมกันชนกันจริง"""
+
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.delay, self.fail = delay, False
+
+    def create(self, model_name, system_instruction, ttl):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("503 unavailable")
+        return super().create(model_name, system_instruction, ttl)
+
+def _cache(store=None, clock=None, ttl=3600):
+    return PrefixCache(store if store is not None else LocalPrefixStore(), ttl=ttl, clock=clock or Clock())
+
+def _wait_refresh(cache):
+    for _ in range(200):
+        if not cache._refreshing:
+            return
+        time.sleep(0.01)
+    raise AssertionError("refresh ไม่จบ")
+
+# ---------- PrefixCache ----------
+def test_concurrent_first_use_creates_once():
+    store = SlowStore(delay=0.05)
+    cache = _cache(store)
+    handles = []
+    threads = [threading.Thread(target=lambda: handles.append(cache.get("m", "prefix"))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert store.created == 1
+    assert len(set(handles)) == 1 and handles[0] in store.handles
+    assert cache.snapshot()["creates"] == 1
+
+def test_prefix_change_replaces_handle():
+    store = LocalPrefixStore()
+    cache = _cache(store)
+    old = cache.get("m", "prefix เดิม")
+    assert cache.get("m", "prefix เดิม") == old and store.created == 1
+    other = cache.get("อีกโมเดล", "prefix เดิม")  # โมเดลอื่นไม่กระทบกัน
+
+    new = cache.get("m", "prefix ใหม่")
+    assert new != old and store.created == 3
+    assert old not in store.handles and store.text(new) == "prefix ใหม่"
+    assert other in store.handles
+    assert prefix_digest("prefix เดิม") != prefix_digest("prefix ใหม่")
+
+def test_failure_backs_off_then_retries():
+    clock = Clock()
+    store = SlowStore()
+    store.fail = True
+    cache = _cache(store, clock)
+    assert cache.get("m", "prefix") is None
+    store.fail = False
+    clock.now += PREFIX_RETRY_SECONDS - 1
+    assert cache.get("m", "prefix") is None  # ยังอยู่ในช่วงพัก ไม่ลองซ้ำทุกเทิร์น
+    assert store.created == 0 and cache.snapshot()["failures"] == 1
+
+    clock.now += 1
+    assert cache.get("m", "prefix") is not None and store.created == 1
+
+def test_too_small_prefix_is_uncached():
+    cache = _cache(LocalPrefixStore(min_chars=100))
+    assert cache.get("m", "สั้น") is None
+    assert cache.snapshot() == {"handles": 0, "hits": 0, "creates": 0, "failures": 1}
+
+def test_refresh_ahead_of_expiry_in_background():
+    clock = Clock()
+    store = SlowStore()
+    cache = _cache(store, clock, ttl=3600)
+    old = cache.get("m", "prefix")
+    clock.now += 3600 - PREFIX_REFRESH_MARGIN + 1
+
+    store.delay = 0.1
+    started = time.perf_counter()
+    assert cache.get("m", "prefix") == old  # ไม่รอ create
+    assert time.perf_counter() - started < store.delay
+    assert cache.get("m", "prefix") == old  # ระหว่าง refresh ไม่สร้างซ้ำ
+    _wait_refresh(cache)
+    new = cache.get("m", "prefix")
+    assert new != old and store.created == 2
+    assert old in store.handles  # handle เดิมปล่อยหมดอายุเอง คำขอที่ใช้อยู่ไม่พัง
+
+def test_failed_refresh_keeps_handle_until_expiry():
+    clock = Clock()
+    store = SlowStore()
+    cache = _cache(store, clock, ttl=3600)
+    old = cache.get("m", "prefix")
+    clock.now += 3600 - PREFIX_REFRESH_MARGIN + 1
+    store.fail = True
+    assert cache.get("m", "prefix") == old
+    for _ in range(200):
+        if cache.snapshot()["failures"]:
+            break
+        time.sleep(0.01)
+    assert cache.get("m", "prefix") == old and cache.snapshot()["failures"] == 1  # ไม่ลองเบื้องหลังซ้ำ
+
+    store.fail = False
+    clock.now += PREFIX_REFRESH_MARGIN
+    new = cache.get("m", "prefix")  # หมดอายุแล้ว → สร้างใหม่ตรงนี้
+    assert new not in (None, old) and store.created == 2
+
+def test_invalidate_recreates():
+    store = LocalPrefixStore()
+    cache = _cache(store)
+    h = cache.get("m", "prefix")
+    cache.invalidate("m", h)
+    assert h not in store.handles and store.deleted == 1
+    assert cache.get("m", "prefix") not in (None, h)
+
+# ---------- GeminiBackend (genai ปลอม) ----------
+class FakeModel:
+    def __init__(self, log, handle=None, error=None):
+        self.log, self.handle, self.error = log, handle, error
+
+    def generate_content(self, contents, stream=False):
+        self.log.append(self.handle)
+        if self.error:
+            raise RuntimeError(self.error)
+        return iter([type("Chunk", (), {"text": t})() for t in ["ค่า", "เทอม"]])
+
+class FakeGenai:
+    """GenerativeModel ปลอม: errors = handle → ข้อความ error ที่โมเดลจาก cached content นั้นโยน"""
+
+    def __init__(self, errors=None):
+        log = self.log = []
+        errors = errors or {}
+
+        class GenerativeModel:
+            def __new__(cls, model_name=None, **kw):
+                return FakeModel(log)
+
+            @staticmethod
+            def from_cached_content(handle, **kw):
+                return FakeModel(log, handle, errors.get(handle))
+
+        self.GenerativeModel = GenerativeModel
+
+def _gemini(genai, store):
+    backend = GeminiBackend("test-key", prefix_cache=PrefixCache(store))
+    backend._genai = genai
+    return backend
+
+def test_gemini_uses_cached_prefix():
+    store = LocalPrefixStore()
+    genai = FakeGenai()
+    backend = _gemini(genai, store)
+    assert "".join(backend.stream("m", [], "ค่าเทอม")) == "ค่าเทอม"
+    assert "".join(backend.stream("m", [], "ค่าเทอม")) == "ค่าเทอม"
+    handle = next(iter(store.handles))
+    assert genai.log == [handle, handle] and store.text(handle) == PROMPT_FTE
+
+def test_gemini_retries_uncached_when_handle_gone():
+    store = LocalPrefixStore()
+    genai = FakeGenai({"cachedContents/local-1": "404 CachedContent not found"})
+    backend = _gemini(genai, store)
+    assert "".join(backend.stream("m", [], "ค่าเทอม")) == "ค่าเทอม"
+    assert genai.log == ["cachedContents/local-1", None]  # handle ใช้ไม่ได้ → ส่ง prefix เต็มครั้งนี้
+    assert "cachedContents/local-1" not in store.handles
+
+    assert "".join(backend.stream("m", [], "ค่าเทอม")) == "ค่าเทอม"
+    assert genai.log[-1] == "cachedContents/local-2" and store.created == 2
+
+def test_gemini_other_errors_propagate():
+    store = LocalPrefixStore()
+    genai = FakeGenai({"cachedContents/local-1": "429 quota exceeded"})
+    backend = _gemini(genai, store)
+    with pytest.raises(RuntimeError, match="429"):
+        list(backend.stream("m", [], "ค่าเทอม"))
+    assert genai.log == ["cachedContents/local-1"] and store.deleted == 0
@@ -0,0 +1,166 @@
+import pytest
+
+import engine
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from engine import (FALLBACK_MODEL_NAME, PRIMARY_MODEL_NAME, ModelUnavailableError, StubBackend,
+                    stream_with_fallback)
+from tracing import Trace
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def _breaker(clock=None):
+    return CircuitBreaker(window=60, min_calls=4, error_rate=0.5, cooldown=30, clock=clock or Clock())
+
+def _state(breaker, model=PRIMARY_MODEL_NAME):
+    return breaker.snapshot()[model]["state"]
+
+def _run(backend, breaker, **kw):
+    stats, trace, restarts, pieces = {}, Trace(), [], []
+
+    def on_restart(model):
+        restarts.append(model)
+        pieces.clear()  # ผู้เรียกทิ้งข้อความที่ได้มาก่อนหน้า
+
+    for piece in stream_with_fallback(backend, [], "ค่าเทอม", breaker, on_restart, stats, trace, **kw):
+        pieces.append(piece)
+    return "".join(pieces), stats, trace, restarts
+
+def _spans(trace):
+    return {s["name"]: s for s in trace.spans}
+
+# ---------- circuit breaker ----------
+def test_breaker_opens_then_probes():
+    clock = Clock()
+    b = _breaker(clock)
+    for _ in range(3):
+        assert b.allow("m")
+        b.record("m", False)
+    assert _state(b, "m") == CLOSED  # น้อยกว่า min_calls ยังไม่ตัดสิน
+    b.record("m", False)
+    assert _state(b, "m") == OPEN and not b.allow("m")
+
+    clock.now += 30
+    assert b.allow("m")      # คำขอทดลองหนึ่งเดียว
+    assert _state(b, "m") == HALF_OPEN and not b.allow("m")
+    b.record("m", False)     # ทดลองล้ม → open อีกรอบ
+    assert _state(b, "m") == OPEN and not b.allow("m")
+
+    clock.now += 30
+    assert b.allow("m")
+    b.release("m")           # ไม่ได้เรียกจริง → คืนสิทธิ์ทดลอง
+    assert b.allow("m")
+    b.record("m", True, 0.2)
+    assert _state(b, "m") == CLOSED and b.allow("m")
+    assert b.snapshot()["m"]["calls"] == 1  # เริ่มนับใหม่หลังกลับมา closed
+
+def test_breaker_open_cools_down_without_allow():
+    clock = Clock()
+    b = _breaker(clock)
+    for _ in range(4):
+        b.record("m", False)
+    clock.now += 30
+    assert _state(b, "m") == HALF_OPEN  # snapshot ไม่ค้าง open แม้ไม่มีใครเรียก allow
+    b.record("m", True, 0.1)
+    assert _state(b, "m") == CLOSED
+
+def test_breaker_window_expires_failures():
+    clock = Clock()
+    b = _breaker(clock)
+    for _ in range(3):
+        b.record("m", False)
+    clock.now += 61
+    b.record("m", False)
+    assert _state(b, "m") == CLOSED
+
+# ---------- routing ----------
+def test_primary_429_goes_to_fallback_and_opens_breaker():
+    backend = StubBackend(reply_chars=60, faults={PRIMARY_MODEL_NAME: {"error_rate": 1.0}})
+    b = _breaker()
+    for _ in range(4):
+        text, stats, _, restarts = _run(backend, b)
+        assert text.startswith(f"[{FALLBACK_MODEL_NAME}]") and stats["route"] == "fallback"
+        assert not restarts  # ล้มก่อน token แรก ไม่ต้องเริ่มใหม่
+    assert _state(b) == OPEN
+    text, stats, trace, _ = _run(backend, b)
+    assert stats["route"] == "breaker_open" and "model" not in _spans(trace)
+
+def test_all_models_down():
+    backend = StubBackend(error_rate=1.0)
+    with pytest.raises(ModelUnavailableError):
+        _run(backend, _breaker())
+
+def test_fallback_breaker_gates_and_recovers():
+    clock = Clock()
+    b = _breaker(clock)
+    backend = StubBackend(reply_chars=60, error_rate=1.0)
+    for _ in range(4):
+        with pytest.raises(ModelUnavailableError):
+            _run(backend, b)
+    assert _state(b) == OPEN and _state(b, FALLBACK_MODEL_NAME) == OPEN
+    with pytest.raises(ModelUnavailableError):  # open ทั้งคู่ → ไม่เรียกโมเดลใดเลย
+        _run(backend, b)
+    assert b.snapshot()[FALLBACK_MODEL_NAME]["calls"] == 4
+
+    clock.now += 30  # หลัง cooldown: โมเดลหลักยังล่ม โมเดลสำรองกลับมา → คำขอทดลองของทั้งคู่
+    backend.faults = {PRIMARY_MODEL_NAME: {"error_rate": 1.0}, FALLBACK_MODEL_NAME: {"error_rate": 0.0}}
+    text, stats, _, _ = _run(backend, b)
+    assert text.startswith(f"[{FALLBACK_MODEL_NAME}]") and stats["route"] == "fallback"
+    assert _state(b) == OPEN and _state(b, FALLBACK_MODEL_NAME) == CLOSED
+    text, stats, _, _ = _run(backend, b)
+    assert stats["route"] == "breaker_open" and _state(b, FALLBACK_MODEL_NAME) == CLOSED
+
+def test_hedge_fallback_wins(monkeypatch):
+    monkeypatch.setattr(engine, "HEDGE_MAX_DELAY", 0.05)
+    backend = StubBackend(reply_chars=60, faults={PRIMARY_MODEL_NAME: {"first_token_delay": 0.5}})
+    b = _breaker()
+    text, stats, trace, _ = _run(backend, b)
+    assert text.startswith(f"[{FALLBACK_MODEL_NAME}]")
+    assert stats["hedged"] and stats["route"] == "hedge" and stats["model"] == FALLBACK_MODEL_NAME
+    spans = _spans(trace)
+    assert spans["fallback"]["won"] and spans["fallback"]["hedge"]
+    assert spans["model"]["cancelled"] and spans["model"]["ttft_ms"] is None
+    snap = b.snapshot()  # ผู้แพ้ hedge (โมเดลหลัก) นับเป็นความล้มเหลว ผู้ชนะนับสำเร็จ
+    assert snap[PRIMARY_MODEL_NAME]["error_rate"] == 1.0
+    assert snap[FALLBACK_MODEL_NAME]["calls"] == 1 and snap[FALLBACK_MODEL_NAME]["error_rate"] == 0.0
+
+def test_hedge_primary_wins(monkeypatch):
+    monkeypatch.setattr(engine, "HEDGE_MAX_DELAY", 0.05)
+    backend = StubBackend(reply_chars=60, faults={PRIMARY_MODEL_NAME: {"first_token_delay": 0.2},
+                                                  FALLBACK_MODEL_NAME: {"first_token_delay": 2.0}})
+    b = _breaker()
+    text, stats, trace, _ = _run(backend, b)
+    assert text.startswith(f"[{PRIMARY_MODEL_NAME}]")
+    assert stats["hedged"] and stats["route"] == "primary"
+    assert _spans(trace)["fallback"]["cancelled"]
+    snap = b.snapshot()  # hedge ที่ถูกยกเลิกไม่นับเป็นผลของโมเดลสำรอง
+    assert snap[PRIMARY_MODEL_NAME]["calls"] == 1 and snap[PRIMARY_MODEL_NAME]["error_rate"] == 0.0
+    assert snap[FALLBACK_MODEL_NAME]["calls"] == 0
+
+def test_mid_stream_restart():
+    backend = StubBackend(reply_chars=200, piece_chars=20, faults={PRIMARY_MODEL_NAME: {"fail_after": 2}})
+    b = _breaker()
+    text, stats, trace, restarts = _run(backend, b)
+    assert restarts == [FALLBACK_MODEL_NAME]
+    assert text.startswith(f"[{FALLBACK_MODEL_NAME}]") and len(text) == 200
+    assert stats["route"] == "fallback" and stats["model"] == FALLBACK_MODEL_NAME
+    spans = _spans(trace)
+    assert spans["model"]["chars"] == 40 and spans["model"]["error"] == "RuntimeError"
+    assert b.snapshot()[PRIMARY_MODEL_NAME]["error_rate"] == 1.0
+
+def test_early_close_releases_probe():
+    clock = Clock()
+    b = _breaker(clock)
+    for _ in range(4):
+        b.record(PRIMARY_MODEL_NAME, False)
+    clock.now += 30  # half-open: คำขอถัดไปเป็นคำขอทดลอง
+    backend = StubBackend(reply_chars=200, piece_chars=10, piece_delay=0.01)
+    gen = stream_with_fallback(backend, [], "ค่าเทอม", b)
+    assert next(gen).startswith("[")
+    gen.close()  # ผู้ใช้ปิดหน้ากลางสตรีม
+    assert _state(b) == HALF_OPEN
+    assert b.allow(PRIMARY_MODEL_NAME)  # สิทธิ์ทดลองถูกคืน ไม่ค้างจนโมเดลหลักถูกข้ามตลอดไป
@@ -0,0 +1,35 @@
+import json
+import os
+
+import tracing
+from tracing import Tracer
+
+def _finish(tracer, **attrs):
+    trace = tracer.start(**attrs)
+    with trace.span("retrieve"):
+        pass
+    tracer.finish(trace)
+
+def _lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_file_per_channel_and_process(tmp_path, monkeypatch):
+    template = str(tmp_path / "trace-{channel}-{pid}.jsonl")
+    app, api = Tracer(template, channel="streamlit"), Tracer(template, channel="api")
+    _finish(app, channel="streamlit")
+    _finish(api, channel="api")
+    pid = os.getpid()
+    assert app.path == str(tmp_path / f"trace-streamlit-{pid}.jsonl") != api.path
+    assert [r["channel"] for r in _lines(app.path)] == ["streamlit"]
+    assert [r["channel"] for r in _lines(api.path)] == ["api"]
+
+    monkeypatch.setattr(tracing.os, "getpid", lambda: pid + 1)  # เช่น worker ที่ fork หลังสร้าง Tracer
+    _finish(app, channel="streamlit")
+    assert app.path.endswith(f"trace-streamlit-{pid + 1}.jsonl")
+    assert len(_lines(app.path)) == 1 and len(_lines(tmp_path / f"trace-streamlit-{pid}.jsonl")) == 1
+
+def test_no_path_keeps_window_only():
+    tracer = Tracer(path=None)
+    _finish(tracer)
+    assert tracer.path is None and tracer.percentiles()["retrieve"]["n"] == 1
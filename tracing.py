@@ -0,0 +1,143 @@
+# tracing.py
+# จับเวลาแต่ละขั้นของหนึ่งเทิร์นแชท (span) แล้วเขียนเป็น JSONL แบบ append-only หมุนไฟล์ตามขนาด
+# หนึ่งบรรทัดต่อหนึ่งเทิร์น: {"trace_id", "ts", "total_ms", <attrs ของเทิร์น>, "spans": [...]}
+# span ของแต่ละขั้น: {"name", "start_ms" (นับจากต้นเทิร์น), "ms", <attrs ของขั้น>}
+# ไม่เก็บข้อความคำถาม/คำตอบ เก็บเฉพาะขนาด จำนวน token และเลข chunk ที่ค้นเจอ
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# ไฟล์ trace (ว่าง = ไม่เขียนไฟล์), ขนาดสูงสุดต่อไฟล์ก่อนหมุน และจำนวนไฟล์เก่าที่เก็บไว้ (.1 .. .N)
+# RotatingFileHandler หมุนไฟล์ได้ถูกต้องภายในโปรเซสเดียว → ชื่อไฟล์มี {channel} (streamlit/api) และ {pid}
+# แทนค่าตอนเปิดไฟล์ ทุกโปรเซส (หลาย replica ใน checkout เดียวกัน) จึงเขียนคนละไฟล์
+# (FTE_TRACE_PATH ที่ไม่มี {pid} = ผู้ตั้งรับประกันเองว่ามีโปรเซสเดียวเขียนไฟล์นั้น)
+TRACE_PATH = os.environ.get("FTE_TRACE_PATH", str(BASE_DIR / "logs" / "trace-{channel}-{pid}.jsonl"))
+TRACE_MAX_BYTES = int(os.environ.get("FTE_TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUPS = 5
+# จำนวนเทิร์นล่าสุดที่ใช้คำนวณ percentile แบบ rolling
+TRACE_WINDOW = 500
+
+class Trace:
+    """span ของหนึ่งเทิร์น — ใช้จาก thread เดียว (thread ที่ตอบคำขอนั้น)"""
+
+    def __init__(self, **attrs):
+        self.id = uuid.uuid4().hex
+        self.ts = time.time()
+        self.started = time.perf_counter()
+        self.attrs: Dict = dict(attrs)
+        self.spans: List[Dict] = []
+
+    def _ms(self, t: float) -> float:
+        return round((t - self.started) * 1000, 3)
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[Dict]:
+        """จับเวลาช่วงโค้ด; dict ที่ได้เพิ่ม attrs ระหว่างทางได้"""
+        t0 = time.perf_counter()
+        rec = {"name": name, "start_ms": self._ms(t0), **attrs}
+        try:
+            yield rec
+        except Exception as e:
+            rec["error"] = type(e).__name__
+            raise
+        finally:
+            rec["ms"] = round((time.perf_counter() - t0) * 1000, 3)
+            self.spans.append(rec)
+
+    def add_span(self, name: str, ms: float, start: Optional[float] = None, **attrs) -> None:
+        """span ที่จับเวลามาจากที่อื่นแล้ว (เช่น เวลา render สะสมของ StreamRenderer)
+        start = time.perf_counter() ตอนเริ่ม ถ้ารู้ (เช่น คำขอโมเดลที่รันใน thread อื่น)"""
+        self.spans.append({"name": name, "start_ms": None if start is None else self._ms(start),
+                           "ms": round(ms, 3), **attrs})
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> Dict:
+        return {"trace_id": self.id,
+                "ts": round(self.ts, 3),
+                "total_ms": self._ms(time.perf_counter()),
+                **self.attrs,
+                "spans": self.spans}
+
+class Tracer:
+    """รับ Trace ที่จบแล้ว → เขียน JSONL + เก็บไว้ในหน้าต่าง rolling สำหรับ percentile"""
+
+    def __init__(self, path: Optional[str] = TRACE_PATH,
+                 max_bytes: int = TRACE_MAX_BYTES,
+                 backups: int = TRACE_BACKUPS,
+                 window: int = TRACE_WINDOW,
+                 channel: str = "engine"):
+        self._template, self.channel = path, channel
+        self._max_bytes, self._backups = max_bytes, backups
+        self._handler: Optional[RotatingFileHandler] = None
+        self._pid: Optional[int] = None
+        self.path: Optional[str] = None
+        self._recent: "deque[Dict]" = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def _file_handler(self) -> Optional[RotatingFileHandler]:
+        # เปิดไฟล์ของโปรเซสนี้ — โปรเซสที่ fork มาจากผู้สร้าง Tracer (pid เปลี่ยน) ได้ไฟล์ของตัวเอง
+        if not self._template:
+            return None
+        pid = os.getpid()
+        if self._pid != pid:
+            self.path = self._template.format(channel=self.channel, pid=pid)
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            handler = RotatingFileHandler(self.path, maxBytes=self._max_bytes, backupCount=self._backups,
+                                          encoding="utf-8", delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._handler, self._pid = handler, pid
+        return self._handler
+
+    def start(self, **attrs) -> Trace:
+        return Trace(**attrs)
+
+    def finish(self, trace: Trace) -> Dict:
+        rec = trace.to_dict()
+        with self._lock:
+            self._recent.append(rec)
+        try:
+            with self._lock:
+                handler = self._file_handler()
+            if handler is not None:
+                line = json.dumps(rec, ensure_ascii=False, default=str)
+                handler.handle(logging.makeLogRecord({"msg": line, "args": None}))
+        except OSError:
+            pass  # เขียน trace ไม่ได้ต้องไม่ทำให้คำตอบล้ม
+        return rec
+
+    def recent(self) -> List[Dict]:
+        with self._lock:
+            return list(self._recent)
+
+    def percentiles(self, qs=(50, 95, 99)) -> Dict[str, Dict[str, float]]:
+        """{ชื่อขั้น: {"n", "p50", "p95", "p99"}} (ms) จากเทิร์นล่าสุดในหน้าต่าง
+
+        ขั้นที่เกิดหลายครั้งในเทิร์นเดียว (เช่น retry) รวมเวลากันก่อน; "total" คือทั้งเทิร์น
+        """
+        per_stage: Dict[str, List[float]] = {}
+        for rec in self.recent():
+            per_stage.setdefault("total", []).append(rec["total_ms"])
+            sums: Dict[str, float] = {}
+            for s in rec["spans"]:
+                sums[s["name"]] = sums.get(s["name"], 0.0) + s["ms"]
+            for name, ms in sums.items():
+                per_stage.setdefault(name, []).append(ms)
+        out = {}
+        for name, values in per_stage.items():
+            pct = np.percentile(values, qs)
+            out[name] = {"n": len(values), **{f"p{q}": round(float(v), 1) for q, v in zip(qs, pct)}}
+        return out